@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aknx_social_network_app.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up, it serves the notification stream itself
+from main_app.sse import NotificationStream  # noqa: E402
+
+application = NotificationStream(django_application)
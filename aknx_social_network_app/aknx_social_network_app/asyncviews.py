@@ -0,0 +1,52 @@
+"""
+Async entry points for read-only viewset actions served under ASGI.
+
+Under ASGI, Django runs a synchronous view and renders a DRF response on a single
+shared thread (`thread_sensitive=True`), so every request queues behind the
+others for that one thread. Django 3.2 has no async ORM and DRF has no async
+views. The views built here therefore make exactly one hop to a pooled thread.
+That hop runs authentication, the action, pagination and rendering. Everything
+else, including the middleware chain, stays on the event loop. Responses are
+identical to those of the router's synchronous endpoints.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpResponse
+
+from . import metrics
+
+
+def async_action(viewset_class, action):
+    """
+    Builds an async view serving one action of a viewset.
+
+    Args:
+        viewset_class: The viewset the action belongs to.
+        action: The name of a `GET` action of the viewset.
+
+    Returns:
+        The async view, to be routed with `path()`.
+    """
+
+    initkwargs = getattr(viewset_class, action).kwargs
+    sync_view = viewset_class.as_view({'get': action}, **initkwargs)
+
+    def handle(request, kwargs):
+        try:
+            response = metrics.render(sync_view(request, **kwargs))
+            # A plain response, as Django would otherwise render it again on the shared thread
+            plain = HttpResponse(response.content, status=response.status_code)
+            for header, value in response.items():
+                plain[header] = value
+            return plain
+        finally:
+            # Connections of pooled threads are not closed by the request signals
+            close_old_connections()
+
+    async def view(request, **kwargs):
+        return await sync_to_async(handle, thread_sensitive=False)(request, kwargs)
+
+    view.csrf_exempt = True
+    view.__name__ = f'async_{action}'
+    return view
@@ -0,0 +1,115 @@
+"""
+Helpers shared by the benchmark management commands.
+
+Benchmarks run against a throwaway test database created the same way as the
+test runner does, so they never touch the configured database.
+"""
+
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import override_settings
+
+FIRST_NAMES = (
+    'james', 'mary', 'robert', 'patricia', 'john', 'jennifer', 'michael', 'linda',
+    'david', 'elizabeth', 'william', 'barbara', 'richard', 'susan', 'joseph', 'jessica',
+    'thomas', 'sarah', 'arjun', 'priya', 'rahul', 'ananya', 'vikram', 'sneha',
+)
+LAST_NAMES = (
+    'smith', 'johnson', 'williams', 'brown', 'jones', 'garcia', 'miller', 'davis',
+    'sharma', 'verma', 'gupta', 'patel', 'reddy', 'nair', 'iyer', 'mehta',
+)
+
+
+def percentile(samples, pct):
+    """
+    Returns the nearest-rank percentile of the given samples.
+
+    Args:
+        samples: A non-empty sequence of numbers.
+        pct: The percentile to compute, between 0 and 100.
+    """
+
+    ordered = sorted(samples)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def summarize(samples):
+    """
+    Summarizes latency samples given in seconds as milliseconds.
+    """
+
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p90_ms': percentile(samples, 90) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
+
+
+def format_summary(label, summary):
+    return '{:<32} n={:<6} mean={:8.2f}ms p50={:8.2f}ms p90={:8.2f}ms p99={:8.2f}ms'.format(
+        label, summary['count'], summary['mean_ms'], summary['p50_ms'],
+        summary['p90_ms'], summary['p99_ms'])
+
+
+def time_calls(func, arguments):
+    """
+    Calls `func` once per argument and returns the wall time of every call in seconds.
+    """
+
+    samples = []
+    for argument in arguments:
+        start = time.perf_counter()
+        func(argument)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+@contextmanager
+def temporary_database(verbosity=0):
+    """
+    Creates a migrated test database for the duration of the block and destroys it afterwards.
+    Only the default database is replaced, the replicas and shards are left out of the block.
+    """
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        with override_settings(DATABASE_REPLICAS=[], FRIEND_REQUEST_SHARDS=[]):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+def create_synthetic_users(count, batch_size=5000, seed=0, start=0):
+    """
+    Bulk inserts `count` users with realistic looking names and unique emails.
+
+    Passwords are left unusable, hashing a million passwords would dominate the run.
+
+    Returns:
+        list: The primary keys of every user in the database, in insertion order.
+    """
+
+    User = get_user_model()
+    rng = random.Random(seed)
+    created = 0
+    while created < count:
+        batch = []
+        for number in range(start + created, start + min(count, created + batch_size)):
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            email = f'{first_name}.{last_name}{number}@example.com'
+            batch.append(User(
+                username=email, email=email, password='!',
+                first_name=first_name.title(), last_name=last_name.title()))
+        User.objects.bulk_create(batch, batch_size=batch_size)
+        created += len(batch)
+    return list(User.objects.order_by('id').values_list('id', flat=True))
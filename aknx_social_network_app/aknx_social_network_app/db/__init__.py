@@ -0,0 +1,17 @@
+"""
+Database backends adding connection pooling and health checks to Django's.
+
+`aknx_social_network_app.db.sqlite3` and `aknx_social_network_app.db.postgresql`
+take the same settings as the backends they extend, plus:
+
+- `POOL`: `{'SIZE': ..., 'TIMEOUT': ..., 'MAX_LIFETIME': ...}`, a per-process pool
+  of connections shared by the request threads (see pool.py). Without it a
+  connection is opened per request, or kept `CONN_MAX_AGE` seconds by its thread.
+- `CONN_HEALTH_CHECKS`: check a reused connection before its first query in a
+  request, as Django 4.1 does, rather than failing the request on a connection
+  the database server has dropped.
+- `PRAGMAS` (SQLite): pragmas run on every new connection. The `PRAGMAS` of
+  `TEST` are added to them while a test database is in use.
+
+The pools report their acquire latency and saturation at /metrics.
+"""
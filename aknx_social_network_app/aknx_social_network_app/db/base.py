@@ -0,0 +1,63 @@
+from django.utils.asyncio import async_unsafe
+
+from .pool import get_pool
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Takes the connections of a database wrapper from its pool, and checks persistent
+    connections before their first use in a request.
+
+    The health checks backport the `CONN_HEALTH_CHECKS` setting of Django 4.1: a
+    connection kept from a previous request, or taken idle from the pool, runs the
+    backend's `is_usable()` before its first query and is replaced when it fails.
+    """
+
+    health_check_done = False
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def open_connection(self, conn_params):
+        """
+        Opens a new connection, when the pool has no idle one.
+        """
+
+        return super().get_new_connection(conn_params)
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        opened = []
+
+        def connect():
+            opened.append(True)
+            return self.open_connection(conn_params)
+
+        connection = self.pool.acquire(connect)
+        # A connection just opened needs no checking
+        self.health_check_done = bool(opened)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.release(self.connection, discard=self.errors_occurred and not self.is_usable())
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        self.health_check_done = False
+
+    def close_if_health_check_failed(self):
+        if (self.connection is None or self.health_check_done or self.in_atomic_block
+                or not self.settings_dict.get('CONN_HEALTH_CHECKS')):
+            return
+        self.health_check_done = True
+        if not self.is_usable():
+            # Broken rather than in error, it is not given back to the pool
+            self.errors_occurred = True
+            self.close()
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
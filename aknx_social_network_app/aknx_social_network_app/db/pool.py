@@ -0,0 +1,197 @@
+"""
+Per-process pools of database connections, shared by the threads of a process.
+
+A pool keeps up to `size` open connections. A thread needing one takes an idle
+connection, opens a new one while fewer than `size` are open, or waits at most
+`timeout` seconds for another thread to give one back. Connections are given
+back when Django closes them, at the end of every request with the default
+`CONN_MAX_AGE` of 0, and are closed for good once older than `max_lifetime`.
+
+A pool of size 0 keeps no connection: every acquire opens one and every release
+closes it, as Django does on its own, and only the statistics are kept. Every
+database alias has a pool either way, so connect times are always reported.
+"""
+
+import threading
+import time
+
+from django.db.utils import OperationalError
+
+
+class PoolTimeout(OperationalError):
+    """
+    Raised when no connection of a pool became free in time.
+    """
+
+
+class ConnectionPool:
+    """
+    A bounded pool of DB-API connections, taken by one thread at a time.
+
+    Args:
+        alias: The database alias, used in messages and metrics.
+        size: The maximum number of open connections, 0 to keep none.
+        timeout: Seconds an acquire waits for a free connection when `size` are in use.
+        max_lifetime: Seconds after which a connection is closed rather than reused, None to keep it.
+    """
+
+    def __init__(self, alias, size=0, timeout=5, max_lifetime=None):
+        self.alias = alias
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self._condition = threading.Condition()
+        # Most recently released last, so the warmest connection is reused first
+        self._idle = []
+        self._opened_at = {}
+        self._in_use = 0
+        self._stats = {
+            'acquires': 0, 'waits': 0, 'timeouts': 0, 'opened': 0, 'closed': 0,
+            'acquire_seconds': 0.0, 'max_acquire_seconds': 0.0,
+        }
+
+    def acquire(self, connect):
+        """
+        Returns an idle connection, or a new one opened by calling `connect()`.
+
+        Raises:
+            PoolTimeout: If `size` connections stayed in use for `timeout` seconds.
+        """
+
+        start = time.perf_counter()
+        connection = None
+        with self._condition:
+            waited = False
+            deadline = time.monotonic() + self.timeout
+            while self.size and not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f'No connection of the {self.alias!r} database pool became free '
+                        f'within {self.timeout}s, all {self.size} are in use.')
+                waited = True
+                self._condition.wait(remaining)
+            if self._idle:
+                connection = self._idle.pop()
+            self._in_use += 1
+            self._stats['waits'] += waited
+
+        if connection is None:
+            try:
+                connection = connect()
+            except BaseException:
+                with self._condition:
+                    self._in_use -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self._opened_at[connection] = time.monotonic()
+                self._stats['opened'] += 1
+
+        elapsed = time.perf_counter() - start
+        with self._condition:
+            self._stats['acquires'] += 1
+            self._stats['acquire_seconds'] += elapsed
+            self._stats['max_acquire_seconds'] = max(self._stats['max_acquire_seconds'], elapsed)
+        return connection
+
+    def release(self, connection, discard=False):
+        """
+        Gives a connection back, rolling back what it left uncommitted.
+        It is closed instead when discarded, broken, too old or not to be kept.
+        """
+
+        if not discard and self.size:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+        with self._condition:
+            opened_at = self._opened_at.get(connection, 0)
+            expired = self.max_lifetime is not None and time.monotonic() - opened_at >= self.max_lifetime
+            keep = self.size and not discard and not expired
+            if keep:
+                self._idle.append(connection)
+            else:
+                self._opened_at.pop(connection, None)
+                self._stats['closed'] += 1
+            self._in_use -= 1
+            self._condition.notify()
+        if not keep:
+            self._close(connection)
+
+    def close_idle(self):
+        """
+        Closes the idle connections, the ones in use are closed when given back.
+        """
+
+        with self._condition:
+            idle, self._idle = self._idle, []
+            for connection in idle:
+                self._opened_at.pop(connection, None)
+            self._stats['closed'] += len(idle)
+        for connection in idle:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            # Already broken, there is nothing left to release
+            pass
+
+    def stats(self):
+        """
+        Returns the counters of the pool, along with the number of connections in use and idle.
+        """
+
+        with self._condition:
+            return {**self._stats, 'size': self.size, 'in_use': self._in_use, 'idle': len(self._idle)}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict):
+    """
+    Returns the pool of a database, created from its `POOL` settings on first use.
+
+    Databases are told apart by their alias and location, so the test databases do not
+    get the connections of the databases they replace.
+    """
+
+    key = (alias, str(settings_dict['NAME']), settings_dict['HOST'], str(settings_dict['PORT']))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            options = settings_dict.get('POOL') or {}
+            pool = _pools[key] = ConnectionPool(
+                alias,
+                size=options.get('SIZE', 0),
+                timeout=options.get('TIMEOUT', 5),
+                max_lifetime=options.get('MAX_LIFETIME'),
+            )
+        return pool
+
+
+def get_pools():
+    """
+    Returns the pools of this process, as (alias, pool) pairs.
+    """
+
+    with _pools_lock:
+        return [(key[0], pool) for key, pool in _pools.items()]
+
+
+def close_pools():
+    """
+    Closes the idle connections of every pool and forgets the pools.
+    """
+
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_idle()
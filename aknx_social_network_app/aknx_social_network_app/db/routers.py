@@ -0,0 +1,218 @@
+"""
+Routing of the read-heavy endpoints to the read replicas.
+
+Viewsets list their replica actions in `replica_actions` and mix in
+`ReplicaReadsMixin`. A GET request to one of those actions picks a replica
+once, after authentication, and every query of the request reads from it.
+Everything else uses the primary: writes, the other actions, and any read made
+inside a transaction.
+
+Replicas trail the primary, so two rules keep users from seeing their data go
+back in time:
+
+- Users are pinned to the primary for `DATABASE_REPLICA_PIN_SECONDS` after a
+  write changing their data, whoever made it. The social cache pins the users
+  whose entries it drops, and the mixin pins the authors of successful writes.
+  Pins live in the `DATABASE_REPLICA_PIN_CACHE` alias, which must be shared by
+  the processes, a pin is otherwise missed by the process serving the next read.
+- A replica lagging more than `DATABASE_REPLICA_MAX_LAG` seconds, or failing its
+  lag check, gets no reads until a later check finds it caught up. Each process
+  checks a replica at most every `DATABASE_REPLICA_LAG_CHECK_INTERVAL` seconds.
+
+The pin window covers the lag tolerated plus the check interval, so a user
+pinned after a write reads from the primary until every replica in use has it.
+"""
+
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+logger = logging.getLogger(__name__)
+
+PIN_KEY = 'db:pinned:{}'
+
+_replica = contextvars.ContextVar('replica_alias', default=None)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends the reads of replica requests to the replica they picked, and the rest to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = _replica.get()
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Explicit, instances read from a replica would otherwise be saved to it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        return db not in settings.DATABASE_REPLICAS
+
+
+def replica_lag(alias):
+    """
+    Returns how many seconds a replica trails the primary.
+
+    Only PostgreSQL replicas report it. A replica that has replayed everything it received
+    is up to date, however long ago the primary last wrote. One still replaying trails by
+    the age of the last transaction it replayed. Other engines are assumed to be up to date.
+    """
+
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT CASE '
+            'WHEN NOT pg_is_in_recovery() THEN 0 '
+            'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+            'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+        return float(cursor.fetchone()[0])
+
+
+class LagMonitor:
+    """
+    The last known lag of each replica in this process, checked again once stale.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checks = {}
+        self._routed = Counter()
+
+    def is_fresh(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._checks.get(alias, (None, None))
+            stale = checked_at is None or now - checked_at >= settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL
+            if stale:
+                # Other requests keep the previous result while this one checks
+                self._checks[alias] = (now, lag)
+        if stale:
+            try:
+                lag = replica_lag(alias)
+            except DatabaseError:
+                logger.warning('Could not check the lag of the %s database', alias, exc_info=True)
+                lag = None
+            with self._lock:
+                self._checks[alias] = (now, lag)
+        return lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG
+
+    def record(self, alias, reason):
+        with self._lock:
+            self._routed[alias, reason] += 1
+
+    def status(self):
+        """
+        Returns the last lag measured of each replica, None when it could not be checked,
+        and the number of requests routed to each database, with the reason.
+        """
+
+        with self._lock:
+            return {
+                'lag': {alias: lag for alias, (_, lag) in self._checks.items()},
+                'routed': dict(self._routed),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._checks.clear()
+            self._routed.clear()
+
+
+monitor = LagMonitor()
+
+
+def choose_replica(user_id):
+    """
+    Returns the alias of a replica to serve a read of the given user from,
+    None when it must be served from the primary.
+    """
+
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas:
+        return None
+    if user_id is not None and is_pinned(user_id):
+        monitor.record(DEFAULT_DB_ALIAS, 'pinned')
+        return None
+    fresh = [alias for alias in replicas if monitor.is_fresh(alias)]
+    if not fresh:
+        monitor.record(DEFAULT_DB_ALIAS, 'lagging')
+        return None
+    alias = random.choice(fresh)
+    monitor.record(alias, 'replica')
+    return alias
+
+
+def is_shared_cache(alias):
+    """
+    Returns whether a cache is shared by the processes, unlike the local-memory and dummy caches.
+    """
+
+    return not settings.CACHES[alias]['BACKEND'].endswith(('.LocMemCache', '.DummyCache'))
+
+
+def get_pin_cache():
+    alias = settings.DATABASE_REPLICA_PIN_CACHE
+    if not is_shared_cache(alias):
+        raise ImproperlyConfigured(
+            f'Read replicas need a DATABASE_REPLICA_PIN_CACHE shared by the processes, the {alias} cache is not, '
+            'see SOCIAL_CACHE_URL.')
+    return caches[alias]
+
+
+def pin_to_primary(*user_ids):
+    """
+    Serves the reads of the given users from the primary for the next `DATABASE_REPLICA_PIN_SECONDS`.
+    """
+
+    if not settings.DATABASE_REPLICAS or not user_ids:
+        return
+    get_pin_cache().set_many(
+        {PIN_KEY.format(user_id): True for user_id in user_ids}, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return get_pin_cache().get(PIN_KEY.format(user_id), False)
+
+
+class ReplicaReadsMixin:
+    """
+    Viewset mixin serving the GET requests of the `replica_actions` from a read replica,
+    and pinning the authors of successful writes to the primary.
+    """
+
+    replica_actions = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and self.action in self.replica_actions:
+            self._replica_token = _replica.set(choose_replica(request.user.pk))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _replica.reset(token)
+            self._replica_token = None
+        elif (request.method not in SAFE_METHODS and response.status_code < 400
+              and request.user.is_authenticated):
+            pin_to_primary(request.user.pk)
+        return super().finalize_response(request, response, *args, **kwargs)
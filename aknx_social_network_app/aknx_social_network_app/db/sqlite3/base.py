@@ -0,0 +1,33 @@
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+from ..base import PooledDatabaseWrapperMixin
+from .creation import DatabaseCreation
+
+PRAGMA_TOKEN = re.compile(r'^\w+$')
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, SQLiteDatabaseWrapper):
+    """
+    The SQLite backend with pooled connections, running the `PRAGMAS` of the database
+    settings on every new connection, e.g. `{'journal_mode': 'wal', 'busy_timeout': 5000}`.
+    """
+
+    creation_class = DatabaseCreation
+
+    def open_connection(self, conn_params):
+        pragmas = self.settings_dict.get('PRAGMAS') or {}
+        for name, value in pragmas.items():
+            # Pragmas take no parameters, they are checked before going into the SQL
+            if not PRAGMA_TOKEN.match(name) or not PRAGMA_TOKEN.match(str(value)):
+                raise ImproperlyConfigured(f'Invalid SQLite pragma {name!r} = {value!r}.')
+        connection = super().open_connection(conn_params)
+        try:
+            for name, value in pragmas.items():
+                connection.execute(f'PRAGMA {name} = {value}')
+        except BaseException:
+            connection.close()
+            raise
+        return connection
@@ -0,0 +1,40 @@
+import os
+
+from django.db.backends.sqlite3.creation import DatabaseCreation as SQLiteDatabaseCreation
+
+from ..pool import close_pools
+
+
+class DatabaseCreation(SQLiteDatabaseCreation):
+    """
+    Removes the write-ahead log along with a test database file, a log left behind
+    would be replayed into the next test database of the same name. The `PRAGMAS`
+    of the `TEST` settings are run on the test database's connections, on top of
+    those of the database it replaces.
+    """
+
+    def _remove_journal(self, test_database_name):
+        for suffix in ('-wal', '-shm'):
+            try:
+                os.remove(f'{test_database_name}{suffix}')
+            except FileNotFoundError:
+                pass
+
+    def _create_test_db(self, verbosity, autoclobber, keepdb=False):
+        test_database_name = super()._create_test_db(verbosity, autoclobber, keepdb)
+        if not keepdb and not self.is_in_memory_db(test_database_name):
+            self._remove_journal(test_database_name)
+        settings_dict = self.connection.settings_dict
+        self._pragmas = settings_dict.get('PRAGMAS')
+        settings_dict['PRAGMAS'] = {**(self._pragmas or {}), **settings_dict['TEST'].get('PRAGMAS', {})}
+        return test_database_name
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the log open
+        close_pools()
+        if hasattr(self, '_pragmas'):
+            self.connection.settings_dict['PRAGMAS'] = self._pragmas
+            del self._pragmas
+        super()._destroy_test_db(test_database_name, verbosity)
+        if test_database_name and not self.is_in_memory_db(test_database_name):
+            self._remove_journal(test_database_name)
@@ -0,0 +1,368 @@
+"""
+Per-request performance instrumentation and its Prometheus endpoint.
+
+`InstrumentationMiddleware` measures every request and files the numbers under
+its route name (the router's `<basename>-<action>`, e.g.
+`friendrequest-get-friend-list`) and method:
+
+- the wall time of the request,
+- the number of queries and the time spent in the database, measured by an
+  execute wrapper installed on every database connection,
+- the time spent rendering the response data to JSON,
+- the size of the response body (not known for streaming responses).
+
+The numbers are aggregated in process into fixed-bucket histograms. An
+observation costs a few bisections under a lock and the memory used does not
+grow with traffic. `metrics_view` serves them in the Prometheus text format,
+along with the social cache and throttle counters, the acquire latency and
+saturation of the database connection pools, and the lag and reads of the
+replicas. Each process reports its own
+requests, so every worker has to be scraped.
+
+Requests slower than `SLOW_REQUEST_MS` are logged as warnings along with the
+SQL they ran, slowest statement first. The overhead of the instrumentation is
+measured by the `benchmark_instrumentation` command.
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+
+from aknx_social_network_app.db import routers
+from aknx_social_network_app.db.pool import get_pools
+from main_app import cache as social_cache
+from main_app.throttles import get_throttle_stats
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+HISTOGRAMS = {
+    'http_request_duration_seconds': (LATENCY_BUCKETS, 'Wall time of the requests.'),
+    'http_request_db_duration_seconds': (LATENCY_BUCKETS, 'Time the requests spent in the database.'),
+    'http_request_queries': (QUERY_BUCKETS, 'Database queries made by the requests.'),
+    'http_request_render_duration_seconds': (LATENCY_BUCKETS, 'Time spent rendering the responses.'),
+    'http_response_size_bytes': (SIZE_BUCKETS, 'Size of the response bodies, streaming responses excluded.'),
+}
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, with their sum.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        # Buckets are inclusive upper bounds, the last count is the +Inf bucket
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class MetricsRegistry:
+    """
+    Histograms and status counters of the requests served by this process, per route and method.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._responses = Counter()
+
+    def observe(self, route, method, status, values):
+        """
+        Records a request.
+
+        Args:
+            route: The route name of the request.
+            method: The HTTP method of the request.
+            status: The status code of the response.
+            values: A mapping of histogram name to the value observed, None when it is unknown.
+        """
+
+        with self._lock:
+            histograms = self._histograms.get((route, method))
+            if histograms is None:
+                histograms = self._histograms[route, method] = {
+                    name: Histogram(buckets) for name, (buckets, _) in HISTOGRAMS.items()
+                }
+            for name, value in values.items():
+                if value is not None:
+                    histograms[name].observe(value)
+            self._responses[route, method, status] += 1
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._responses.clear()
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+
+        with self._lock:
+            lines = []
+            for name, (buckets, description) in HISTOGRAMS.items():
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+                for (route, method), histograms in sorted(self._histograms.items()):
+                    histogram = histograms[name]
+                    labels = f'route="{route}",method="{method}"'
+                    bounds = [format_value(bound) for bound in buckets] + ['+Inf']
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_sum{{{labels}}} {format_value(histogram.sum)}')
+                    lines.append(f'{name}_count{{{labels}}} {sum(histogram.counts)}')
+
+            lines += ['# HELP http_responses_total Responses per route, method and status.',
+                      '# TYPE http_responses_total counter']
+            for (route, method, status), count in sorted(self._responses.items()):
+                lines.append(f'http_responses_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+        return lines
+
+
+registry = MetricsRegistry()
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestMetrics:
+    """
+    Measurements of the request being served, shared with the threads it runs queries on.
+    """
+
+    __slots__ = ('queries', 'db_time', 'render_time', 'statements', 'max_statements')
+
+    def __init__(self, max_statements):
+        self.queries = 0
+        self.db_time = 0
+        self.render_time = None
+        self.statements = []
+        self.max_statements = max_statements
+
+    def record_query(self, sql, duration):
+        self.queries += 1
+        self.db_time += duration
+        if len(self.statements) < self.max_statements:
+            self.statements.append((duration, sql))
+
+
+def record_queries(execute, sql, params, many, context):
+    """
+    Execute wrapper timing the queries made while a request is being measured.
+    """
+
+    request_metrics = _current.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_metrics.record_query(sql, time.perf_counter() - start)
+
+
+def instrument_connection(connection, **kwargs):
+    if record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_queries)
+
+
+def render(response):
+    """
+    Renders a response, counting the time it takes as render time of the current request.
+    """
+
+    start = time.perf_counter()
+    response.render()
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.render_time = time.perf_counter() - start
+    return response
+
+
+class InstrumentationMiddleware:
+    """
+    Middleware measuring every request into the process-wide registry.
+    Works in both sync and async middleware chains, so async views stay async.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Marks the instance as a coroutine function for Django's handler
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        self.slow_request_time = settings.SLOW_REQUEST_MS / 1000
+        self.max_statements = settings.SLOW_REQUEST_MAX_STATEMENTS
+        # Connections opened from now on, e.g. on the threads of async views. The ones
+        # already open on the request thread are instrumented by __call__.
+        connection_created.connect(instrument_connection, dispatch_uid='metrics.instrument_connection')
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        for connection in connections.all():
+            instrument_connection(connection)
+        request_metrics = RequestMetrics(self.max_statements)
+        token = _current.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, request_metrics, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        request_metrics = RequestMetrics(self.max_statements)
+        token = _current.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, request_metrics, time.perf_counter() - start)
+        return response
+
+    def process_template_response(self, request, response):
+        request_metrics = _current.get()
+        if request_metrics is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                request_metrics.render_time = time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def finish(self, request, response, request_metrics, duration):
+        match = request.resolver_match
+        route = (match.url_name or match.view_name) if match else 'unmatched'
+        registry.observe(route, request.method, response.status_code, {
+            'http_request_duration_seconds': duration,
+            'http_request_db_duration_seconds': request_metrics.db_time,
+            'http_request_queries': request_metrics.queries,
+            'http_request_render_duration_seconds': request_metrics.render_time,
+            'http_response_size_bytes': None if response.streaming else len(response.content),
+        })
+        if duration >= self.slow_request_time:
+            statements = ''.join(
+                '\n  {:.1f}ms {}'.format(statement_time * 1000, sql)
+                for statement_time, sql in sorted(request_metrics.statements, key=lambda s: -s[0]))
+            logger.warning(
+                'Slow request %s %s (%s): %.0fms, %d queries taking %.0fms%s',
+                request.method, request.get_full_path(), route, duration * 1000,
+                request_metrics.queries, request_metrics.db_time * 1000, statements)
+
+
+POOL_COUNTERS = (
+    ('db_connections_opened_total', 'opened', 'Connections opened by the database pools.'),
+    ('db_connection_acquire_waits_total', 'waits', 'Acquires that waited for a connection to be given back.'),
+    ('db_connection_acquire_timeouts_total', 'timeouts', 'Acquires that gave up waiting for a connection.'),
+)
+
+
+def render_pools():
+    """
+    Returns the statistics of the database connection pools in the Prometheus text format.
+    """
+
+    pools = [(alias, pool.stats()) for alias, pool in get_pools()]
+    lines = ['# HELP db_pool_size Maximum open connections of the database pools, 0 when not pooled.',
+             '# TYPE db_pool_size gauge']
+    lines += [f'db_pool_size{{alias="{alias}"}} {stats["size"]}' for alias, stats in pools]
+    lines += ['# HELP db_connections Open connections of the database pools, in use or idle.',
+              '# TYPE db_connections gauge']
+    for alias, stats in pools:
+        for state in ('in_use', 'idle'):
+            lines.append(f'db_connections{{alias="{alias}",state="{state}"}} {stats[state]}')
+    lines += ['# HELP db_connection_acquire_seconds Time spent taking a connection from a pool or opening one.',
+              '# TYPE db_connection_acquire_seconds summary']
+    for alias, stats in pools:
+        lines.append(f'db_connection_acquire_seconds_sum{{alias="{alias}"}} {format_value(stats["acquire_seconds"])}')
+        lines.append(f'db_connection_acquire_seconds_count{{alias="{alias}"}} {stats["acquires"]}')
+    lines += ['# HELP db_connection_acquire_max_seconds Longest time spent taking a connection.',
+              '# TYPE db_connection_acquire_max_seconds gauge']
+    lines += [f'db_connection_acquire_max_seconds{{alias="{alias}"}} {format_value(stats["max_acquire_seconds"])}'
+              for alias, stats in pools]
+    for name, key, description in POOL_COUNTERS:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+        lines += [f'{name}{{alias="{alias}"}} {stats[key]}' for alias, stats in pools]
+    return lines
+
+
+def render_replicas():
+    """
+    Returns the last lag measured of the read replicas, and where the replica requests went,
+    in the Prometheus text format.
+    """
+
+    status = routers.monitor.status()
+    lines = ['# HELP db_replica_lag_seconds Last lag measured of the read replicas, NaN when the check failed.',
+             '# TYPE db_replica_lag_seconds gauge']
+    lines += [f'db_replica_lag_seconds{{alias="{alias}"}} {"NaN" if lag is None else format_value(lag)}'
+              for alias, lag in status['lag'].items()]
+    lines += ['# HELP db_replica_routed_requests_total Replica requests per database serving them, and why.',
+              '# TYPE db_replica_routed_requests_total counter']
+    lines += [f'db_replica_routed_requests_total{{alias="{alias}",reason="{reason}"}} {count}'
+              for (alias, reason), count in status['routed'].items()]
+    return lines
+
+
+def metrics_view(request):
+    """
+    Serves the metrics of this process in the Prometheus text format.
+    Scrapers authenticate with `Authorization: Bearer <METRICS_TOKEN>`.
+    """
+
+    token = settings.METRICS_TOKEN
+    if not token or not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('Forbidden\n', status=403, content_type=CONTENT_TYPE)
+
+    lines = registry.render()
+    lines += ['# HELP social_cache_requests_total Lookups of the per-user social cache.',
+              '# TYPE social_cache_requests_total counter']
+    for kind, stats in social_cache.get_stats().items():
+        for result in ('hits', 'misses'):
+            lines.append(f'social_cache_requests_total{{kind="{kind}",result="{result}"}} {stats[result]}')
+    lines += ['# HELP throttle_requests_total Requests allowed and denied per throttle scope, in every process.',
+              '# TYPE throttle_requests_total counter']
+    for scope, counters in get_throttle_stats().items():
+        for result, count in counters.items():
+            lines.append(f'throttle_requests_total{{scope="{scope}",result="{result}"}} {count}')
+    lines += render_pools()
+    lines += render_replicas()
+    return HttpResponse('\n'.join(lines) + '\n', content_type=CONTENT_TYPE)
@@ -0,0 +1,169 @@
+"""
+Pagination classes shared by the API viewsets.
+
+`PageNumberOrCursorPagination` is the default pagination class. It keeps the
+page number behaviour unless the client asks for keyset pagination, either with
+`?pagination=cursor` or by following a `cursor` link from a previous page.
+"""
+
+import base64
+import binascii
+import json
+from collections.abc import Mapping
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(values):
+    """
+    Encodes a list of ordering values into an opaque, url-safe cursor string.
+    """
+
+    payload = json.dumps([
+        value.isoformat() if hasattr(value, 'isoformat') else value for value in values
+    ], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields):
+    """
+    Decodes a cursor produced by `encode_cursor` back into python values.
+
+    Args:
+        cursor: The opaque cursor string sent by the client.
+        fields: The model fields the cursor values belong to, in order.
+
+    Raises:
+        ValueError: If the cursor is malformed or does not match the fields.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('Invalid cursor')
+    try:
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except DjangoValidationError as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def keyset_filter(ordering, values):
+    """
+    Builds the condition selecting the rows strictly after `values` in `ordering`.
+
+    For an ordering of `('-created_at', '-id')` this is
+    `created_at < c OR (created_at = c AND id < i)`.
+    """
+
+    condition = Q()
+    for position, (name, value) in enumerate(zip(ordering, values)):
+        field = name.lstrip('-')
+        lookup = 'lt' if name.startswith('-') else 'gt'
+        step = Q(**{f'{field}__{lookup}': value})
+        for previous_name, previous_value in zip(ordering[:position], values[:position]):
+            step &= Q(**{previous_name.lstrip('-'): previous_value})
+        condition |= step
+    return condition
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset pagination over a unique, indexed ordering.
+
+    Pages are fetched with `WHERE (ordering) > (last row) LIMIT page_size + 1`, so
+    no COUNT query is issued and the cost of a page does not depend on its depth.
+    Rows inserted while a client is paging never shift the rows it has yet to see.
+    The ordering is taken from the view's `cursor_ordering` attribute and must end
+    with a unique field; the last row of a page may be a model instance or a dict
+    produced by `values()`, as long as it carries the ordering fields.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    ordering = ('-id',)
+
+    def get_ordering(self, view):
+        return tuple(getattr(view, 'cursor_ordering', self.ordering))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(view)
+        self.base_url = request.build_absolute_uri()
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in self.ordering]
+            try:
+                values = decode_cursor(cursor, fields)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+            queryset = queryset.filter(keyset_filter(self.ordering, values))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_row_value(self, row, name):
+        if isinstance(row, Mapping):
+            return row[name]
+        return getattr(row, name)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        values = [self.get_row_value(last, name.lstrip('-')) for name in self.ordering]
+        return replace_query_param(self.base_url, self.cursor_query_param, encode_cursor(values))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class PageNumberOrCursorPagination(PageNumberPagination):
+    """
+    Page number pagination that switches to `KeysetPagination` per request.
+    A request opts in with `?pagination=cursor` or by sending a `cursor` parameter.
+    """
+
+    pagination_query_param = 'pagination'
+    keyset_class = KeysetPagination
+
+    def use_cursor(self, request):
+        return (
+            request.query_params.get(self.pagination_query_param) == 'cursor'
+            or self.keyset_class.cursor_query_param in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.keyset_class() if self.use_cursor(request) else None
+        if self.keyset is not None:
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,147 @@
+"""
+Opt-in fast path for serializing and rendering large list responses.
+
+With `many=True`, DRF runs every row through the field machinery of the
+serializer: attribute lookup, `SkipField` handling and `to_representation` per
+field and per row, then `JSONRenderer` encodes the result. For the flat,
+read-only serializers of the list endpoints, `FastListSerializer` compiles the
+fields once into a plan of `(name, source, converter)` and extracts every row
+with a single `itemgetter` (or `attrgetter` for model instances).
+`FastJSONRenderer` encodes those rows with `orjson` when it is installed.
+
+Both are enabled by the `FAST_SERIALIZATION` setting and produce the same bytes
+as the standard path: the converters are the ones the fields would apply, and
+`orjson` is only used on payloads made of strings, integers, booleans and
+nulls, which it encodes exactly like `json.dumps` does for DRF. Anything else
+falls back to DRF.
+"""
+
+from collections.abc import Mapping
+from operator import attrgetter, itemgetter
+
+from django.conf import settings
+from django.db import models
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.serializer_helpers import ReturnList
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The fields whose `to_representation` is a plain conversion of the value
+CONVERTERS = {
+    serializers.IntegerField: int,
+    serializers.CharField: str,
+    serializers.EmailField: str,
+}
+PLAIN_TYPES = (str, int, bool, type(None))
+
+_plans = {}
+
+
+class PlainList(ReturnList):
+    """
+    Serialized rows known to hold only strings, integers, booleans and nulls.
+    """
+
+
+def compile_plan(serializer):
+    """
+    Compiles the readable fields of a serializer into `(name, source, converter)` tuples.
+
+    Returns:
+        tuple: The plan, or None if a field needs the full DRF machinery.
+    """
+
+    if type(serializer).to_representation is not serializers.Serializer.to_representation:
+        return None
+    plan = []
+    for field in serializer._readable_fields:
+        converter = CONVERTERS.get(type(field))
+        if converter is None or len(field.source_attrs) != 1:
+            return None
+        plan.append((field.field_name, field.source_attrs[0], converter))
+    if not plan:
+        return None
+    return tuple(plan)
+
+
+def make_extractor(getter, plan):
+    """
+    Returns a function fetching the values of every field of a row at once, as a tuple.
+    """
+
+    sources = [source for _, source, _ in plan]
+    extract = getter(*sources)
+    if len(sources) == 1:
+        return lambda row: (extract(row),)
+    return extract
+
+
+class FastListSerializer(serializers.ListSerializer):
+    """
+    List serializer running flat, read-only child serializers through a compiled plan.
+    Opt in with `list_serializer_class = FastListSerializer` in the child's Meta.
+    The plan is compiled once per child serializer class, so the child's fields must
+    not depend on the context.
+    """
+
+    def get_plan(self):
+        child_class = type(self.child)
+        if child_class not in _plans:
+            plan = compile_plan(self.child)
+            _plans[child_class] = plan and (
+                plan, make_extractor(itemgetter, plan), make_extractor(attrgetter, plan))
+        return _plans[child_class]
+
+    def to_representation(self, data):
+        compiled = self.get_plan() if settings.FAST_SERIALIZATION else None
+        self._plain = compiled is not None
+        if compiled is None:
+            return super().to_representation(data)
+
+        plan, extract_item, extract_attr = compiled
+        fields = [(name, converter) for name, _, converter in plan]
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        rows = []
+        for row in iterable:
+            values = extract_item(row) if isinstance(row, Mapping) else extract_attr(row)
+            rows.append({
+                name: None if value is None else converter(value)
+                for (name, converter), value in zip(fields, values)
+            })
+        return rows
+
+    @property
+    def data(self):
+        data = super().data
+        if getattr(self, '_plain', False):
+            return PlainList(data, serializer=self)
+        return data
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer encoding the rows of `FastListSerializer` with orjson,
+    bare or in a pagination envelope. Other payloads are rendered by DRF.
+    """
+
+    def is_plain(self, data):
+        if isinstance(data, PlainList):
+            return True
+        return isinstance(data, dict) and any(isinstance(value, PlainList) for value in data.values()) and all(
+            isinstance(value, PlainList) or type(value) in PLAIN_TYPES for value in data.values())
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.ensure_ascii or not self.compact or not self.is_plain(data) \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data)
+        except orjson.JSONEncodeError:
+            # Integers past 64 bits and invalid strings, left to DRF to render or reject
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped like DRF does, so the output stays a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
@@ -19,6 +19,8 @@ from rest_framework_nested import routers
 
 from users.views import UsersViewSet
 from main_app.views import SocialViewSet
+from .asyncviews import async_action
+from .metrics import metrics_view
 
 router = routers.SimpleRouter()
 router.register(r'users', UsersViewSet)
@@ -28,4 +30,13 @@ router.register(r'social', SocialViewSet)
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
+    # Same read endpoints for ASGI deployments, see asyncviews.py
+    path('api/async/social/get_friend_list/', async_action(SocialViewSet, 'get_friend_list'),
+         name='async-friendrequest-get-friend-list'),
+    path('api/async/social/get_pending_friend_requests/',
+         async_action(SocialViewSet, 'get_pending_friend_requests'),
+         name='async-friendrequest-get-pending-friend-requests'),
+    path('api/async/users/search_users/', async_action(UsersViewSet, 'search_users'),
+         name='async-user-search-users'),
+    path('metrics', metrics_view, name='metrics'),
 ]
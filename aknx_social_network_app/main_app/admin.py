@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ProfilingRule
+
+
+@admin.register(ProfilingRule)
+class ProfilingRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'path_pattern', 'user', 'sample_percent', 'enabled', 'expires_at')
+    list_filter = ('enabled',)
+    raw_id_fields = ('user',)
@@ -0,0 +1,157 @@
+"""
+Per-user cache of friend ids, friend counts, pending friend request counts and social versions.
+
+Entries live in the cache alias named by the `SOCIAL_CACHE_ALIAS` setting, a
+local-memory cache by default (bounded by MAX_ENTRIES, evicting the least
+recently used entry, and expiring after TIMEOUT) or any shared cache backend.
+Every write path touching friend requests invalidates the affected users'
+entries, and hits and misses are counted per process to size the cache.
+
+A user's social version identifies the state of their friend requests. It is
+dropped along with the other entries on every write and reseeded from the clock
+on the next read, so it only ever increases. The list endpoints derive their
+ETags from it when the cache is shared by the processes. Users whose entries are
+dropped are also pinned to the primary database for a while, so they do not read
+the data from before the write from a replica that has yet to get it.
+"""
+
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from aknx_social_network_app.db.routers import is_shared_cache, pin_to_primary
+
+from .models import FriendRequest, Friendship
+
+FRIEND_IDS_KEY = 'social:friend_ids:{}'
+FRIEND_COUNT_KEY = 'social:friend_count:{}'
+PENDING_COUNT_KEY = 'social:pending_count:{}'
+VERSION_KEY = 'social:version:{}'
+
+_stats_lock = threading.Lock()
+_stats = Counter()
+
+
+def get_cache():
+    return caches[settings.SOCIAL_CACHE_ALIAS]
+
+
+def _record(kind, hit):
+    with _stats_lock:
+        _stats[kind, 'hits' if hit else 'misses'] += 1
+
+
+def get_friend_ids(user_id):
+    """
+    Returns the ids of a user's friends, loading them from the Friendship table on a miss.
+    Lists longer than `SOCIAL_CACHE_MAX_FRIEND_IDS` are not cached to keep entries small.
+    """
+
+    cache = get_cache()
+    key = FRIEND_IDS_KEY.format(user_id)
+    friend_ids = cache.get(key)
+    _record('friend_ids', friend_ids is not None)
+    if friend_ids is None:
+        friend_ids = list(Friendship.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
+        if len(friend_ids) <= settings.SOCIAL_CACHE_MAX_FRIEND_IDS:
+            cache.set(key, friend_ids)
+    return friend_ids
+
+
+def get_friend_count(user_id):
+    """
+    Returns the number of friends of a user. It is cached on its own, also for the users
+    whose friend ids are too many to cache.
+    """
+
+    cache = get_cache()
+    key = FRIEND_COUNT_KEY.format(user_id)
+    count = cache.get(key)
+    _record('friend_count', count is not None)
+    if count is None:
+        count = Friendship.objects.filter(user_id=user_id).count()
+        cache.set(key, count)
+    return count
+
+
+def get_pending_count(user_id):
+    """
+    Returns the number of pending friend requests received by a user.
+    """
+
+    cache = get_cache()
+    key = PENDING_COUNT_KEY.format(user_id)
+    count = cache.get(key)
+    _record('pending_count', count is not None)
+    if count is None:
+        count = FriendRequest.objects.filter(receiver_id=user_id, status='pending').count()
+        cache.set(key, count)
+    return count
+
+
+def get_version(user_id):
+    """
+    Returns the social version of a user, which changes on every write to a friend request
+    sent or received by the user.
+    """
+
+    cache = get_cache()
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    _record('version', version is not None)
+    if version is None:
+        seed = time.time_ns()
+        cache.add(key, seed)
+        # Another process may have seeded it first
+        version = cache.get(key, seed)
+    return version
+
+
+def invalidate(*user_ids):
+    """
+    Drops the cached entries of the given users after a write to their friend requests.
+    The entries are dropped right away and once more when the surrounding transaction
+    commits, so a read racing with the write cannot leave data cached from before it.
+    """
+
+    user_ids = set(user_ids)
+    keys = [key.format(user_id) for user_id in user_ids
+            for key in (FRIEND_IDS_KEY, FRIEND_COUNT_KEY, PENDING_COUNT_KEY, VERSION_KEY)]
+    if not keys:
+        return
+    get_cache().delete_many(keys)
+    pin_to_primary(*user_ids)
+
+    def committed():
+        get_cache().delete_many(keys)
+        # The pins run from the commit, when the replicas start getting the write
+        pin_to_primary(*user_ids)
+
+    transaction.on_commit(committed)
+
+
+def get_stats():
+    """
+    Returns the hits, misses and hit ratio of each kind of entry in this process.
+    """
+
+    with _stats_lock:
+        stats = {}
+        for kind in ('friend_ids', 'friend_count', 'pending_count', 'version'):
+            hits, misses = _stats[kind, 'hits'], _stats[kind, 'misses']
+            total = hits + misses
+            stats[kind] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': hits / total if total else None,
+            }
+        return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,144 @@
+"""
+Change feed of the friend requests sent or received by a user.
+
+A client keeps a local copy of its friend requests and asks for the changes
+since the position it last synced to. Changes are friend request rows whose
+`updated_at` moved past that position, including rejected requests, and the
+tombstones of deleted requests. The position is an opaque cursor over
+`(timestamp, kind, id)` where `kind` orders rows before tombstones stamped
+with the same time.
+
+Each page is read with one index range scan per side (sender or receiver) and
+per kind, merged in Python, so a sync costs work proportional to the number of
+changes and not to the size of the lists. Timestamps are taken before the
+write commits, so once caught up the cursor stops `settle` short of the present:
+changes committed late within that window are sent again rather than missed.
+"""
+
+import heapq
+from datetime import timedelta
+
+from django.db.models import IntegerField, Q
+from django.utils import timezone
+
+from aknx_social_network_app.pagination import decode_cursor, encode_cursor
+
+from .models import FriendRequest, FriendRequestTombstone
+
+ROW, TOMBSTONE = 0, 1
+# Sorts before every change stamped with the same time
+BEFORE_ALL = -1
+
+
+class ExpiredCursor(Exception):
+    """
+    Raised for a cursor older than the tombstone retention, deletions since then may be lost.
+    """
+
+
+def parse_since(since):
+    """
+    Decodes a `since` cursor into a `(timestamp, kind, id)` position.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+
+    fields = [FriendRequest._meta.get_field('updated_at'), IntegerField(), FriendRequest._meta.get_field('id')]
+    return tuple(decode_cursor(since, fields))
+
+
+def after(position, kind, time_field):
+    """
+    Builds the condition selecting the changes of the given kind strictly after `position`.
+    """
+
+    time, position_kind, position_id = position
+    if kind > position_kind:
+        return Q(**{f'{time_field}__gte': time})
+    if kind < position_kind:
+        return Q(**{f'{time_field}__gt': time})
+    return Q(**{f'{time_field}__gt': time}) | Q(**{time_field: time, 'id__gt': position_id})
+
+
+def request_changes(user_id, position, limit):
+    for side, counterpart in (('sender', 'receiver'), ('receiver', 'sender')):
+        queryset = FriendRequest.objects.filter(**{side: user_id})
+        if position is not None:
+            queryset = queryset.filter(after(position, ROW, 'updated_at'))
+        rows = queryset.with_counterpart_profile(counterpart).order_by('updated_at', 'id')[:limit]
+        yield [((row['updated_at'], ROW, row['id']), {
+            'id': row['id'],
+            'sender': row['sender_id'],
+            'receiver': row['receiver_id'],
+            'status': row['status'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+            'deleted': False,
+            'user': {
+                'id': row['profile_id'],
+                'email': row['email'],
+                'first_name': row['first_name'],
+                'last_name': row['last_name'],
+            },
+        }) for row in rows]
+
+
+def tombstone_changes(user_id, position, limit):
+    for side in ('sender_id', 'receiver_id'):
+        queryset = FriendRequestTombstone.objects.filter(**{side: user_id})
+        if position is not None:
+            queryset = queryset.filter(after(position, TOMBSTONE, 'deleted_at'))
+        tombstones = queryset.values(
+            'id', 'request_id', 'sender_id', 'receiver_id', 'deleted_at').order_by('deleted_at', 'id')[:limit]
+        yield [((tombstone['deleted_at'], TOMBSTONE, tombstone['id']), {
+            'id': tombstone['request_id'],
+            'sender': tombstone['sender_id'],
+            'receiver': tombstone['receiver_id'],
+            'status': None,
+            'created_at': None,
+            'updated_at': tombstone['deleted_at'],
+            'deleted': True,
+            'user': None,
+        }) for tombstone in tombstones]
+
+
+def friend_request_changes(user_id, since=None, limit=100, settle=timedelta(seconds=5), retention=None):
+    """
+    Returns a page of changes to the friend requests of a user.
+
+    Args:
+        user_id: The user whose friend requests are synced.
+        since: The cursor returned by the previous sync, None for a full sync.
+        limit: The maximum number of changes returned.
+        settle: How close to the present the returned cursor may get.
+        retention: How long tombstones are kept, older cursors are refused.
+
+    Returns:
+        tuple: The changes oldest first, the cursor to sync from next time, and whether
+            more changes are ready to be fetched right away.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+        ExpiredCursor: If the cursor is older than the tombstone retention.
+    """
+
+    now = timezone.now()
+    position = parse_since(since) if since else None
+    if position is not None and retention is not None and position[0] < now - retention:
+        raise ExpiredCursor()
+
+    sources = [*request_changes(user_id, position, limit + 1), *tombstone_changes(user_id, position, limit + 1)]
+    merged = list(heapq.merge(*sources, key=lambda change: change[0]))
+    has_more = len(merged) > limit
+    page = merged[:limit]
+
+    if has_more:
+        next_position = page[-1][0]
+    else:
+        # Caught up: resume from just before the present, changes stamped within the
+        # settle window may not all be committed yet and are sent again next time
+        next_position = (now - settle, BEFORE_ALL, 0)
+        if position is not None:
+            next_position = max(next_position, position)
+    return [change for _, change in page], encode_cursor(next_position), has_more
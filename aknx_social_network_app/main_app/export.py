@@ -0,0 +1,159 @@
+"""
+Streaming export of friend requests as NDJSON or CSV.
+
+Rows are read with `QuerySet.iterator(chunk_size=...)`, which uses a
+server-side cursor where the database supports one, and encoded one chunk at
+a time. Memory use stays the same whether a user has ten friend requests or
+the whole table holds millions. The encoded chunks are served as a
+`StreamingHttpResponse` by `SocialViewSet.export`, or written to a file by
+the `export_friend_requests` command.
+
+Django 3.2 iterates streaming responses on the event loop under ASGI, where
+database queries are not allowed. There the chunks are produced on a worker
+thread and handed over through a small bounded queue.
+"""
+
+import asyncio
+import csv
+import itertools
+import queue
+import threading
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from rest_framework.negotiation import DefaultContentNegotiation
+
+from .models import FriendRequest
+
+FIELDS = ('id', 'sender_id', 'sender_email', 'receiver_id', 'receiver_email', 'status', 'created_at', 'updated_at')
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+_DONE = object()
+
+
+class ExportContentNegotiation(DefaultContentNegotiation):
+    """
+    Picks the first renderer whatever the client accepts, for the errors of an export.
+    The export itself is not rendered, its format is chosen by the `output` parameter.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+def export_queryset(user_id=None):
+    """
+    Returns the friend requests sent or received by a user, or all of them if no user is given.
+    """
+
+    queryset = FriendRequest.objects.all()
+    if user_id is not None:
+        queryset = queryset.involving(user_id)
+    return queryset.for_export()
+
+
+class Echo:
+    """
+    File-like object handing back what the csv writer writes to it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def encode_ndjson(rows):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    return ''.join(encoder.encode({field: row[field] for field in FIELDS}) + '\n' for row in rows)
+
+
+_csv_writer = csv.writer(Echo())
+
+
+def encode_csv(rows):
+    return ''.join(_csv_writer.writerow([
+        row[field].isoformat() if hasattr(row[field], 'isoformat') else row[field] for field in FIELDS
+    ]) for row in rows)
+
+
+def export_chunks(queryset, output='ndjson', chunk_size=2000):
+    """
+    Yields the export of a queryset as encoded chunks of up to `chunk_size` rows.
+
+    Args:
+        queryset: The rows to export, as produced by `export_queryset`. An export of every
+            friend request is read one database after the other while sharded, in id order in each.
+        output: 'ndjson' or 'csv'.
+        chunk_size: The number of rows fetched from the database and encoded at a time.
+    """
+
+    encode = encode_csv if output == 'csv' else encode_ndjson
+    if output == 'csv':
+        yield encode_csv([dict(zip(FIELDS, FIELDS))]).encode()
+    chunk = []
+    rows = itertools.chain.from_iterable(shard.iterator(chunk_size=chunk_size) for shard in queryset.per_shard())
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield encode(chunk).encode()
+            chunk = []
+    if chunk:
+        yield encode(chunk).encode()
+
+
+def iterate_in_thread(iterable, buffer_size=4):
+    """
+    Yields the items of an iterable consumed on a worker thread, at most `buffer_size` ahead.
+    The caller blocks while waiting for the next item. Closing the generator stops the worker.
+    """
+
+    items = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def put(item, error=None):
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except Exception as e:
+            put(_DONE, e)
+        finally:
+            # Releases the cursor, then the connection this thread opened
+            getattr(iterable, 'close', lambda: None)()
+            connections.close_all()
+
+    threading.Thread(target=produce, name='export', daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def stream_chunks(chunks):
+    """
+    Yields the chunks of an export, from a worker thread when iterated on an event loop.
+    """
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        yield from chunks
+    else:
+        yield from iterate_in_thread(chunks)
@@ -0,0 +1,60 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Count
+
+from . import sharding
+from .models import FriendRequest, Friendship
+
+User = get_user_model()
+
+PROFILE_FIELDS = ('id', 'email', 'first_name', 'last_name')
+
+
+def friend_ids(user_id):
+    """
+    Returns a subquery of the ids of a user's friends, served by the (user, friend) index.
+    """
+
+    return Friendship.objects.filter(user_id=user_id).values('friend_id')
+
+
+def mutual_friends(user_id, other_id):
+    """
+    Lists the friends two users have in common, computed in a single query.
+
+    Args:
+        user_id: The id of the first user.
+        other_id: The id of the second user.
+
+    Returns:
+        QuerySet: Dicts with the `id`, `email`, `first_name` and `last_name` of each mutual friend,
+        ordered by id.
+    """
+
+    return User.objects.filter(
+        id__in=friend_ids(user_id)).filter(id__in=friend_ids(other_id)).order_by('id').values(*PROFILE_FIELDS)
+
+
+def friend_suggestions(user_id):
+    """
+    Ranks the friends of a user's friends by the number of friends they have in common with the user.
+    Candidates are found with one set-based query walking two hops of the Friendship table,
+    excluding the user, their current friends and anyone they already sent a friend request to.
+
+    Args:
+        user_id: The id of the user to suggest friends for.
+
+    Returns:
+        QuerySet: Dicts with the candidate's profile fields and `mutual_friends`, best candidates first.
+    """
+
+    my_friends = friend_ids(user_id)
+    requested = FriendRequest.objects.filter(sender_id=user_id).values('receiver_id')
+    if sharding.is_sharded():
+        # Stored apart from the users, the ids are read first
+        requested = list(requested.values_list('receiver_id', flat=True))
+
+    # Users having a friendship with one of my friends, one joined row per mutual friend
+    candidates = User.objects.filter(friendships__friend_id__in=my_friends)
+    candidates = candidates.exclude(id=user_id).exclude(id__in=my_friends).exclude(id__in=requested)
+    return candidates.values(*PROFILE_FIELDS).annotate(
+        mutual_friends=Count('friendships')).order_by('-mutual_friends', 'id')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from main_app.models import Friendship
+
+
+class Command(BaseCommand):
+    help = 'Creates the missing Friendship rows for every accepted friend request.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Number of friend requests linked per transaction.')
+
+    def handle(self, *args, **options):
+        linked = 0
+        for count in Friendship.objects.link_accepted(batch_size=options['batch_size']):
+            linked += count
+            self.stdout.write(f'Linked {linked} accepted friend requests')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled friendships for {linked} friend requests.'))
@@ -0,0 +1,173 @@
+import asyncio
+import io
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test import override_settings
+
+from aknx_social_network_app.benchmarking import (
+    FIRST_NAMES,
+    create_synthetic_users,
+    format_summary,
+    summarize,
+    temporary_database,
+)
+from main_app.synthetic import DEFAULT_STATUSES, create_friend_graph
+from users.tokens import issue_access_token
+
+User = get_user_model()
+
+ENDPOINTS = (
+    ('social/get_friend_list/', ''),
+    ('social/get_pending_friend_requests/', ''),
+    ('users/search_users/', 'search={}'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Load tests the read endpoints with many concurrent clients, comparing the async '
+        'endpoints under ASGI with the synchronous ones under ASGI and WSGI. The '
+        'applications are called in-process, so the numbers leave out the HTTP server '
+        'and its socket handling.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000)
+        parser.add_argument('--edges', type=int, default=100_000,
+                            help='Number of friend requests in the graph.')
+        parser.add_argument('--requests', type=int, default=5_000,
+                            help='Number of requests sent to each configuration.')
+        parser.add_argument('--concurrency', type=int, default=1_000,
+                            help='Number of requests in flight at once.')
+        parser.add_argument('--wsgi-threads', type=int, default=32,
+                            help='Number of worker threads of the WSGI server.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        store = {'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'}
+        with temporary_database(), override_settings(RATE_LIMIT_STORE=store):
+            start = time.perf_counter()
+            user_ids = create_synthetic_users(options['users'], seed=options['seed'])
+            create_friend_graph(user_ids, options['edges'], seed=options['seed'], statuses=DEFAULT_STATUSES)
+            self.stdout.write('Created {} users and {} friend requests in {:.1f}s'.format(
+                len(user_ids), options['edges'], time.perf_counter() - start))
+
+            plan = self.make_plan(user_ids, options['requests'], options['seed'])
+            configurations = [
+                ('asgi-async', self.asgi_caller(get_asgi_application(), '/api/async/')),
+                ('asgi-sync', self.asgi_caller(get_asgi_application(), '/api/')),
+                ('wsgi', self.wsgi_caller(get_wsgi_application(), '/api/', options['wsgi_threads'])),
+            ]
+            for label, call in configurations:
+                elapsed, samples, statuses = asyncio.run(self.drive(call, plan, options['concurrency']))
+                errors = sum(count for status, count in statuses.items() if status != 200)
+                self.stdout.write('{} {:9.1f} req/s errors={}'.format(
+                    format_summary(label, summarize(samples)), len(samples) / elapsed, errors))
+
+    def make_plan(self, user_ids, count, seed):
+        """
+        Builds the requests to send, as (path, query string, authorization header) tuples.
+        """
+
+        rng = random.Random(seed)
+        users = User.objects.in_bulk(rng.sample(user_ids, min(len(user_ids), 500)))
+        tokens = [f'Bearer {issue_access_token(user)}' for user in users.values()]
+        plan = []
+        for _ in range(count):
+            path, query = rng.choice(ENDPOINTS)
+            plan.append((path, query.format(rng.choice(FIRST_NAMES)), rng.choice(tokens)))
+        return plan
+
+    async def drive(self, call, plan, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        samples = []
+        statuses = Counter()
+
+        async def send(request):
+            async with semaphore:
+                start = time.perf_counter()
+                status = await call(*request)
+                samples.append(time.perf_counter() - start)
+                statuses[status] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(request) for request in plan))
+        return time.perf_counter() - start, samples, statuses
+
+    def asgi_caller(self, application, prefix):
+        async def call(path, query, authorization):
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': '1.1',
+                'method': 'GET',
+                'scheme': 'http',
+                'path': prefix + path,
+                'query_string': query.encode(),
+                'root_path': '',
+                'headers': [
+                    (b'host', b'testserver'),
+                    (b'accept', b'application/json'),
+                    (b'authorization', authorization.encode()),
+                ],
+                'client': ('127.0.0.1', 0),
+                'server': ('testserver', 80),
+            }
+            started = {}
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    started['status'] = message['status']
+
+            await application(scope, receive, send)
+            return started['status']
+        return call
+
+    def wsgi_caller(self, application, prefix, threads):
+        executor = ThreadPoolExecutor(max_workers=threads)
+
+        def handle(path, query, authorization):
+            environ = {
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': prefix + path,
+                'QUERY_STRING': query,
+                'SERVER_NAME': 'testserver',
+                'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1',
+                'HTTP_ACCEPT': 'application/json',
+                'HTTP_AUTHORIZATION': authorization,
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(),
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split()[0])
+
+            body = application(environ, start_response)
+            try:
+                b''.join(body)
+            finally:
+                # Sends request_finished, closing the thread's database connection
+                body.close()
+            return started['status']
+
+        async def call(*request):
+            return await asyncio.get_running_loop().run_in_executor(executor, handle, *request)
+        return call
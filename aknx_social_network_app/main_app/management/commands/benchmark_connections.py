@@ -0,0 +1,174 @@
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count, Max
+from django.test import override_settings
+from django.test.testcases import _StaticFilesHandler
+
+from aknx_social_network_app.benchmarking import (
+    FIRST_NAMES,
+    create_synthetic_users,
+    format_summary,
+    summarize,
+    temporary_database,
+)
+from aknx_social_network_app.db.pool import close_pools, get_pool
+from main_app.models import FriendRequest
+from main_app.synthetic import DEFAULT_STATUSES, create_friend_graph
+from main_app.throttles import FriendRequestRateThrottle
+from users.tokens import issue_access_token
+
+from .benchmark_endpoints import BenchmarkServerThread
+
+User = get_user_model()
+
+READS = (
+    '/api/social/get_friend_list/',
+    '/api/social/get_pending_friend_requests/',
+    '/api/social/suggestions/',
+    '/api/users/search_users/?search={}',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Load tests the read and write endpoints through a live HTTP server with concurrent '
+        'clients, on a throwaway database holding a synthetic friend graph, opening a '
+        'connection per request, keeping persistent connections, and taking them from a pool.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000)
+        parser.add_argument('--edges', type=int, default=100_000,
+                            help='Number of friend requests in the graph.')
+        parser.add_argument('--requests', type=int, default=2_000,
+                            help='Number of requests sent to each configuration.')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Number of clients, each with its own keep-alive HTTP connection.')
+        parser.add_argument('--pool-size', type=int, default=4,
+                            help='Size of the pool, below the concurrency to show waits.')
+        parser.add_argument('--write-percent', type=float, default=10,
+                            help='Percentage of the requests sending a friend request.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        store = {'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'}
+        # Throttled like production, with a rate the benchmark cannot reach
+        # Slow requests are expected under load, they are not logged
+        with temporary_database(), override_settings(RATE_LIMIT_STORE=store, SLOW_REQUEST_MS=60_000), \
+                mock.patch.object(FriendRequestRateThrottle, 'rate', '1000000/min'):
+            start = time.perf_counter()
+            user_ids = create_synthetic_users(options['users'], seed=options['seed'])
+            create_friend_graph(user_ids, options['edges'], statuses=DEFAULT_STATUSES, seed=options['seed'])
+            self.stdout.write('Created {} users and {} friend requests in {:.1f}s'.format(
+                len(user_ids), options['edges'], time.perf_counter() - start))
+
+            # The most requested users, whose lists are the largest, send to users they never met
+            senders = FriendRequest.objects.values('receiver_id').annotate(
+                requests=Count('id')).order_by('-requests')[:options['concurrency']]
+            tokens = [issue_access_token(User(pk=row['receiver_id'])) for row in senders]
+
+            pragmas = connection.settings_dict.get('PRAGMAS') or {}
+            configurations = (
+                ('per-request', {'CONN_MAX_AGE': 0, 'POOL': None, 'PRAGMAS': {'journal_mode': 'delete'}}),
+                ('per-request+pragmas', {'CONN_MAX_AGE': 0, 'POOL': None, 'PRAGMAS': pragmas}),
+                ('persistent', {'CONN_MAX_AGE': 600, 'POOL': None, 'PRAGMAS': pragmas}),
+                ('pooled', {'CONN_MAX_AGE': 0, 'POOL': {'SIZE': options['pool_size'], 'TIMEOUT': 30},
+                            'PRAGMAS': pragmas}),
+            )
+            saved = {key: connection.settings_dict.get(key) for key in ('CONN_MAX_AGE', 'POOL', 'PRAGMAS')}
+            try:
+                for label, overrides in configurations:
+                    plan, receivers = self.make_plan(random.Random(options['seed']), options)
+                    # The wrappers of the server threads are built from these settings, and
+                    # the pools are created again from them
+                    connection.close()
+                    close_pools()
+                    connection.settings_dict.update(overrides)
+                    # Switches the journal mode before the clients connect, it takes a lock of its own
+                    connection.ensure_connection()
+                    connection.close()
+                    self.run(label, tokens, plan, receivers)
+            finally:
+                connection.close()
+                connection.settings_dict.update(saved)
+                close_pools()
+
+    def make_plan(self, rng, options):
+        """
+        Returns the method and path of every request, and users without any friend request
+        to send the writes to, one per write.
+        """
+
+        plan = []
+        for _ in range(options['requests']):
+            if rng.random() * 100 < options['write_percent']:
+                plan.append(('POST', '/api/social/send_request/'))
+            else:
+                plan.append(('GET', rng.choice(READS).format(rng.choice(FIRST_NAMES))))
+        writes = sum(method == 'POST' for method, _ in plan)
+        last_id = User.objects.aggregate(last_id=Max('id'))['last_id']
+        user_ids = create_synthetic_users(writes, seed=rng.random(), start=last_id)
+        return plan, user_ids[len(user_ids) - writes:]
+
+    def run(self, label, tokens, plan, receivers):
+        """
+        Sends the requests of one configuration from concurrent clients and reports them.
+        """
+
+        server = BenchmarkServerThread('localhost', _StaticFilesHandler)
+        server.daemon = True
+        server.start()
+        server.is_ready.wait()
+        if server.error:
+            raise server.error
+
+        samples, statuses = [], Counter()
+        lock = threading.Lock()
+
+        def client(token):
+            http_connection = http.client.HTTPConnection('localhost', server.port)
+            headers = {'Accept': 'application/json', 'Content-Type': 'application/json',
+                       'Authorization': f'Bearer {token}'}
+            try:
+                while True:
+                    with lock:
+                        if not plan:
+                            return
+                        method, path = plan.pop()
+                        body = json.dumps({'receiver': receivers.pop()}) if method == 'POST' else None
+                    start = time.perf_counter()
+                    http_connection.request(method, path, body, headers)
+                    response = http_connection.getresponse()
+                    response.read()
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        samples.append(elapsed)
+                        statuses[response.status] += 1
+            finally:
+                http_connection.close()
+
+        clients = [threading.Thread(target=client, args=(token,)) for token in tokens]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        duration = time.perf_counter() - start
+        server.terminate()
+
+        stats = get_pool(connection.alias, connection.settings_dict).stats()
+        close_pools()
+        self.stdout.write(format_summary(label, summarize(samples)) + ' {:7.0f} req/s statuses={}'.format(
+            len(samples) / duration, ','.join(f'{status}x{count}' for status, count in sorted(statuses.items()))))
+        self.stdout.write('{:<32} connections opened={} acquire mean={:.3f}ms max={:.2f}ms waits={} timeouts={}'.format(
+            '', stats['opened'], stats['acquire_seconds'] / max(stats['acquires'], 1) * 1000,
+            stats['max_acquire_seconds'] * 1000, stats['waits'], stats['timeouts']))
@@ -0,0 +1,330 @@
+import http.client
+import itertools
+import json
+import random
+import socket
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Max
+from django.test import Client, override_settings
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.test.testcases import LiveServerThread, QuietWSGIRequestHandler, _StaticFilesHandler
+from django.test.utils import CaptureQueriesContext
+
+from aknx_social_network_app.benchmarking import (
+    FIRST_NAMES,
+    create_synthetic_users,
+    format_summary,
+    summarize,
+    temporary_database,
+)
+from aknx_social_network_app.urls import router
+from main_app.models import FriendRequest
+from main_app.synthetic import DEFAULT_STATUSES, create_friend_graph
+from main_app.throttles import FriendRequestRateThrottle
+from users.tokens import issue_access_token
+
+User = get_user_model()
+
+PASSWORD = 'benchmark-password'
+# Router endpoints left out of the suite, with the reason
+EXCLUDED = {
+    ('user-list', 'post'): 'creates users with a blank username, `register` is the supported path',
+    ('friendrequest-detail', 'put'): 'SocialRequestSerializer does not implement update()',
+    ('friendrequest-detail', 'patch'): 'SocialRequestSerializer does not implement update()',
+}
+MODES = ('client', 'http')
+
+
+class NoDelayWSGIServer(ThreadedWSGIServer):
+    """
+    Sends responses without waiting on Nagle's algorithm, which otherwise holds back the
+    body behind the headers until the client's delayed acknowledgement, 40ms later.
+    """
+
+    def get_request(self):
+        request, address = super().get_request()
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return request, address
+
+
+class BenchmarkServerThread(LiveServerThread):
+    def _create_server(self):
+        return NoDelayWSGIServer((self.host, self.port), QuietWSGIRequestHandler, allow_reuse_address=False)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks every endpoint of the API router on a throwaway database holding a '
+        'synthetic power-law friend graph, through the Django test client and through a '
+        'live HTTP server. Reports latency percentiles, queries and peak allocations per '
+        'request, and fails when they regress past the stored baseline.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000)
+        parser.add_argument('--edges', type=int, default=100_000,
+                            help='Number of friend requests in the graph.')
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Number of timed requests per endpoint and mode.')
+        parser.add_argument('--warmup', type=int, default=3,
+                            help='Untimed requests per endpoint and mode, also used to measure allocations.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default=str(settings.BASE_DIR / 'benchmark_baseline.json'),
+                            help='Results to compare against.')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Store the results as the new baseline instead of comparing.')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Relative increase of p50 latency or peak allocations tolerated.')
+
+    def handle(self, *args, **options):
+        parameters = {key: options[key] for key in ('users', 'edges', 'requests', 'warmup', 'seed')}
+        store = {'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'}
+        # Throttled like production, with a rate the benchmark cannot reach
+        with temporary_database(), override_settings(RATE_LIMIT_STORE=store), \
+                mock.patch.object(FriendRequestRateThrottle, 'rate', '1000000/min'):
+            start = time.perf_counter()
+            user_ids = create_synthetic_users(options['users'], seed=options['seed'])
+            create_friend_graph(user_ids, options['edges'], statuses=DEFAULT_STATUSES, seed=options['seed'])
+            self.stdout.write('Created {} users and {} friend requests in {:.1f}s'.format(
+                len(user_ids), options['edges'], time.perf_counter() - start))
+
+            calls = (options['warmup'] + options['requests']) * len(MODES)
+            scenarios = self.make_scenarios(user_ids, calls, random.Random(options['seed']))
+            missing = self.check_coverage(scenarios)
+            results = {}
+            for mode in MODES:
+                with self.sender(mode) as send:
+                    for key, factory in scenarios.items():
+                        result = self.run(mode, send, key, factory, options['warmup'], options['requests'])
+                        results.setdefault(key, {})[mode] = result
+                        self.report(key, mode, result)
+
+        if missing:
+            raise CommandError('No scenario for: {}'.format(', '.join(missing)))
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump({'parameters': parameters, 'results': results}, baseline_file, indent=2, sort_keys=True)
+                baseline_file.write('\n')
+            self.stdout.write(self.style.SUCCESS(f'Saved the baseline to {options["baseline"]}'))
+            return
+        self.compare(options['baseline'], parameters, results, options['tolerance'])
+
+    def check_coverage(self, scenarios):
+        """
+        Returns the router endpoints that neither have a scenario nor are excluded.
+        """
+
+        missing = []
+        for pattern in router.urls:
+            for method in pattern.callback.actions:
+                key = (pattern.name, method)
+                if key in EXCLUDED:
+                    self.stdout.write('Skipping {} {}: {}'.format(method.upper(), pattern.name, EXCLUDED[key]))
+                elif f'{method.upper()} {pattern.name}' not in scenarios:
+                    missing.append(f'{method.upper()} {pattern.name}')
+        return missing
+
+    def make_scenarios(self, user_ids, calls, rng):
+        """
+        Builds a request factory per endpoint, keyed by method and route name. Each call of a
+        factory returns the path, the JSON body and the authorization header of one request,
+        with fresh rows for the endpoints that write.
+        """
+
+        # The most requested user, whose lists are the largest
+        user = User.objects.get(pk=FriendRequest.objects.values('receiver_id').annotate(
+            requests=Count('id')).order_by('-requests')[0]['receiver_id'])
+        user.set_password(PASSWORD)
+        user.save()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', PASSWORD)
+        as_user = f'Bearer {issue_access_token(user)}'
+        as_admin = f'Bearer {issue_access_token(admin)}'
+
+        # Users without any friend request, and requests pending for the user, consumed by
+        # the endpoints that write
+        last_id = User.objects.aggregate(last_id=Max('id'))['last_id']
+        fresh = iter(create_synthetic_users(calls * 31, seed=rng.random(), start=last_id)[-calls * 31:])
+        FriendRequest.objects.bulk_create([
+            FriendRequest(sender_id=next(fresh), receiver=user) for _ in range(calls * 15)])
+        pending = iter(FriendRequest.objects.filter(
+            receiver=user, sender_id__gt=last_id).order_by('id').values_list('id', flat=True))
+        logout_tokens = iter([f'Bearer {issue_access_token(user)}' for _ in range(calls)])
+        numbers = itertools.count()
+
+        def take(count):
+            return [next(fresh) for _ in range(count)]
+
+        def read(path, authorization=as_user):
+            return lambda: (path, None, authorization)
+
+        return {
+            'GET user-list': read('/api/users/'),
+            'POST user-email-login': lambda: (
+                '/api/users/email_login/', {'email': user.email, 'password': PASSWORD}, None),
+            'POST user-logout': lambda: ('/api/users/logout/', None, next(logout_tokens)),
+            'POST user-register': lambda: ('/api/users/register/', {
+                'email': f'registered{next(numbers)}@example.com', 'first_name': 'New',
+                'last_name': 'User', 'password': PASSWORD}, None),
+            'GET user-search-users': lambda: (
+                f'/api/users/search_users/?search={rng.choice(FIRST_NAMES)}', None, as_user),
+            'GET user-detail': lambda: (f'/api/users/{rng.choice(user_ids)}/', None, as_user),
+            'PUT user-detail': lambda: (f'/api/users/{take(1)[0]}/', {
+                'email': f'renamed{next(numbers)}@example.com', 'first_name': 'Re',
+                'last_name': 'Named'}, as_user),
+            'PATCH user-detail': lambda: (f'/api/users/{take(1)[0]}/', {'first_name': 'Patched'}, as_user),
+            'DELETE user-detail': lambda: (f'/api/users/{take(1)[0]}/', None, as_user),
+            'GET friendrequest-list': read('/api/social/'),
+            'POST friendrequest-list': lambda: ('/api/social/', {'receiver': take(1)[0]}, as_user),
+            'POST friendrequest-send-request': lambda: (
+                '/api/social/send_request/', {'receiver': take(1)[0]}, as_user),
+            'POST friendrequest-bulk-send-requests': lambda: (
+                '/api/social/bulk_send_requests/', {'receivers': take(10)}, as_user),
+            'POST friendrequest-update-request-status': lambda: (
+                f'/api/social/{next(pending)}/update_request_status/', {'status': 'accepted'}, as_user),
+            'POST friendrequest-bulk-update-request-status': lambda: (
+                '/api/social/bulk_update_request_status/',
+                {'requests': [{'id': next(pending), 'status': 'accepted'} for _ in range(10)]}, as_user),
+            'GET friendrequest-get-friend-list': read('/api/social/get_friend_list/'),
+            'GET friendrequest-get-pending-friend-requests': read('/api/social/get_pending_friend_requests/'),
+            'GET friendrequest-mutual-friends': lambda: (
+                f'/api/social/{rng.choice(user_ids)}/mutual_friends/', None, as_user),
+            'GET friendrequest-suggestions': read('/api/social/suggestions/'),
+            'GET friendrequest-changes': read('/api/social/changes/'),
+            'GET friendrequest-export': read('/api/social/export/'),
+            'GET friendrequest-cache-stats': read('/api/social/cache_stats/', as_admin),
+            'GET friendrequest-detail': lambda: (f'/api/social/{next(pending)}/', None, as_user),
+            'DELETE friendrequest-detail': lambda: (f'/api/social/{next(pending)}/', None, as_user),
+        }
+
+    @contextmanager
+    def sender(self, mode):
+        """
+        Yields a function sending a request in the given mode and returning its status code.
+        """
+
+        if mode == 'client':
+            client = Client(raise_request_exception=False)
+
+            def send(method, path, data, authorization):
+                response = client.generic(
+                    method, path, json.dumps(data) if data is not None else '',
+                    content_type='application/json', HTTP_ACCEPT='application/json',
+                    **({'HTTP_AUTHORIZATION': authorization} if authorization else {}))
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                return response.status_code
+
+            yield send
+            return
+
+        # Requests are served on threads with their own connections to the test database
+        server = BenchmarkServerThread('localhost', _StaticFilesHandler)
+        server.daemon = True
+        server.start()
+        server.is_ready.wait()
+        if server.error:
+            raise server.error
+        http_connection = http.client.HTTPConnection('localhost', server.port)
+
+        def send(method, path, data, authorization):
+            headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+            if authorization:
+                headers['Authorization'] = authorization
+            http_connection.request(method, path, json.dumps(data) if data is not None else None, headers)
+            response = http_connection.getresponse()
+            response.read()
+            return response.status
+
+        try:
+            yield send
+        finally:
+            http_connection.close()
+            server.terminate()
+
+    def run(self, mode, send, key, factory, warmup, requests):
+        """
+        Sends the warmup requests, measuring their queries and peak allocations in client
+        mode, then times the others.
+        """
+
+        method = key.split()[0]
+        queries, peaks = None, []
+        for _ in range(warmup):
+            path, data, authorization = factory()
+            if mode != 'client':
+                send(method, path, data, authorization)
+                continue
+            tracemalloc.start()
+            with CaptureQueriesContext(connection) as captured:
+                send(method, path, data, authorization)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+            tracemalloc.stop()
+            queries = len(captured)
+
+        samples = []
+        statuses = Counter()
+        for _ in range(requests):
+            path, data, authorization = factory()
+            start = time.perf_counter()
+            statuses[str(send(method, path, data, authorization))] += 1
+            samples.append(time.perf_counter() - start)
+        return {
+            **summarize(samples),
+            'queries': queries,
+            'peak_kib': round(sum(peaks) / len(peaks), 1) if peaks else None,
+            'statuses': dict(statuses),
+        }
+
+    def report(self, key, mode, result):
+        details = ' statuses={}'.format(','.join(f'{status}x{count}' for status, count in result['statuses'].items()))
+        if result['queries'] is not None:
+            details = ' queries={:<3} peak={:8.1f}KiB'.format(result['queries'], result['peak_kib']) + details
+        self.stdout.write(format_summary(f'{mode:<6} {key}', result) + details)
+
+    def compare(self, path, parameters, results, tolerance):
+        """
+        Compares the results with the baseline and fails on any regression.
+        More queries than the baseline is always a regression, latency and allocations
+        only past the tolerance.
+        """
+
+        try:
+            with open(path) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            self.stdout.write(f'No baseline at {path}, store one with --save-baseline.')
+            return
+        if baseline['parameters'] != parameters:
+            self.stdout.write(self.style.WARNING('The baseline was made with {}, latencies may not compare.'.format(
+                baseline['parameters'])))
+
+        regressions = []
+        for key, modes in results.items():
+            for mode, result in modes.items():
+                expected = baseline['results'].get(key, {}).get(mode)
+                if expected is None:
+                    continue
+                label = f'{mode} {key}'
+                if set(result['statuses']) != set(expected['statuses']):
+                    regressions.append(f'{label}: status codes {sorted(expected["statuses"])} -> '
+                                       f'{sorted(result["statuses"])}')
+                if result['queries'] is not None and expected['queries'] is not None \
+                        and result['queries'] > expected['queries']:
+                    regressions.append(f'{label}: {expected["queries"]} -> {result["queries"]} queries')
+                for metric in ('p50_ms', 'peak_kib'):
+                    if result[metric] and expected[metric] and result[metric] > expected[metric] * (1 + tolerance):
+                        regressions.append('{}: {} {:.1f} -> {:.1f}'.format(
+                            label, metric, expected[metric], result[metric]))
+
+        if regressions:
+            raise CommandError('Regressions against {}:\n  {}'.format(path, '\n  '.join(regressions)))
+        self.stdout.write(self.style.SUCCESS(f'No regression against {path}'))
@@ -0,0 +1,66 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from aknx_social_network_app.benchmarking import (
+    create_synthetic_users,
+    format_summary,
+    summarize,
+    temporary_database,
+    time_calls,
+)
+from main_app import graph
+from main_app.models import Friendship
+from main_app.synthetic import create_friend_graph
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks mutual friends and friend suggestions on a throwaway database '
+        'holding a synthetic power-law friend graph, and fails when the p99 latency '
+        'exceeds the budget.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100_000)
+        parser.add_argument('--edges', type=int, default=1_000_000,
+                            help='Number of accepted friend requests in the graph.')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Number of users timed per query.')
+        parser.add_argument('--budget-ms', type=float, default=100,
+                            help='Maximum p99 latency allowed for each query.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with temporary_database():
+            start = time.perf_counter()
+            user_ids = create_synthetic_users(options['users'], seed=options['seed'])
+            create_friend_graph(user_ids, options['edges'], seed=options['seed'])
+            self.stdout.write('Created {} users and {} friendships in {:.1f}s'.format(
+                len(user_ids), Friendship.objects.count() // 2, time.perf_counter() - start))
+
+            rng = random.Random(options['seed'])
+            pairs = [tuple(rng.sample(user_ids, 2)) for _ in range(options['samples'])]
+            page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+
+            def suggestions(pair):
+                list(graph.friend_suggestions(pair[0])[:20])
+
+            def mutual_friends(pair):
+                # Same work as a mutual_friends page: a COUNT plus the first page
+                queryset = graph.mutual_friends(*pair)
+                queryset.count()
+                list(queryset.order_by('id')[:page_size])
+
+            over_budget = []
+            for label, func in (('suggestions', suggestions), ('mutual_friends', mutual_friends)):
+                summary = summarize(time_calls(func, pairs))
+                self.stdout.write(format_summary(label, summary))
+                if summary['p99_ms'] > options['budget_ms']:
+                    over_budget.append(label)
+
+        if over_budget:
+            raise CommandError('p99 latency over the {}ms budget for: {}'.format(
+                options['budget_ms'], ', '.join(over_budget)))
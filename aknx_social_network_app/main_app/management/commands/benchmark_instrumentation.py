@@ -0,0 +1,88 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import Client, override_settings
+
+from aknx_social_network_app.benchmarking import (
+    create_synthetic_users,
+    format_summary,
+    summarize,
+    temporary_database,
+)
+from main_app.models import FriendRequest
+from main_app.synthetic import DEFAULT_STATUSES, create_friend_graph
+from users.tokens import issue_access_token
+
+User = get_user_model()
+
+MIDDLEWARE = 'aknx_social_network_app.metrics.InstrumentationMiddleware'
+ENDPOINTS = (
+    '/api/social/get_friend_list/',
+    '/api/social/get_pending_friend_requests/',
+    '/api/social/suggestions/',
+    '/api/users/search_users/?search=an',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the overhead of the instrumentation middleware on the read endpoints, '
+        'on a throwaway database holding a synthetic friend graph, and fails when it '
+        'exceeds the budget.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--edges', type=int, default=20_000,
+                            help='Number of friend requests in the graph.')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Number of requests timed per endpoint, with and without instrumentation.')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='Number of alternations between the two, to even out drift.')
+        parser.add_argument('--budget-percent', type=float, default=3,
+                            help='Maximum increase of the p50 latency allowed.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        store = {'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'}
+        with temporary_database(), override_settings(RATE_LIMIT_STORE=store, METRICS_ENABLED=True):
+            user_ids = create_synthetic_users(options['users'], seed=options['seed'])
+            create_friend_graph(user_ids, options['edges'], statuses=DEFAULT_STATUSES, seed=options['seed'])
+            # The most requested user, whose lists are the largest
+            user = User.objects.get(pk=FriendRequest.objects.values('receiver_id').annotate(
+                requests=Count('id')).order_by('-requests')[0]['receiver_id'])
+            authorization = f'Bearer {issue_access_token(user)}'
+
+            # Clients load the middleware on their first request and keep it
+            bare = [name for name in settings.MIDDLEWARE if name != MIDDLEWARE]
+            clients = {}
+            for label, middleware in (('bare', bare), ('instrumented', [MIDDLEWARE, *bare])):
+                with override_settings(MIDDLEWARE=middleware):
+                    clients[label] = Client(HTTP_AUTHORIZATION=authorization, HTTP_ACCEPT='application/json')
+                    for endpoint in ENDPOINTS:
+                        clients[label].get(endpoint)
+
+            samples = {(label, endpoint): [] for label in clients for endpoint in ENDPOINTS}
+            per_round = max(1, options['requests'] // options['rounds'])
+            for _ in range(options['rounds']):
+                for label, client in clients.items():
+                    for endpoint in ENDPOINTS:
+                        for _ in range(per_round):
+                            start = time.perf_counter()
+                            client.get(endpoint)
+                            samples[label, endpoint].append(time.perf_counter() - start)
+
+        totals = {label: 0 for label in clients}
+        for endpoint in ENDPOINTS:
+            for label in clients:
+                summary = summarize(samples[label, endpoint])
+                totals[label] += summary['p50_ms']
+                self.stdout.write(format_summary(f'{label} {endpoint}', summary))
+
+        overhead = (totals['instrumented'] / totals['bare'] - 1) * 100
+        self.stdout.write('Instrumentation overhead on the p50 latency: {:+.1f}%'.format(overhead))
+        if overhead > options['budget_percent']:
+            raise CommandError('Over the budget of {}%'.format(options['budget_percent']))
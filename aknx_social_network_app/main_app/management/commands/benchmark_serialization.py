@@ -0,0 +1,92 @@
+import random
+import time
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+
+from aknx_social_network_app.benchmarking import FIRST_NAMES, LAST_NAMES
+from aknx_social_network_app.serialization import FastJSONRenderer, orjson
+from main_app.serializers import FriendsSerializer
+from users.serializers import UserSerializer
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures how many rows per second the list serializers and the JSON renderer '
+        'get through, for the standard DRF path and with FAST_SERIALIZATION, on pages '
+        'of 10, 100 and 1000 rows. Rows are built in memory, so the numbers leave out '
+        'the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200_000,
+                            help='Number of rows serialized per configuration and page size.')
+        parser.add_argument('--page-sizes', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write('orjson is not installed, the fast path renders with the standard library')
+        rng = random.Random(options['seed'])
+        for page_size in options['page_sizes']:
+            payloads = [
+                ('friends', FriendsSerializer, self.make_friend_rows(rng, page_size)),
+                ('users', UserSerializer, self.make_users(rng, page_size)),
+            ]
+            for label, serializer_class, rows in payloads:
+                iterations = max(1, options['rows'] // page_size)
+                standard = self.run(serializer_class, rows, JSONRenderer(), iterations)
+                with override_settings(FAST_SERIALIZATION=True):
+                    fast = self.run(serializer_class, rows, FastJSONRenderer(), iterations)
+                if standard[1] != fast[1]:
+                    raise CommandError(f'The fast path rendered {label} differently')
+                self.stdout.write('{:<8} page={:<5} standard={:>10.0f} rows/s fast={:>10.0f} rows/s x{:.1f}'.format(
+                    label, page_size, standard[0], fast[0], fast[0] / standard[0]))
+
+    def make_friend_rows(self, rng, count):
+        """
+        Builds rows shaped like `Friendship.objects.with_friend_profile()`.
+        """
+
+        rows = []
+        for number in range(count):
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            rows.append({
+                'id': number,
+                'created_at': None,
+                'request_id': number + 1,
+                'profile_id': rng.randrange(1_000_000),
+                'email': f'{first_name}.{last_name}{number}@example.com',
+                'first_name': first_name.title(),
+                'last_name': last_name.title(),
+            })
+        return rows
+
+    def make_users(self, rng, count):
+        users = []
+        for number in range(count):
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            users.append(User(
+                id=number + 1, email=f'{first_name}.{last_name}{number}@example.com',
+                first_name=first_name.title(), last_name=last_name.title()))
+        return users
+
+    def run(self, serializer_class, rows, renderer, iterations):
+        """
+        Serializes and renders a page of rows in a pagination envelope, as the list endpoints do.
+
+        Returns:
+            tuple: The rows per second and the rendered page.
+        """
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            data = serializer_class(rows, many=True).data
+            content = renderer.render(OrderedDict([
+                ('count', len(rows)), ('next', None), ('previous', None), ('results', data)]))
+        return len(rows) * iterations / (time.perf_counter() - start), content
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main_app.export import CONTENT_TYPES, export_chunks, export_queryset
+
+
+class Command(BaseCommand):
+    help = (
+        'Exports the friend requests of a user, or the whole table, as NDJSON or CSV. '
+        'Rows are streamed a chunk at a time, so millions of rows export in constant memory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, default=None,
+                            help='Id of the user whose sent and received requests are exported, all by default.')
+        parser.add_argument('--output', choices=sorted(CONTENT_TYPES), default='ndjson')
+        parser.add_argument('--file', default='-', help='Path to write the export to, standard output by default.')
+        parser.add_argument('--chunk-size', type=int, default=settings.SOCIAL_EXPORT_CHUNK_SIZE,
+                            help='Number of rows fetched from the database and encoded at a time.')
+
+    def handle(self, *args, **options):
+        chunks = export_chunks(export_queryset(options['user']), options['output'], options['chunk_size'])
+        if options['file'] == '-':
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
+            return
+
+        written = 0
+        with open(options['file'], 'wb') as export_file:
+            for chunk in chunks:
+                export_file.write(chunk)
+                written += len(chunk)
+        self.stderr.write(f'Wrote {written} bytes to {options["file"]}')
@@ -0,0 +1,61 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from aknx_social_network_app.benchmarking import create_synthetic_users
+from main_app.models import FriendRequest
+from main_app.synthetic import DEFAULT_STATUSES, create_friend_graph
+
+User = get_user_model()
+
+
+def parse_statuses(value):
+    """
+    Parses a status mix given as `accepted=0.6,pending=0.3,rejected=0.1`.
+    """
+
+    statuses = {}
+    for item in value.split(','):
+        name, _, share = item.partition('=')
+        if name not in dict(FriendRequest.REQUEST_STATUS):
+            raise CommandError(f'Unknown friend request status: {name}')
+        try:
+            statuses[name] = float(share)
+        except ValueError:
+            raise CommandError(f'Invalid share for {name}: {share}')
+    return statuses
+
+
+class Command(BaseCommand):
+    help = (
+        'Fills the configured database with synthetic users and a power-law friend request '
+        'graph between them, reproducible from its seed. The new users only get requests '
+        'between themselves, so it can run on a database that already holds data.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000)
+        parser.add_argument('--edges', type=int, default=100_000,
+                            help='Number of friend requests in the graph.')
+        parser.add_argument('--statuses', type=parse_statuses, default=DEFAULT_STATUSES,
+                            help='Share of each status, e.g. accepted=0.6,pending=0.3,rejected=0.1.')
+        parser.add_argument('--alpha', type=float, default=0.8,
+                            help='Exponent of the power law receivers are drawn from.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        last_id = User.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        user_ids = [
+            user_id for user_id in create_synthetic_users(options['users'], seed=options['seed'], start=last_id)
+            if user_id > last_id
+        ]
+        try:
+            created = create_friend_graph(user_ids, options['edges'], statuses=options['statuses'],
+                                          alpha=options['alpha'], seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS('Created {} users and {} friend requests in {:.1f}s'.format(
+            len(user_ids), created, time.perf_counter() - start)))
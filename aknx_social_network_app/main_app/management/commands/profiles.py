@@ -0,0 +1,50 @@
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main_app.profiling import list_profiles
+
+
+class Command(BaseCommand):
+    help = (
+        'Lists the request profiles collected by the sampling profiler, or downloads one '
+        'as collapsed stacks for flamegraph.pl, speedscope or any flame graph viewer.'
+    )
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        list_parser = subparsers.add_parser('list', help='List the stored profiles, newest last.')
+        list_parser.add_argument('--route', default=None, help='Only list the profiles of this route name.')
+        download_parser = subparsers.add_parser('download', help='Write a profile to a file or standard output.')
+        download_parser.add_argument('name', help='The name of the profile, as listed.')
+        download_parser.add_argument('--file', default='-',
+                                     help='Path to write the profile to, standard output by default.')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'list':
+            self.list(options['route'])
+        else:
+            self.download(options['name'], options['file'])
+
+    def list(self, route):
+        profiles = [profile for profile in list_profiles() if route is None or profile['route'] == route]
+        for profile in profiles:
+            with open(profile['path']) as profile_file:
+                samples = sum(int(line.rpartition(' ')[2]) for line in profile_file if line.strip())
+            self.stdout.write('{name}  {method:<6} {route:<40} {duration_ms:>6}ms {samples:>6} samples'.format(
+                samples=samples, **profile))
+        if not profiles:
+            self.stdout.write('No profiles.')
+
+    def download(self, name, path):
+        # Only listed profiles are served, a name cannot point outside the directory
+        profile = next((profile for profile in list_profiles() if profile['name'] == name), None)
+        if profile is None:
+            raise CommandError(f'No profile named {name}.')
+        with open(profile['path']) as profile_file:
+            if path == '-':
+                self.stdout.write(profile_file.read(), ending='')
+                return
+            with open(path, 'w') as output_file:
+                shutil.copyfileobj(profile_file, output_file)
+        self.stderr.write(f'Wrote {name} to {path}')
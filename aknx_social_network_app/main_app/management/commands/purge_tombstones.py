@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main_app.models import FriendRequestTombstone
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the tombstones of friend requests deleted longer ago than the change feed '
+        'keeps them. Meant to run periodically, e.g. daily from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Retention in days, SOCIAL_TOMBSTONE_RETENTION_DAYS by default.')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.SOCIAL_TOMBSTONE_RETENTION_DAYS
+        deleted = FriendRequestTombstone.objects.purge(timezone.now() - timedelta(days=days))
+        self.stdout.write(f'Deleted {deleted} tombstones older than {days} days')
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from main_app import sharding
+from main_app.models import FriendRequest
+
+
+class Command(BaseCommand):
+    help = (
+        'Shows where the buckets of friend requests are stored, or moves them between databases '
+        'while they are served, to spread them evenly over FRIEND_REQUEST_SHARDS or one at a time.'
+    )
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        subparsers.add_parser('status', help='List the buckets and friend requests of each database.')
+        rebalance_parser = subparsers.add_parser(
+            'rebalance', help='Move buckets until every shard holds the same number of them.')
+        rebalance_parser.add_argument('--dry-run', action='store_true', help='Only list the moves.')
+        move_parser = subparsers.add_parser('move', help='Move a bucket to a database.')
+        move_parser.add_argument('bucket', type=int)
+        move_parser.add_argument('alias', help='The database alias, default or one of FRIEND_REQUEST_SHARDS.')
+        for subparser in (rebalance_parser, move_parser):
+            subparser.add_argument('--settle', type=float, default=None,
+                                   help='Seconds waited for every process to see each step, twice '
+                                        'FRIEND_REQUEST_SHARD_MAP_REFRESH by default.')
+            subparser.add_argument('--batch-size', type=int, default=1000,
+                                   help='Number of friend requests copied or deleted at a time.')
+
+    def handle(self, *args, **options):
+        if not sharding.is_sharded():
+            raise CommandError('No friend request shard is configured, see DATABASE_SHARD_URLS.')
+        sharding.shard_map.load()
+        if options['action'] == 'status':
+            self.status()
+            return
+        if options['action'] == 'rebalance':
+            moves = sharding.plan_rebalance()
+        else:
+            if not 0 <= options['bucket'] < settings.FRIEND_REQUEST_SHARD_BUCKETS:
+                raise CommandError(f'Buckets go from 0 to {settings.FRIEND_REQUEST_SHARD_BUCKETS - 1}.')
+            if options['alias'] not in [DEFAULT_DB_ALIAS, *settings.FRIEND_REQUEST_SHARDS]:
+                raise CommandError(f'{options["alias"]} is not the default database nor a shard.')
+            moves = {options['bucket']: options['alias']}
+        for bucket, alias in sorted(moves.items()):
+            self.stdout.write(f'Bucket {bucket}: {sharding.shard_map.read_alias(bucket)} -> {alias}')
+        if not moves:
+            self.stdout.write('Nothing to move.')
+        if not moves or options.get('dry_run'):
+            return
+        copied, deleted = sharding.move_buckets(
+            moves, settle=options['settle'], batch_size=options['batch_size'], log=self.stdout.write)
+        self.stdout.write(f'Moved {len(moves)} buckets, copied {copied} and deleted {deleted} friend requests')
+
+    def status(self):
+        homes = sharding.home_buckets()
+        for alias in [DEFAULT_DB_ALIAS, *settings.FRIEND_REQUEST_SHARDS]:
+            buckets = homes.get(alias, [])
+            moving = [bucket for bucket in buckets if len(sharding.shard_map.write_aliases(bucket)) > 1]
+            self.stdout.write('{:<12} {:>4} buckets {:>10} friend requests{}'.format(
+                alias, len(buckets), FriendRequest.objects.using(alias).count(),
+                f', moving {moving}' if moving else ''))
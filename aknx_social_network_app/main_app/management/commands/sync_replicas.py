@@ -0,0 +1,53 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies the SQLite primary database into the SQLite read replicas, once or every '
+        '--interval seconds. Stands in for replication in development, the replicas lag '
+        'the primary by up to the interval.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Seconds between copies, copies once when not given.')
+
+    def handle(self, *args, **options):
+        aliases = [DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS]
+        if len(aliases) == 1:
+            raise CommandError('No read replica is configured, see DATABASE_REPLICA_URLS.')
+        for alias in aliases:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'The {alias} database is not SQLite, replicate it with the database tools.')
+
+        while True:
+            for alias in settings.DATABASE_REPLICAS:
+                start = time.perf_counter()
+                copy_database(connections[DEFAULT_DB_ALIAS].settings_dict['NAME'], connections[alias].settings_dict['NAME'])
+                self.stdout.write('Copied the primary to {} in {:.0f}ms'.format(
+                    alias, (time.perf_counter() - start) * 1000))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
+
+
+def copy_database(source_path, target_path):
+    """
+    Copies a SQLite database into another with the online backup API, consistent
+    even while the source is being written to.
+    """
+
+    source = sqlite3.connect(str(source_path))
+    try:
+        target = sqlite3.connect(str(target_path))
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
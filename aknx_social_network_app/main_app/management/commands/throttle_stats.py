@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from main_app.throttles import get_throttle_stats
+
+
+class Command(BaseCommand):
+    help = 'Prints the allowed and denied request counters of each rate limit scope.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scopes', nargs='*', help='Scopes to report, all of them by default.')
+
+    def handle(self, *args, **options):
+        for scope, counters in get_throttle_stats(options['scopes']).items():
+            self.stdout.write('{:<24} allowed={:<10} denied={}'.format(
+                scope, counters['allowed'], counters['denied']))
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-16 23:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0004_friend_request_access_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendRequestTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_id', models.BigIntegerField()),
+                ('sender_id', models.IntegerField()),
+                ('receiver_id', models.IntegerField()),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['sender', 'updated_at', 'id'], name='friendrequest_sender_changes'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['receiver', 'updated_at', 'id'], name='friendrequest_receiver_changes'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequesttombstone',
+            index=models.Index(fields=['sender_id', 'deleted_at', 'id'], name='tombstone_sender_changes'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequesttombstone',
+            index=models.Index(fields=['receiver_id', 'deleted_at', 'id'], name='tombstone_receiver_changes'),
+        ),
+    ]
@@ -1,5 +1,501 @@
-from django.db import models
+import itertools
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Mod
+from django.db.models.query import ValuesIterable
 from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from . import sharding
+
+
+class KnownCountQuerySetMixin:
+    """
+    Lets a queryset answer `count()` with a number already known, typically from a cache,
+    so the paginator does not issue a COUNT query. Derived querysets count normally again.
+    The count may be given as a callable, only called if the queryset is actually counted.
+    """
+
+    _known_count = None
+
+    def with_known_count(self, count):
+        clone = self._chain()
+        clone._known_count = count
+        return clone
+
+    def count(self):
+        if self._known_count is None:
+            return super().count()
+        if callable(self._known_count):
+            return self._known_count()
+        return self._known_count
+
+
+def can_upsert_returning(connection):
+    """
+    Returns whether a database runs `INSERT ... ON CONFLICT DO UPDATE` and `RETURNING`.
+    """
+
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+class UserColumnsIterable(ValuesIterable):
+    """
+    Yields the dicts of a values() queryset stored apart from the users, filling in the user
+    columns from the users' database with one query per chunk of rows.
+    """
+
+    def __iter__(self):
+        columns = self.queryset._user_columns
+        fields = {field for _, field in columns.values()}
+        rows = super().__iter__()
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            user_ids = {row[id_key] for row in chunk for id_key, _ in columns.values()}
+            users = {user['id']: user for user in get_user_model().objects.filter(
+                id__in=user_ids).values('id', *fields)}
+            for row in chunk:
+                for key, (id_key, field) in columns.items():
+                    user = users.get(row[id_key])
+                    row[key] = user[field] if user is not None else None
+            yield from chunk
+
+
+class FriendRequestQuerySet(KnownCountQuerySetMixin, models.QuerySet):
+    """
+    Carries the routing hints of the friend requests while they are sharded, see main_app/sharding.py.
+    """
+
+    _user_columns = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._user_columns = self._user_columns
+        return clone
+
+    def filter(self, *args, **kwargs):
+        clone = super().filter(*args, **kwargs)
+        hints = sharding.lookup_hints(kwargs)
+        if hints:
+            # The first hints given win, and the dict is shared with the queryset cloned
+            clone._hints = {**hints, **clone._hints}
+        return clone
+
+    def involving(self, user_id):
+        """
+        Returns the friend requests sent or received by a user, which are stored together.
+        """
+
+        clone = self.filter(Q(sender_id=user_id) | Q(receiver_id=user_id))
+        clone._hints = {'user_id': user_id, **clone._hints}
+        return clone
+
+    def per_shard(self):
+        """
+        Splits a query over the friend requests of every user into one query per database,
+        each reading the home copies stored there, so every friend request is read once.
+
+        Returns:
+            list: The querysets, only this one when not sharded or routed by a user or ids.
+        """
+
+        if not sharding.is_sharded() or self._db is not None or self._hints:
+            return [self]
+        return [
+            self.using(alias).alias(home_bucket=Mod('id', settings.FRIEND_REQUEST_SHARD_BUCKETS)).filter(
+                home_bucket__in=buckets)
+            for alias, buckets in sharding.home_buckets().items()
+        ]
+
+    def update(self, **kwargs):
+        if self._db is not None or not sharding.is_sharded():
+            return super().update(**kwargs)
+        # Applied to every copy of the requests matched
+        rows = list(self.values_list('id', 'sender_id', 'receiver_id'))
+        copies = defaultdict(list)
+        for request_id, sender_id, receiver_id in rows:
+            for alias in sharding.copy_aliases(request_id, sender_id, receiver_id):
+                copies[alias].append(request_id)
+        for alias, request_ids in copies.items():
+            self.model.objects.using(alias).filter(id__in=request_ids).update(**kwargs)
+        return len(rows)
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+        if self._db is not None or not sharding.is_sharded():
+            return super().bulk_create(objs, batch_size=batch_size, ignore_conflicts=ignore_conflicts)
+        # Inserted in the home database of each request, then copied
+        objs = list(objs)
+        homes = defaultdict(list)
+        for obj in objs:
+            if obj.id is None:
+                obj.id = sharding.new_request_id(obj.sender_id)
+            homes[sharding.request_alias(obj.id)].append(obj)
+        inserted = []
+        for alias, home_objs in homes.items():
+            self.using(alias).bulk_create(home_objs, batch_size=batch_size, ignore_conflicts=ignore_conflicts)
+            # Those ignored as conflicts are not copied
+            ids = set(self.using(alias).filter(id__in=[obj.id for obj in home_objs]).values_list('id', flat=True))
+            inserted += [obj for obj in home_objs if obj.id in ids]
+        self.mirror(inserted)
+        return objs
+
+    def mirror(self, friend_requests):
+        """
+        Copies friend requests just written to one database to the other databases storing them.
+        Does nothing when not sharded.
+
+        Args:
+            friend_requests: FriendRequest instances, with the database they were written to in `_state.db`.
+        """
+
+        if not sharding.is_sharded():
+            return
+        copies = defaultdict(list)
+        for friend_request in friend_requests:
+            for alias in sharding.copy_aliases(friend_request.id, friend_request.sender_id, friend_request.receiver_id):
+                if alias != friend_request._state.db:
+                    copies[alias].append(friend_request)
+        for alias, copied in copies.items():
+            self.model.objects.using(alias).store_copies(copied)
+
+    def store_copies(self, friend_requests):
+        """
+        Writes copies of friend requests to the database of the queryset, in batches.
+        The copies it already holds are only replaced by more recently updated ones.
+
+        Args:
+            friend_requests: FriendRequest instances with every column set.
+        """
+
+        connection = connections[self.db]
+        if not can_upsert_returning(connection):
+            return self._store_each(friend_requests)
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        columns = ['id', 'sender_id', 'receiver_id', 'status', 'created_at', 'updated_at']
+        batch_size = connection.ops.bulk_batch_size(columns, friend_requests)
+        for start in range(0, len(friend_requests), batch_size):
+            batch = friend_requests[start:start + batch_size]
+            params = []
+            for friend_request in batch:
+                params += [
+                    friend_request.id, friend_request.sender_id, friend_request.receiver_id, friend_request.status,
+                    connection.ops.adapt_datetimefield_value(friend_request.created_at),
+                    connection.ops.adapt_datetimefield_value(friend_request.updated_at),
+                ]
+            sql = (
+                f'INSERT INTO {table} ({", ".join(quote(column) for column in columns)}) '
+                f'VALUES {", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))} '
+                f'ON CONFLICT ({quote("id")}) DO UPDATE '
+                f'SET {quote("status")} = excluded.{quote("status")}, '
+                f'{quote("updated_at")} = excluded.{quote("updated_at")} '
+                f'WHERE {table}.{quote("updated_at")} < excluded.{quote("updated_at")}'
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+    def _store_each(self, friend_requests):
+        for friend_request in friend_requests:
+            if self.filter(id=friend_request.id, updated_at__gte=friend_request.updated_at).exists():
+                continue
+            # Saved raw, keeping the timestamps of the copy
+            self.model(
+                id=friend_request.id, sender_id=friend_request.sender_id, receiver_id=friend_request.receiver_id,
+                status=friend_request.status, created_at=friend_request.created_at,
+                updated_at=friend_request.updated_at,
+            ).save_base(raw=True, using=self.db)
+
+    def drop_copies(self, request_ids):
+        """
+        Deletes copies of friend requests from the database of the queryset, without the
+        signals of a deletion, as the requests live on in their other databases.
+        """
+
+        request_ids = list(request_ids)
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        batch_size = connection.ops.bulk_batch_size(['id'], request_ids)
+        for start in range(0, len(request_ids), batch_size):
+            batch = request_ids[start:start + batch_size]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {quote(self.model._meta.db_table)} '
+                    f'WHERE {quote("id")} IN ({", ".join(["%s"] * len(batch))})', batch)
+
+    def send(self, sender_id, receiver_ids):
+        """
+        Sends friend requests from a user to existing users in a single statement.
+        A receiver without a request from the sender gets a new pending one, and a rejected
+        request is reopened. Pending and accepted requests are left as they are. Concurrent
+        sends of the same request cannot both succeed, nor fail on the unique constraint.
+        While sharded, the statement runs on the sender's database, and the requests are then
+        copied to the receivers'.
+        
+        Args:
+            sender_id: The id of the user sending the requests.
+            receiver_ids: The ids of the users receiving them, without duplicates.
+        
+        Returns:
+            list: The FriendRequest instances sent, carrying their id, users, status and timestamps.
+        """
+
+        if not receiver_ids:
+            return []
+        if self._db is None and sharding.is_sharded():
+            for attempt in range(3):
+                try:
+                    sent = self.using(sharding.user_alias(sender_id)).send(sender_id, receiver_ids)
+                    break
+                except IntegrityError:
+                    # Another process drew the same id, new ones are drawn
+                    if attempt == 2:
+                        raise
+            self.mirror(sent)
+            return sent
+        self._for_write = True
+        connection = connections[self.db]
+        now = timezone.now()
+        if not can_upsert_returning(connection):
+            return self._send_each(sender_id, receiver_ids, now)
+
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        status = quote('status')
+        updated_at = quote('updated_at')
+        timestamp = connection.ops.adapt_datetimefield_value(now)
+        columns = ['sender_id', 'receiver_id', 'status', 'created_at', 'updated_at']
+        rows = [[sender_id, receiver_id, 'pending', timestamp, timestamp] for receiver_id in receiver_ids]
+        if sharding.is_sharded():
+            # The ids name the sender's bucket
+            columns.insert(0, 'id')
+            for row in rows:
+                row.insert(0, sharding.new_request_id(sender_id))
+        values = ', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * len(rows))
+        sql = (
+            f'INSERT INTO {table} ({", ".join(quote(column) for column in columns)}) VALUES {values} '
+            f'ON CONFLICT ({quote("sender_id")}, {quote("receiver_id")}) DO UPDATE '
+            f'SET {status} = excluded.{status}, {updated_at} = excluded.{updated_at} '
+            f'WHERE {table}.{status} = %s '
+            f'RETURNING {quote("id")}, {quote("receiver_id")}, {quote("created_at")}'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*itertools.chain.from_iterable(rows), 'rejected'])
+            rows = cursor.fetchall()
+        return [self._loaded(id=pk, sender_id=sender_id, receiver_id=receiver_id, status='pending',
+                             created_at=self._to_datetime(connection, created_at), updated_at=now)
+                for pk, receiver_id, created_at in rows]
+
+    def _send_each(self, sender_id, receiver_ids, now):
+        # One insert per receiver, then a conditional reopen if the pair already exists
+        sent = []
+        for receiver_id in receiver_ids:
+            try:
+                with transaction.atomic(using=self.db):
+                    sent.append(self.create(sender_id=sender_id, receiver_id=receiver_id))
+                continue
+            except IntegrityError:
+                pass
+            reopened = self.filter(sender_id=sender_id, receiver_id=receiver_id, status='rejected')
+            if reopened.update(status='pending', updated_at=now):
+                pk, created_at = self.filter(
+                    sender_id=sender_id, receiver_id=receiver_id).values_list('id', 'created_at').get()
+                sent.append(self._loaded(id=pk, sender_id=sender_id, receiver_id=receiver_id, status='pending',
+                                         created_at=created_at, updated_at=now))
+        return sent
+
+    def transition(self, request_ids, status, receiver_id=None):
+        """
+        Moves pending friend requests to a new status in a single conditional UPDATE.
+        A request is only ever processed once, whatever the number of concurrent calls.
+        While sharded, each request is updated in its home database, then copied.
+        
+        Args:
+            request_ids: The ids of the friend requests.
+            status: 'accepted' or 'rejected'.
+            receiver_id: Only transition the requests received by this user, if given.
+        
+        Returns:
+            list: The FriendRequest instances transitioned, carrying their id, users, status
+            and timestamps. Requests that were not found or not pending are left out.
+        """
+
+        if not request_ids:
+            return []
+        if self._db is None and sharding.is_sharded():
+            homes = defaultdict(list)
+            for request_id in request_ids:
+                homes[sharding.request_alias(request_id)].append(request_id)
+            transitioned = []
+            for alias, home_ids in homes.items():
+                transitioned += self.using(alias).transition(home_ids, status, receiver_id)
+            self.mirror(transitioned)
+            return transitioned
+        self._for_write = True
+        connection = connections[self.db]
+        now = timezone.now()
+        pending = self.filter(id__in=request_ids, status='pending')
+        if receiver_id is not None:
+            pending = pending.filter(receiver_id=receiver_id)
+        if not can_upsert_returning(connection):
+            return self._transition_each(pending, request_ids, status, now)
+
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        where = ' AND '.join(
+            [f'{quote("status")} = %s', f'{quote("id")} IN ({", ".join(["%s"] * len(request_ids))})'] +
+            ([f'{quote("receiver_id")} = %s'] if receiver_id is not None else []))
+        sql = (
+            f'UPDATE {table} SET {quote("status")} = %s, {quote("updated_at")} = %s WHERE {where} '
+            f'RETURNING {quote("id")}, {quote("sender_id")}, {quote("receiver_id")}, {quote("created_at")}'
+        )
+        params = [status, connection.ops.adapt_datetimefield_value(now), 'pending', *request_ids]
+        if receiver_id is not None:
+            params.append(receiver_id)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        return [self._loaded(id=pk, sender_id=sender, receiver_id=receiver, status=status,
+                             created_at=self._to_datetime(connection, created_at), updated_at=now)
+                for pk, sender, receiver, created_at in rows]
+
+    def _transition_each(self, pending, request_ids, status, now):
+        transitioned = []
+        for request_id in request_ids:
+            if pending.filter(id=request_id).update(status=status, updated_at=now):
+                sender_id, receiver_id, created_at = self.filter(id=request_id).values_list(
+                    'sender_id', 'receiver_id', 'created_at').get()
+                transitioned.append(self._loaded(id=request_id, sender_id=sender_id, receiver_id=receiver_id,
+                                                 status=status, created_at=created_at, updated_at=now))
+        return transitioned
+
+    def _loaded(self, **fields):
+        # Behave like an instance loaded from the database
+        instance = self.model(**fields)
+        instance._state.adding = False
+        instance._state.db = self.db
+        return instance
+
+    def _to_datetime(self, connection, value):
+        # Raw rows hold what the driver returns, a string with SQLite
+        field = self.model._meta.get_field('created_at')
+        for converter in connection.ops.get_db_converters(field.get_col(self.model._meta.db_table)):
+            value = converter(value, field, connection)
+        return value
+
+    def values_with_users(self, *fields, users, **expressions):
+        """
+        Projects each friend request onto a dict like `values()`, along with user columns.
+        The users are joined in the same query, or read from the default database in a second 
+        query per chunk of rows while the friend requests are sharded.
+        
+        Args:
+            users: The user columns to add, each as a lookup through `sender` or `receiver`,
+                e.g. `{'email': 'sender__email'}`. The id of that user must be among the columns.
+        
+        Returns:
+            QuerySet: Dicts with the fields, the expressions and the user columns, in that order.
+        """
+
+        if not sharding.is_sharded():
+            return self.values(*fields, **expressions, **{key: F(lookup) for key, lookup in users.items()})
+        clone = self.values(*fields, **expressions)
+        clone._iterable_class = UserColumnsIterable
+        clone._user_columns = {}
+        for key, lookup in users.items():
+            relation, field = lookup.split('__')
+            id_key = f'{relation}_id'
+            if id_key not in fields:
+                id_key = next(name for name, expression in expressions.items()
+                              if getattr(expression, 'name', None) == f'{relation}_id')
+            clone._user_columns[key] = (id_key, field)
+        return clone
+
+    def with_sender_profile(self):
+        """
+        Projects each friend request onto the sender columns rendered by FriendsSerializer.
+        The sender is joined in the same query, see `values_with_users()`, and rows are returned 
+        as dicts, so listing requests costs a single query without instantiating any model.
+        
+        Returns:
+            QuerySet: Dicts with the request `id` (also as `request_id`) and `created_at`, 
+            and the sender's `profile_id`, `email`, `first_name` and `last_name`.
+        """
+
+        return self.values_with_users(
+            'id',
+            'created_at',
+            request_id=F('id'),
+            profile_id=F('sender_id'),
+            users={
+                'email': 'sender__email',
+                'first_name': 'sender__first_name',
+                'last_name': 'sender__last_name',
+            },
+        )
+
+    def with_counterpart_profile(self, counterpart):
+        """
+        Projects each friend request onto its own columns and those of the user on the other side.
+        
+        Args:
+            counterpart: 'sender' or 'receiver', the side of the user to join.
+        
+        Returns:
+            QuerySet: Dicts with the request columns, and the counterpart's `profile_id`, 
+            `email`, `first_name` and `last_name`.
+        """
+
+        return self.values_with_users(
+            'id',
+            'sender_id',
+            'receiver_id',
+            'status',
+            'created_at',
+            'updated_at',
+            profile_id=F(f'{counterpart}_id'),
+            users={
+                'email': f'{counterpart}__email',
+                'first_name': f'{counterpart}__first_name',
+                'last_name': f'{counterpart}__last_name',
+            },
+        )
+
+    def for_export(self):
+        """
+        Projects each friend request onto the columns of an export, in id order.
+        Both users' emails are joined, see `values_with_users()`.
+        
+        Returns:
+            QuerySet: Dicts with the request columns and the `sender_email` and `receiver_email`.
+        """
+
+        return self.values_with_users(
+            'id',
+            'sender_id',
+            'receiver_id',
+            'status',
+            'created_at',
+            'updated_at',
+            users={
+                'sender_email': 'sender__email',
+                'receiver_email': 'receiver__email',
+            },
+        ).order_by('id')
+
 
 class FriendRequest(models.Model):
     """
@@ -19,6 +515,9 @@ class FriendRequest(models.Model):
         
     Meta:
         unique_together: Ensures that a sender cannot send multiple requests to the same receiver.
+        indexes: A partial index on the pending requests of a receiver, newest first, a 
+            composite index on `(receiver, status)` for the other per-receiver lookups and counts, 
+            and the requests of each side in `(updated_at, id)` order for the change feed.
     """
 
     REQUEST_STATUS = (
@@ -26,20 +525,284 @@ class FriendRequest(models.Model):
         ('accepted', 'Accepted'), 
         ('rejected', 'Rejected')
     )
+    # Not enforced by the database, the shards hold no users. Deleting a user still
+    # deletes its friend requests, in Django.
     sender = models.ForeignKey(
         get_user_model(),
         null=False,
         related_name='sent_requests', 
-        on_delete=models.CASCADE)
+        on_delete=models.CASCADE,
+        # Covered by the leading column of the (sender, receiver) unique index
+        db_index=False,
+        db_constraint=False)
     receiver = models.ForeignKey(
         get_user_model(), 
         null=False,
         blank=False,
         related_name='received_requests', 
-        on_delete=models.CASCADE)
+        on_delete=models.CASCADE,
+        # Covered by the leading column of the (receiver, status) index
+        db_index=False,
+        db_constraint=False)
     status = models.CharField(max_length=10, choices=REQUEST_STATUS, default='pending')
     created_at = models.DateTimeField(auto_now_add=True,)
     updated_at = models.DateTimeField(auto_now=True,)
 
+    objects = FriendRequestQuerySet.as_manager()
+
     class Meta:
         unique_together = ('sender', 'receiver')
+        indexes = [
+            models.Index(
+                fields=['receiver', '-created_at', '-id'],
+                condition=Q(status='pending'),
+                name='friendrequest_pending_inbox'),
+            models.Index(fields=['receiver', 'status'], name='friendrequest_receiver_status'),
+            models.Index(fields=['sender', 'updated_at', 'id'], name='friendrequest_sender_changes'),
+            models.Index(fields=['receiver', 'updated_at', 'id'], name='friendrequest_receiver_changes'),
+            # The list of the requests a user sent or received, merged from both in order
+            models.Index(fields=['sender', '-created_at', '-id'], name='friendrequest_sender_recent'),
+            models.Index(fields=['receiver', '-created_at', '-id'], name='friendrequest_receiver_recent'),
+        ]
+
+    def save(self, *args, using=None, **kwargs):
+        """
+        Saves the friend request. While sharded, a new request gets an id in the sender's
+        bucket, and the request is saved to its home database then copied to the others
+        storing it, unless a database is given.
+        """
+
+        if self.id is None and sharding.is_sharded():
+            self.id = sharding.new_request_id(self.sender_id)
+        if using is not None or not sharding.is_sharded():
+            return super().save(*args, using=using, **kwargs)
+        super().save(*args, using=sharding.request_alias(self.id), **kwargs)
+        type(self).objects.mirror([self])
+
+
+class ShardAssignment(models.Model):
+    """
+    Assigns a bucket of users to the database storing their friend requests, see main_app/sharding.py.
+    Buckets without an assignment are stored in the default database.
+    
+    Attributes:
+        bucket (PositiveIntegerField): The bucket, below `FRIEND_REQUEST_SHARD_BUCKETS`.
+        alias (CharField): The database the bucket is read from and written to.
+        also_write (CharField): Another database the bucket is written to while it moves, if not blank.
+    """
+
+    bucket = models.PositiveIntegerField(primary_key=True)
+    alias = models.CharField(max_length=100)
+    also_write = models.CharField(max_length=100, blank=True)
+
+    def __str__(self):
+        return f'{self.bucket} -> {self.alias}'
+
+
+class FriendRequestTombstoneQuerySet(models.QuerySet):
+
+    def purge(self, before):
+        """
+        Deletes the tombstones of friend requests deleted before the given time.
+
+        Returns:
+            int: The number of tombstones deleted.
+        """
+
+        return self.filter(deleted_at__lt=before).delete()[0]
+
+
+class FriendRequestTombstone(models.Model):
+    """
+    Records a deleted friend request, so the change feed can tell clients to drop it.
+    The users are kept as plain ids, as the request is usually deleted along with one of them.
+    
+    Attributes:
+        request_id (BigIntegerField): The id of the deleted friend request.
+        sender_id (IntegerField): The id of the user who had sent it.
+        receiver_id (IntegerField): The id of the user who had received it.
+        deleted_at (DateTimeField): The timestamp when the friend request was deleted.
+        
+    Meta:
+        indexes: The tombstones of each side in `(deleted_at, id)` order for the change feed.
+    """
+
+    request_id = models.BigIntegerField()
+    sender_id = models.IntegerField()
+    receiver_id = models.IntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    objects = FriendRequestTombstoneQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender_id', 'deleted_at', 'id'], name='tombstone_sender_changes'),
+            models.Index(fields=['receiver_id', 'deleted_at', 'id'], name='tombstone_receiver_changes'),
+        ]
+
+
+
+class FriendshipQuerySet(KnownCountQuerySetMixin, models.QuerySet):
+
+    def with_friend_profile(self):
+        """
+        Projects each friendship onto the friend columns rendered by FriendsSerializer.
+        The friend is joined in the same query and rows are returned as dicts.
+        
+        Returns:
+            QuerySet: Dicts with the friendship `id` and `created_at`, the accepted 
+            `request_id`, and the friend's `profile_id`, `email`, `first_name` and `last_name`.
+        """
+
+        return self.values(
+            'id',
+            'created_at',
+            request_id=F('friend_request_id'),
+            profile_id=F('friend_id'),
+            email=F('friend__email'),
+            first_name=F('friend__first_name'),
+            last_name=F('friend__last_name'),
+        )
+
+    def link(self, friend_requests):
+        """
+        Creates both directions of the friendship for each accepted friend request.
+        Rows that already exist are left untouched, so linking is idempotent.
+
+        Args:
+            friend_requests: Accepted FriendRequest instances.
+        """
+
+        now = timezone.now()
+        rows = []
+        for friend_request in friend_requests:
+            created_at = friend_request.updated_at or now
+            rows.append(self.model(
+                user_id=friend_request.receiver_id, friend_id=friend_request.sender_id,
+                friend_request_id=friend_request.id, created_at=created_at))
+            rows.append(self.model(
+                user_id=friend_request.sender_id, friend_id=friend_request.receiver_id,
+                friend_request_id=friend_request.id, created_at=created_at))
+        return self.bulk_create(rows, ignore_conflicts=True)
+
+    def link_accepted(self, batch_size=2000):
+        """
+        Links every accepted friend request, walking FriendRequest by primary key in batches,
+        one database after the other while sharded.
+        Each batch is linked in its own transaction, so the walk can be interrupted and rerun.
+
+        Yields:
+            int: The number of friend requests linked by each batch.
+        """
+
+        accepted = FriendRequest.objects.filter(status='accepted').only(
+            'id', 'sender_id', 'receiver_id', 'updated_at').order_by('id')
+        for shard in accepted.per_shard():
+            last_id = 0
+            while True:
+                batch = list(shard.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                with transaction.atomic():
+                    self.link(batch)
+                last_id = batch[-1].id
+                yield len(batch)
+
+
+class Friendship(models.Model):
+    """
+    Symmetric adjacency list of the friend graph, denormalized from accepted friend requests.
+    Every accepted FriendRequest is stored twice, once from each user's side, so 
+    "who are my friends" is a single range scan on `(user, friend)` in both directions 
+    instead of an OR over the sender and receiver columns of FriendRequest.
+    
+    Attributes:
+        user (ForeignKey): The user owning this side of the friendship.
+        friend (ForeignKey): The friend of `user`.
+        friend_request (ForeignKey): The accepted friend request the friendship comes from.
+        created_at (DateTimeField): The timestamp when the friend request was accepted.
+        
+    Meta:
+        constraints: The composite unique index on `(user, friend)`.
+        indexes: The friends of a user, most recent first, serving friend-list reads.
+    """
+
+    user = models.ForeignKey(
+        get_user_model(),
+        related_name='friendships',
+        on_delete=models.CASCADE,
+        # Covered by the leading column of the (user, friend) index
+        db_index=False)
+    friend = models.ForeignKey(
+        get_user_model(),
+        related_name='+',
+        on_delete=models.CASCADE)
+    # The friend request may be stored in a shard, the friendships of a deleted
+    # request are deleted by main_app/signals.py
+    friend_request = models.ForeignKey(
+        FriendRequest,
+        related_name='friendships',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = FriendshipQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'friend'], name='friendship_user_friend_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='friendship_user_recent'),
+        ]
+
+
+class ProfilingRuleQuerySet(models.QuerySet):
+
+    def active(self):
+        now = timezone.now()
+        return self.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=now), enabled=True)
+
+
+class ProfilingRule(models.Model):
+    """
+    Selects requests to run under the sampling profiler (main_app/profiling.py).
+    A request is profiled when it matches every condition a rule sets, and then only
+    for `sample_percent` of such requests. Rules are edited in the admin and picked
+    up by every process within `PROFILING_RULES_REFRESH` seconds.
+    
+    Attributes:
+        name (CharField): What the rule is for, shown in the admin.
+        path_pattern (CharField): A regular expression searched in the request path, any path if blank.
+        user (ForeignKey): The only user whose requests are profiled, any user if null.
+        sample_percent (FloatField): The percentage of the matching requests profiled.
+        enabled (BooleanField): Whether the rule applies.
+        expires_at (DateTimeField): When the rule stops applying, never if null.
+        created_at (DateTimeField): The timestamp when the rule was created.
+    """
+
+    name = models.CharField(max_length=100)
+    path_pattern = models.CharField(max_length=200, blank=True)
+    user = models.ForeignKey(
+        get_user_model(),
+        null=True,
+        blank=True,
+        related_name='+',
+        on_delete=models.CASCADE)
+    sample_percent = models.FloatField(
+        default=1,
+        validators=[MinValueValidator(0), MaxValueValidator(100)])
+    enabled = models.BooleanField(default=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = ProfilingRuleQuerySet.as_manager()
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        try:
+            re.compile(self.path_pattern)
+        except re.error as e:
+            raise ValidationError({'path_pattern': f'Invalid regular expression: {e}'})
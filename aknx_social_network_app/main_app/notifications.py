@@ -0,0 +1,308 @@
+"""
+Friend request notifications pushed to connected clients.
+
+The write paths publish an event to the user it concerns once their transaction
+commits: `friend_request.received` to the receiver of a new request, and
+`friend_request.accepted` or `friend_request.rejected` to its sender. Connected
+clients get the event over the stream served by `main_app.sse`.
+
+The broker is configured by the `NOTIFICATIONS_BROKER` setting, which names the
+`BACKEND` class and its `OPTIONS`. `LocalBroker` fans events out to the
+subscribers of the current process only. `RedisBroker` carries them across
+processes. Either way, the last events of each user are kept in a bounded
+buffer so a client that reconnects with the id of the last event it saw gets
+the ones it missed. A subscriber that falls too far behind is dropped rather
+than slowing publishers down; it reconnects and resumes from the buffer.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque, namedtuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+EVENT_RECEIVED = 'friend_request.received'
+EVENT_ACCEPTED = 'friend_request.accepted'
+EVENT_REJECTED = 'friend_request.rejected'
+
+logger = logging.getLogger(__name__)
+
+Event = namedtuple('Event', ['id', 'type', 'data'])
+
+
+class SubscriptionOverflow(Exception):
+    """
+    Raised to a subscriber that fell more than `queue_size` events behind.
+    """
+
+
+class Subscription:
+    """
+    The events of one user delivered to one consumer running on an asyncio loop.
+    Publishers may push from any thread, the events are handed over to the loop.
+    """
+
+    def __init__(self, broker, user_id, max_pending, loop):
+        self.broker = broker
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self.loop = loop
+        self.overflowed = False
+        self._pending = deque()
+        self._ready = asyncio.Event()
+
+    def push(self, event):
+        self.loop.call_soon_threadsafe(self._deliver, event)
+
+    def _deliver(self, event):
+        if len(self._pending) >= self.max_pending:
+            # Drop the rest, the consumer resumes from the broker's buffer
+            self.overflowed = True
+        elif not self.overflowed:
+            self._pending.append(event)
+        self._ready.set()
+
+    async def get(self):
+        """
+        Waits for the next event.
+
+        Raises:
+            SubscriptionOverflow: Once the pending events are consumed, if some were dropped.
+        """
+
+        while not self._pending:
+            if self.overflowed:
+                raise SubscriptionOverflow()
+            self._ready.clear()
+            await self._ready.wait()
+        return self._pending.popleft()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """
+    Broker fanning events out to the subscribers of the current process.
+    Event ids are increasing per user and based on the clock, so they keep
+    increasing across restarts.
+
+    Args:
+        buffer_size: The number of events kept per user for clients resuming a stream.
+        queue_size: The number of events a subscriber may fall behind before it is dropped.
+        max_users: The number of users whose events are buffered, the least recently
+            notified users' buffers are dropped past it.
+    """
+
+    def __init__(self, buffer_size=100, queue_size=100, max_users=10000):
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()
+        self._evicted = {}
+        self._subscribers = defaultdict(set)
+        # Events published before this point are unknown to this broker
+        self._started = time.time_ns() // 1000
+
+    def parse_id(self, event_id):
+        """
+        Returns a sortable key of an event id, None if it is not one of this broker's ids.
+        """
+
+        try:
+            return int(event_id)
+        except (TypeError, ValueError):
+            return None
+
+    def publish(self, user_id, event_type, data):
+        with self._lock:
+            buffer = self._buffers.setdefault(user_id, deque())
+            self._buffers.move_to_end(user_id)
+            last_id = int(buffer[-1].id) if buffer else 0
+            event = Event(str(max(last_id + 1, time.time_ns() // 1000)), event_type, data)
+            buffer.append(event)
+            if len(buffer) > self.buffer_size:
+                self._evicted[user_id] = int(buffer.popleft().id)
+            if len(self._buffers) > self.max_users:
+                dropped_user, dropped = self._buffers.popitem(last=False)
+                self._evicted.pop(dropped_user, None)
+                # Streams resuming from before the dropped events can no longer be checked
+                self._started = max(self._started, int(dropped[-1].id))
+            subscribers = list(self._subscribers.get(user_id, ()))
+        self.fan_out(subscribers, event)
+        return event
+
+    def fan_out(self, subscribers, event):
+        for subscription in subscribers:
+            subscription.push(event)
+
+    def subscribe(self, user_id):
+        """
+        Subscribes the running asyncio loop to the events of a user published from now on.
+        """
+
+        subscription = Subscription(self, user_id, self.queue_size, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def missed_events(self, user_id, last_event_id):
+        """
+        Returns the events of a user published after the one a resuming client saw last.
+        Called after `subscribe`, so events published in between may be returned by both.
+
+        Returns:
+            list: The events in order, or None if some of them are no longer buffered,
+                in which case the client has to reload its state.
+        """
+
+        last_key = self.parse_id(last_event_id)
+        with self._lock:
+            if last_key is None or last_key < max(self._evicted.get(user_id, 0), self._started):
+                return None
+            return [event for event in self._buffers.get(user_id, ()) if int(event.id) > last_key]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+
+class RedisBroker(LocalBroker):
+    """
+    Broker carrying events across processes through Redis.
+    Each user's events are appended to a Redis stream capped at `buffer_size`, which
+    also provides their ids and the events missed by resuming clients. Every event is
+    announced on a pub/sub channel, and a listener thread in each process fans it out
+    to the subscribers of that process.
+
+    Args:
+        url: The Redis connection URL.
+        key_prefix: The prefix of the streams and of the channel.
+    """
+
+    def __init__(self, url, key_prefix='notifications', buffer_size=100, queue_size=100):
+        super().__init__(buffer_size, queue_size, max_users=0)
+        # Imported lazily so the redis client is only required when this broker is configured
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self.key_prefix = key_prefix
+        self.channel = f'{key_prefix}:events'
+        self._listener = None
+
+    def stream_key(self, user_id):
+        return f'{self.key_prefix}:stream:{user_id}'
+
+    def parse_id(self, event_id):
+        try:
+            milliseconds, sequence = str(event_id).split('-')
+            return int(milliseconds), int(sequence)
+        except (TypeError, ValueError):
+            return None
+
+    def publish(self, user_id, event_type, data):
+        payload = json.dumps(data)
+        event_id = self._client.xadd(
+            self.stream_key(user_id), {'type': event_type, 'data': payload},
+            maxlen=self.buffer_size, approximate=True).decode()
+        self._client.publish(self.channel, json.dumps({
+            'user_id': user_id, 'id': event_id, 'type': event_type, 'data': data}))
+        return Event(event_id, event_type, data)
+
+    def subscribe(self, user_id):
+        self.start_listener()
+        return super().subscribe(user_id)
+
+    def missed_events(self, user_id, last_event_id):
+        last_key = self.parse_id(last_event_id)
+        if last_key is None:
+            return None
+        key = self.stream_key(user_id)
+        oldest = self._client.xrange(key, count=1)
+        if oldest and self.parse_id(oldest[0][0].decode()) > last_key \
+                and self._client.xlen(key) >= self.buffer_size:
+            # The stream was trimmed past the client's last event
+            return None
+        return [
+            Event(entry_id.decode(), fields[b'type'].decode(), json.loads(fields[b'data']))
+            for entry_id, fields in self._client.xrange(key, min=f'({last_event_id}')
+        ]
+
+    def start_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self.listen, name='notifications', daemon=True)
+                self._listener.start()
+
+    def listen(self):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            event = json.loads(message['data'])
+            with self._lock:
+                subscribers = list(self._subscribers.get(event['user_id'], ()))
+            self.fan_out(subscribers, Event(event['id'], event['type'], event['data']))
+
+
+_broker = None
+
+
+def get_broker():
+    """
+    Returns the broker configured by the `NOTIFICATIONS_BROKER` setting.
+    """
+
+    global _broker
+    if _broker is None:
+        config = settings.NOTIFICATIONS_BROKER
+        _broker = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _broker
+
+
+@receiver(setting_changed)
+def reset_broker(setting, **kwargs):
+    global _broker
+    if setting == 'NOTIFICATIONS_BROKER':
+        _broker = None
+
+
+def notify(user_id, event_type, data):
+    """
+    Publishes an event to a user once the current transaction commits.
+    Notifications are best effort, a broker failure does not fail the request.
+    """
+
+    def publish():
+        try:
+            get_broker().publish(user_id, event_type, data)
+        except Exception:
+            logger.exception('Could not publish %s to user %s', event_type, user_id)
+
+    transaction.on_commit(publish)
+
+
+def notify_request_sent(friend_request, sender):
+    notify(friend_request.receiver_id, EVENT_RECEIVED, {
+        'request_id': friend_request.id,
+        'user': {'id': sender.id, 'email': sender.email},
+    })
+
+
+def notify_request_processed(friend_request, receiver):
+    event_type = EVENT_ACCEPTED if friend_request.status == 'accepted' else EVENT_REJECTED
+    notify(friend_request.sender_id, event_type, {
+        'request_id': friend_request.id,
+        'user': {'id': receiver.id, 'email': receiver.email},
+    })
@@ -0,0 +1,331 @@
+"""
+Sampling profiler for the requests selected by ProfilingRule rows.
+
+Admins add rules in the admin to profile the requests of a path pattern, of a
+user, or a percentage of the traffic, and every process picks them up within
+`PROFILING_RULES_REFRESH` seconds. Rules are reloaded on a short-lived
+background thread, so requests never wait on the rules query.
+
+While a selected request runs, a single sampler thread per process reads its
+stack every `PROFILING_INTERVAL_MS` milliseconds with `sys._current_frames()`.
+The request thread itself runs untouched, unlike with a tracing profiler. The
+samples are folded into collapsed stacks, one `frame;frame;frame count` line
+per distinct stack, and written to `PROFILING_DIR` when the request ends. That
+is the input format of flamegraph.pl, speedscope and most flame graph viewers.
+
+Overhead and storage are capped:
+- at most `PROFILING_MAX_CONCURRENT` requests are profiled at once, and others are served unprofiled,
+- a profile stops sampling after `PROFILING_MAX_SAMPLES` samples,
+- the oldest profiles are deleted beyond `PROFILING_MAX_FILES` files or `PROFILING_MAX_BYTES` bytes.
+
+Only WSGI deployments are profiled. Under ASGI the views run on threads the
+middleware cannot tell apart, so the middleware is left out of the chain.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections
+from django.utils import timezone
+
+from users.tokens import read_access_token
+
+from .models import ProfilingRule
+
+logger = logging.getLogger(__name__)
+
+PROFILE_NAME = re.compile(
+    r'^(?P<time>\d{8}T\d{6})-(?P<method>[A-Z]+)-(?P<route>[\w.-]+)-(?P<duration_ms>\d+)ms-[0-9a-f]{8}\.collapsed$')
+
+ActiveRule = namedtuple('ActiveRule', ['name', 'pattern', 'user_id', 'sample_percent', 'expires_at'])
+
+
+class RuleCache:
+    """
+    The active profiling rules of this process, reloaded in the background once stale.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.stale_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self):
+        """
+        Loads the active rules on the calling thread.
+        """
+
+        rules = []
+        for rule in ProfilingRule.objects.active():
+            try:
+                pattern = re.compile(rule.path_pattern)
+            except re.error:
+                logger.warning('Skipping profiling rule %r: invalid path pattern %r', rule.name, rule.path_pattern)
+                continue
+            rules.append(ActiveRule(rule.name, pattern, rule.user_id, rule.sample_percent, rule.expires_at))
+        self.rules = rules
+        self.stale_at = time.monotonic() + settings.PROFILING_RULES_REFRESH
+
+    def refresh(self):
+        try:
+            self.load()
+        except DatabaseError:
+            logger.exception('Could not load the profiling rules')
+            self.stale_at = time.monotonic() + settings.PROFILING_RULES_REFRESH
+        finally:
+            self._refreshing = False
+            connections.close_all()
+
+    def get(self):
+        if time.monotonic() >= self.stale_at:
+            with self._lock:
+                if not self._refreshing and time.monotonic() >= self.stale_at:
+                    self._refreshing = True
+                    threading.Thread(target=self.refresh, name='profiling-rules', daemon=True).start()
+        return self.rules
+
+    def match(self, request):
+        """
+        Returns the first rule selecting the request, None if it is not to be profiled.
+        """
+
+        rules = self.get()
+        if not rules:
+            return None
+        now = timezone.now()
+        user_id = None
+        for rule in rules:
+            if rule.expires_at is not None and rule.expires_at <= now:
+                continue
+            if not rule.pattern.search(request.path):
+                continue
+            if rule.user_id is not None:
+                user_id = user_id or request_user_id(request)
+                if rule.user_id != user_id:
+                    continue
+            if random.random() * 100 < rule.sample_percent:
+                return rule
+        return None
+
+
+rules = RuleCache()
+
+
+def request_user_id(request):
+    """
+    Returns the id of the user of a session or an access token, without querying the database.
+    """
+
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.pk
+    auth = request.headers.get('Authorization', '').split()
+    if len(auth) == 2 and auth[0].lower() == 'bearer':
+        try:
+            return read_access_token(auth[1])['uid']
+        except signing.BadSignature:
+            return None
+    return None
+
+
+_labels = {}
+_path_prefixes = sorted({os.path.join(path, '') for path in sys.path if path}, key=len, reverse=True)
+
+
+def frame_label(code):
+    """
+    Returns `function (module/path.py:line)` for a code object, with paths relative to sys.path.
+    """
+
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        for prefix in _path_prefixes:
+            if filename.startswith(prefix):
+                filename = filename[len(prefix):]
+                break
+        label = _labels[code] = f'{code.co_name} ({filename}:{code.co_firstlineno})'
+    return label
+
+
+class Profile:
+    """
+    Stack samples of one request, folded into collapsed stacks.
+    """
+
+    def __init__(self, max_samples):
+        self.stacks = Counter()
+        self.samples = 0
+        self.max_samples = max_samples
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def add(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame.f_code))
+            frame = frame.f_back
+        with self._lock:
+            # The sampler may still hold a profile its request just closed
+            if self.closed or self.samples >= self.max_samples:
+                return
+            self.stacks[';'.join(reversed(labels))] += 1
+            self.samples += 1
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Sampler:
+    """
+    A thread sampling the stacks of the threads serving profiled requests, running while there are any.
+    """
+
+    def __init__(self):
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, thread_id, profile):
+        with self._lock:
+            self._profiles[thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='profiling-sampler', daemon=True)
+                self._thread.start()
+
+    def remove(self, thread_id):
+        with self._lock:
+            self._profiles.pop(thread_id, None)
+
+    def run(self):
+        interval = settings.PROFILING_INTERVAL_MS / 1000
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                profiles = list(self._profiles.items())
+            frames = sys._current_frames()
+            for thread_id, profile in profiles:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.add(frame)
+            del frames
+            time.sleep(interval)
+
+
+sampler = Sampler()
+
+
+def save_profile(profile, method, route, duration):
+    """
+    Writes a profile to PROFILING_DIR and deletes the oldest profiles beyond the storage caps.
+
+    Returns:
+        Path: The file written.
+    """
+
+    directory = Path(settings.PROFILING_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = '{}-{}-{}-{}ms-{}.collapsed'.format(
+        timezone.now().strftime('%Y%m%dT%H%M%S'), method, re.sub(r'[^\w.-]', '_', route),
+        round(duration * 1000), uuid.uuid4().hex[:8])
+    path = directory / name
+    path.write_text(profile.collapsed())
+    prune_profiles(directory)
+    return path
+
+
+def prune_profiles(directory):
+    profiles = sorted(list_profiles(directory), key=lambda profile: profile['name'], reverse=True)
+    total = 0
+    for index, profile in enumerate(profiles):
+        total += profile['size']
+        if index >= settings.PROFILING_MAX_FILES or total > settings.PROFILING_MAX_BYTES:
+            try:
+                os.remove(profile['path'])
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory=None):
+    """
+    Returns the profiles stored in a directory, PROFILING_DIR by default, oldest first.
+
+    Returns:
+        list: A dict per profile with its `name`, `path`, `size`, and the `time`, `method`,
+            `route` and `duration_ms` of the request.
+    """
+
+    directory = Path(directory or settings.PROFILING_DIR)
+    if not directory.is_dir():
+        return []
+    profiles = []
+    for path in sorted(directory.iterdir()):
+        match = PROFILE_NAME.match(path.name)
+        if match is None:
+            continue
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            continue
+        profiles.append({'name': path.name, 'path': path, 'size': size, **match.groupdict()})
+    return profiles
+
+
+class ProfilingMiddleware:
+    """
+    Middleware running the requests selected by the profiling rules under the sampler.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED or asyncio.iscoroutinefunction(get_response):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slots = threading.BoundedSemaphore(settings.PROFILING_MAX_CONCURRENT)
+
+    def __call__(self, request):
+        if rules.match(request) is None or not self.slots.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            profile = Profile(settings.PROFILING_MAX_SAMPLES)
+            thread_id = threading.get_ident()
+            start = time.perf_counter()
+            sampler.add(thread_id, profile)
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.remove(thread_id)
+                profile.close()
+            duration = time.perf_counter() - start
+        finally:
+            self.slots.release()
+
+        if profile.samples:
+            match = request.resolver_match
+            route = (match.url_name or match.view_name) if match else 'unmatched'
+            try:
+                save_profile(profile, request.method, route, duration)
+            except OSError:
+                logger.exception('Could not save the profile of %s %s', request.method, request.path)
+        return response
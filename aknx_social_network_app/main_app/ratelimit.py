@@ -0,0 +1,206 @@
+"""
+Shared counter stores backing the rate limit throttles.
+
+Every worker process must see the same counters for a rate limit to hold, so
+the counters live in a store shared by all processes and are only ever changed
+with atomic increments. The store is configured by the `RATE_LIMIT_STORE`
+setting, a dict with the dotted path of the `BACKEND` class and its `OPTIONS`.
+"""
+
+import random
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+class BaseCounterBackend:
+    """
+    Interface of a counter store. Counters that were never incremented, or whose
+    time to live elapsed, read as zero.
+    """
+
+    def incr(self, key, amount=1, ttl=None):
+        """
+        Atomically adds `amount` to a counter and returns its new value.
+
+        Args:
+            key: The name of the counter.
+            amount: The value to add, may be negative.
+            ttl: Seconds the counter lives after its creation, forever if None.
+        """
+
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """
+        Returns a dict with the current value of each counter.
+        """
+
+        raise NotImplementedError
+
+    def get(self, key):
+        return self.get_many([key])[key]
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocMemCounterBackend(BaseCounterBackend):
+    """
+    Counters held in process memory. Only suitable for tests and single process
+    deployments as every process gets its own counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def _value(self, key, now):
+        value, expires_at = self._counters.get(key, (0, None))
+        if expires_at is not None and expires_at <= now:
+            return 0, None
+        return value, expires_at
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._lock:
+            value, expires_at = self._value(key, now)
+            if value == 0 and expires_at is None and ttl is not None:
+                expires_at = now + ttl
+            self._counters[key] = (value + amount, expires_at)
+            return value + amount
+
+    def get_many(self, keys):
+        now = time.time()
+        with self._lock:
+            return {key: self._value(key, now)[0] for key in keys}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+
+class SQLiteCounterBackend(BaseCounterBackend):
+    """
+    Counters stored in a SQLite file shared by every process on the host.
+    Increments are single UPSERT statements inside an immediate transaction,
+    so concurrent processes never lose an update. Expired rows are purged lazily.
+    """
+
+    # Probability for an increment to also purge the expired counters
+    purge_probability = 0.001
+
+    def __init__(self, path, timeout=5.0):
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS counters ('
+                'key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL)')
+            self._local.connection = connection
+        return connection
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT INTO counters (key, value, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                'value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END, '
+                'expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END',
+                (key, amount, expires_at, now, now))
+            value, = connection.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+            if random.random() < self.purge_probability:
+                connection.execute('DELETE FROM counters WHERE expires_at <= ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = dict.fromkeys(keys, 0)
+        if keys:
+            placeholders = ', '.join('?' * len(keys))
+            rows = self.connection.execute(
+                f'SELECT key, value FROM counters WHERE key IN ({placeholders}) '
+                'AND (expires_at IS NULL OR expires_at > ?)', (*keys, time.time()))
+            values.update(rows)
+        return values
+
+    def clear(self):
+        self.connection.execute('DELETE FROM counters')
+
+
+class RedisCounterBackend(BaseCounterBackend):
+    """
+    Counters stored in Redis, or any server speaking its protocol.
+    Requires the `redis` package.
+    """
+
+    def __init__(self, url, key_prefix='ratelimit:'):
+        # Imported lazily so the dependency is only needed when configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.key_prefix = key_prefix
+
+    def incr(self, key, amount=1, ttl=None):
+        key = self.key_prefix + key
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.incrby(key, amount)
+        if ttl is not None:
+            # NX keeps the expiry set by the first increment (Redis >= 7)
+            pipeline.expire(key, int(ttl) + 1, nx=True)
+        return pipeline.execute()[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.key_prefix + key for key in keys])
+        return {key: int(value or 0) for key, value in zip(keys, values)}
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.key_prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+_backend = None
+
+
+def get_counter_backend():
+    """
+    Returns the counter store configured by the `RATE_LIMIT_STORE` setting.
+    """
+
+    global _backend
+    if _backend is None:
+        config = settings.RATE_LIMIT_STORE
+        _backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_counter_backend(setting, **kwargs):
+    global _backend
+    if setting == 'RATE_LIMIT_STORE':
+        _backend = None
@@ -3,8 +3,11 @@ from django.contrib.auth import get_user_model
 from rest_framework.validators import UniqueValidator
 from django.core.validators import validate_email
 from django.contrib.auth.hashers import make_password
-from django.core.exceptions import ValidationError
-from .models import FriendRequest
+from django.db import transaction
+from aknx_social_network_app.serialization import FastListSerializer
+from .models import FriendRequest, Friendship
+from . import cache as social_cache
+from . import notifications
 
 User = get_user_model()
 
@@ -44,56 +47,230 @@ class SocialRequestSerializer(serializers.Serializer):
         # Check if user sending request to himself
         if sender == receiver:
             raise serializers.ValidationError({"message": "You cannot send a friend request to yourself."})
-        
-        # Check if a connection already exists between these users
-        existing_request = FriendRequest.objects.filter(
-            sender=sender,
-            receiver=receiver,
-        ).exclude(status='rejected').exists()
-
-        if existing_request:
-            raise ValidationError({"message": "A friend request already exists, or you are already friends."})
 
         return data
     
     def create(self, validated_data):
-        # Set the sender as the currently authenticated user
-        validated_data['sender'] = self.context['request'].user
+        sender = self.context['request'].user
+
+        # A single upsert, it fails when a request already exists however many sends race
+        sent = FriendRequest.objects.send(sender.id, [validated_data['receiver'].id])
+        if not sent:
+            raise serializers.ValidationError({"message": "A friend request already exists, or you are already friends."})
+        friend_request, = sent
+        social_cache.invalidate(friend_request.receiver_id)
+        notifications.notify_request_sent(friend_request, sender)
+        return friend_request
+    
+class BulkSocialRequestSerializer(serializers.Serializer):
+    """
+    Serializer for sending friend requests to many users at once.
+    The receivers are looked up with one query, and the requests are sent with a single 
+    upsert that skips those already pending or accepted, so concurrent batches cannot race.
+    Invalid receivers do not fail the batch, they are reported in the per-item results.
+    
+    Args:
+        receivers: The ids of the users receiving a friend request.
+    
+    Returns:
+        list: One result per distinct receiver, with its `receiver` id, a `status` of 
+        'sent' or 'error', and a `message`.
+    """
+
+    MAX_RECEIVERS = 500
+
+    receivers = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_RECEIVERS,
+    )
+
+    def validate_receivers(self, receivers):
+        # Drop duplicates, keeping the order the client sent
+        return list(dict.fromkeys(receivers))
+
+    def create(self, validated_data):
+        sender = self.context['request'].user
+        receiver_ids = validated_data['receivers']
+
+        existing_users = set(User.objects.filter(id__in=receiver_ids).values_list('id', flat=True))
+        with transaction.atomic():
+            sent = {
+                friend_request.receiver_id: friend_request
+                for friend_request in FriendRequest.objects.send(sender.id, [
+                    receiver_id for receiver_id in receiver_ids
+                    if receiver_id != sender.id and receiver_id in existing_users
+                ])
+            }
+            social_cache.invalidate(*sent)
+            for receiver_id in receiver_ids:
+                if receiver_id in sent:
+                    notifications.notify_request_sent(sent[receiver_id], sender)
+
+        results = []
+        for receiver_id in receiver_ids:
+            if receiver_id in sent:
+                results.append({"receiver": receiver_id, "status": "sent", "message": "Request Sent Successfully!"})
+                continue
+            if receiver_id == sender.id:
+                message = "You cannot send a friend request to yourself."
+            elif receiver_id not in existing_users:
+                message = "You can not send request to this user as it does not exist."
+            else:
+                message = "A friend request already exists, or you are already friends."
+            results.append({"receiver": receiver_id, "status": "error", "message": message})
+        return results
+
 
-        return FriendRequest.objects.create(**validated_data)
+class RequestStatusItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField(min_value=1)
+    status = serializers.ChoiceField(
+        choices=['accepted', 'rejected'],
+        error_messages={'invalid_choice': "Invalid status. Only 'accepted' or 'rejected' are allowed."}
+    )
+
+
+class BulkRequestStatusSerializer(serializers.Serializer):
+    """
+    Serializer for accepting or rejecting many received friend requests at once.
+    The pending requests are moved with one conditional UPDATE per status, together with 
+    the friendships of the accepted ones, in one transaction. A request processed 
+    concurrently by another call is reported as already processed.
+    
+    Args:
+        requests: A list of `{"id": ..., "status": "accepted" | "rejected"}` items.
     
-class FriendsSerializer(serializers.ModelSerializer):
+    Returns:
+        list: One result per distinct request id, with its `id`, a `status` of 
+        'accepted', 'rejected' or 'error', and a `message`.
+    """
+
+    MAX_REQUESTS = 500
+
+    requests = RequestStatusItemSerializer(many=True, allow_empty=False, max_length=MAX_REQUESTS)
+
+    def validate_requests(self, items):
+        # Keep the first status given for a request id
+        unique = {}
+        for item in items:
+            unique.setdefault(item['id'], item)
+        return list(unique.values())
+
+    def create(self, validated_data):
+        receiver = self.context['request'].user
+        items = validated_data['requests']
+
+        by_status = {}
+        for item in items:
+            by_status.setdefault(item['status'], []).append(item['id'])
+
+        with transaction.atomic():
+            processed = {}
+            for status_value, request_ids in by_status.items():
+                for friend_request in FriendRequest.objects.transition(request_ids, status_value, receiver.id):
+                    processed[friend_request.id] = friend_request
+            # Only failed items need telling apart, requests not found and already processed
+            failed = [item['id'] for item in items if item['id'] not in processed]
+            found = set(FriendRequest.objects.filter(
+                receiver=receiver, id__in=failed).values_list('id', flat=True)) if failed else set()
+
+            Friendship.objects.link([
+                friend_request for friend_request in processed.values() if friend_request.status == 'accepted'
+            ])
+            if processed:
+                social_cache.invalidate(receiver.id, *[
+                    friend_request.sender_id for friend_request in processed.values()
+                ])
+            for item in items:
+                if item['id'] in processed:
+                    notifications.notify_request_processed(processed[item['id']], receiver)
+
+        results = []
+        for item in items:
+            if item['id'] in processed:
+                results.append({"id": item['id'], "status": item['status'],
+                                "message": f"Friend request {item['status']}."})
+            elif item['id'] in found:
+                results.append({"id": item['id'], "status": "error",
+                                "message": "This request has already been processed."})
+            else:
+                results.append({"id": item['id'], "status": "error", "message": "Friend request not found."})
+        return results
+
+
+class FriendsSerializer(serializers.Serializer):
     """
-    Serializer for friend request objects, providing user details.
-    This serializer transforms friend request instances into a format that includes the receiver's email, first name, and last name. 
-    It utilizes custom methods to extract these fields from the related user model.
+    Serializer for friend request rows, providing the other user's details.
+    This serializer renders the dicts produced by `FriendRequest.objects.with_sender_profile()` 
+    and `Friendship.objects.with_friend_profile()`, which already carry the user's id, email, 
+    first name and last name from a single joined query.
     Attributes:
-        email (str): The email address of the receiver.
-        first_name (str): The first name of the receiver.
-        last_name (str): The last name of the receiver.
-    Meta:
-        model: The model associated with this serializer (FriendRequest).
-        fields: The fields to be included in the serialized output.
+        id (int): The id of the friend request.
+        user_id (int): The id of the sender, or of the friend.
+        email (str): The email address of the user.
+        first_name (str): The first name of the user.
+        last_name (str): The last name of the user.
     """
 
-    email = serializers.SerializerMethodField()
-    first_name = serializers.SerializerMethodField()
-    last_name = serializers.SerializerMethodField()
-    user_id = serializers.SerializerMethodField()
+    id = serializers.IntegerField(source='request_id', read_only=True)
+    user_id = serializers.IntegerField(source='profile_id', read_only=True)
+    email = serializers.EmailField(read_only=True)
+    first_name = serializers.CharField(read_only=True)
+    last_name = serializers.CharField(read_only=True)
 
     class Meta:
-        model = FriendRequest
-        fields = ['id', 'user_id', 'email', 'first_name', 'last_name']
+        list_serializer_class = FastListSerializer
 
-    def get_email(self, obj):
-        return obj.sender.email 
 
-    def get_first_name(self, obj):
-        return obj.sender.first_name
+class FriendSuggestionSerializer(serializers.Serializer):
+    """
+    Serializer for "people you may know" rows produced by `graph.friend_suggestions`.
+    Attributes:
+        id (int): The id of the suggested user.
+        email (str): The email address of the suggested user.
+        first_name (str): The first name of the suggested user.
+        last_name (str): The last name of the suggested user.
+        mutual_friends (int): The number of friends the suggested user has in common with the requester.
+    """
+
+    id = serializers.IntegerField(read_only=True)
+    email = serializers.EmailField(read_only=True)
+    first_name = serializers.CharField(read_only=True)
+    last_name = serializers.CharField(read_only=True)
+    mutual_friends = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        list_serializer_class = FastListSerializer
 
-    def get_last_name(self, obj):
-        return obj.sender.last_name
+
+class ProfileSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    email = serializers.EmailField()
+    first_name = serializers.CharField()
+    last_name = serializers.CharField()
+
+
+class FriendRequestChangeSerializer(serializers.Serializer):
+    """
+    Serializer for one change of the friend request change feed.
+    A deleted friend request is a tombstone, with no status and no user.
     
-    def get_user_id(self, obj):
-        return obj.sender.id
+    Args:
+        id: The id of the friend request.
+        sender: The id of the user who sent the friend request.
+        receiver: The id of the user who received the friend request.
+        status: The status of the friend request, null if it was deleted.
+        created_at: The timestamp when the friend request was created.
+        updated_at: The timestamp of the change.
+        deleted: Whether the friend request was deleted.
+        user: The profile of the user on the other side of the friend request.
+    """
 
+    id = serializers.IntegerField()
+    sender = serializers.IntegerField()
+    receiver = serializers.IntegerField()
+    status = serializers.CharField(allow_null=True)
+    created_at = serializers.DateTimeField(allow_null=True)
+    updated_at = serializers.DateTimeField()
+    deleted = serializers.BooleanField()
+    user = ProfileSerializer(allow_null=True)
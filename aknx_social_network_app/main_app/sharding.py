@@ -0,0 +1,403 @@
+"""
+Hash sharding of the friend requests over several databases.
+
+Users are hashed into `FRIEND_REQUEST_SHARD_BUCKETS` buckets, and each bucket
+is stored in the database a ShardAssignment row gives it. Buckets without one
+stay in the default database, so turning sharding on moves nothing until
+`python manage.py shards rebalance` spreads them over `FRIEND_REQUEST_SHARDS`.
+
+A friend request is stored in the bucket of its sender and in the bucket of its
+receiver, so all the requests of a user, sent and received, are in the user's
+database and per-user queries read a single database. Its id names a bucket
+too, the sender's for the requests sent while sharded, and the database of that
+bucket holds its home copy, found from the id alone. A request from before has
+a third copy when its id falls in another bucket.
+
+`FriendRequestQuerySet` carries the routing hints: filtering on the sender, the
+receiver or the ids picks the database, see `lookup_hints()`, and the writes of
+`send()`, `transition()`, `save()` and `bulk_create()` go to the home database
+and are then copied to the others. Queries over every friend request raise
+ShardingError, except through `per_shard()`.
+
+The shards hold no users, which has a cost:
+- the foreign keys to the users are not enforced by the databases, and deleting
+  a user deletes its friend requests in Django, see main_app/signals.py,
+- the user columns of the projections are read from the default database in a
+  second query, a chunk of rows at a time,
+- the copies are written by separate statements on separate databases. A failure
+  in between leaves a stale copy until the request is written again, the most
+  recently updated copy wins.
+
+A bucket moves to another database while it is being served, see `move_buckets()`.
+"""
+
+import itertools
+import logging
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Ids are ((milliseconds since EPOCH_MS << SEQUENCE_BITS) | sequence) * buckets + bucket.
+# With 64 buckets they fit in 53 bits until 2057, exact as numbers in JavaScript clients.
+EPOCH_MS = 1_672_531_200_000
+SEQUENCE_BITS = 7
+# Starts anywhere, so processes allocating in the same millisecond rarely draw the same sequence
+_sequence = itertools.count(random.randrange(1 << SEQUENCE_BITS))
+
+
+class ShardingError(Exception):
+    """
+    Raised for a friend request query that cannot be routed to a single database.
+    """
+
+
+def is_sharded():
+    return bool(settings.FRIEND_REQUEST_SHARDS)
+
+
+def user_bucket(user_id):
+    return zlib.crc32(str(user_id).encode()) % settings.FRIEND_REQUEST_SHARD_BUCKETS
+
+
+def id_bucket(request_id):
+    return request_id % settings.FRIEND_REQUEST_SHARD_BUCKETS
+
+
+def new_request_id(sender_id):
+    """
+    Returns a new friend request id in the bucket of the sender, roughly in creation order.
+    The same id drawn by two processes fails on the primary key of the sender's database.
+    """
+
+    milliseconds = int(time.time() * 1000) - EPOCH_MS
+    sequence = next(_sequence) % (1 << SEQUENCE_BITS)
+    return ((milliseconds << SEQUENCE_BITS) | sequence) * settings.FRIEND_REQUEST_SHARD_BUCKETS + user_bucket(sender_id)
+
+
+class ShardMap:
+    """
+    The database of every bucket in this process, reloaded in the background once stale.
+    """
+
+    def __init__(self):
+        self.assignments = None
+        self.stale_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self):
+        """
+        Loads the assignments on the calling thread, from the default database.
+        """
+
+        ShardAssignment = apps.get_model('main_app', 'ShardAssignment')
+        self.assignments = {
+            bucket: (alias, also_write) for bucket, alias, also_write in
+            ShardAssignment.objects.using(DEFAULT_DB_ALIAS).values_list('bucket', 'alias', 'also_write')
+        }
+        self.stale_at = time.monotonic() + settings.FRIEND_REQUEST_SHARD_MAP_REFRESH
+
+    def refresh(self):
+        try:
+            self.load()
+        except DatabaseError:
+            logger.exception('Could not load the shard map')
+            self.stale_at = time.monotonic() + settings.FRIEND_REQUEST_SHARD_MAP_REFRESH
+        finally:
+            self._refreshing = False
+            connections.close_all()
+
+    def get(self):
+        if self.assignments is None:
+            # Nothing can be routed without it, the first load is waited for
+            with self._lock:
+                if self.assignments is None:
+                    self.load()
+        elif time.monotonic() >= self.stale_at:
+            with self._lock:
+                if not self._refreshing and time.monotonic() >= self.stale_at:
+                    self._refreshing = True
+                    threading.Thread(target=self.refresh, name='shard-map', daemon=True).start()
+        return self.assignments
+
+    def read_alias(self, bucket):
+        alias, _ = self.get().get(bucket, (DEFAULT_DB_ALIAS, ''))
+        return alias
+
+    def write_aliases(self, bucket):
+        alias, also_write = self.get().get(bucket, (DEFAULT_DB_ALIAS, ''))
+        return [alias, also_write] if also_write else [alias]
+
+
+shard_map = ShardMap()
+
+
+def user_alias(user_id):
+    """
+    Returns the database holding the friend requests sent and received by a user.
+    """
+
+    return shard_map.read_alias(user_bucket(user_id))
+
+
+def request_alias(request_id):
+    """
+    Returns the database holding the home copy of a friend request.
+    """
+
+    return shard_map.read_alias(id_bucket(request_id))
+
+
+def request_buckets(request_id, sender_id, receiver_id):
+    return {id_bucket(request_id), user_bucket(sender_id), user_bucket(receiver_id)}
+
+
+def copy_aliases(request_id, sender_id, receiver_id):
+    """
+    Returns every database a friend request is written to, its home database first.
+    """
+
+    aliases = []
+    for bucket in (id_bucket(request_id), user_bucket(sender_id), user_bucket(receiver_id)):
+        aliases += [alias for alias in shard_map.write_aliases(bucket) if alias not in aliases]
+    return aliases
+
+
+def home_buckets():
+    """
+    Returns the buckets whose home copies each database holds, by alias.
+    """
+
+    homes = defaultdict(list)
+    for bucket in range(settings.FRIEND_REQUEST_SHARD_BUCKETS):
+        homes[shard_map.read_alias(bucket)].append(bucket)
+    return dict(homes)
+
+
+def lookup_hints(lookups):
+    """
+    Returns the routing hints of the keyword lookups of a friend request filter,
+    a `user_id` for a sender or receiver, and `request_ids` for ids.
+    """
+
+    hints = {}
+    for name in ('sender', 'sender_id', 'receiver', 'receiver_id'):
+        if name in lookups:
+            value = getattr(lookups[name], 'pk', lookups[name])
+            try:
+                hints.setdefault('user_id', int(value))
+            except (TypeError, ValueError):
+                pass
+    for name in ('pk', 'id'):
+        if name in lookups:
+            try:
+                hints.setdefault('request_ids', [int(lookups[name])])
+            except (TypeError, ValueError):
+                pass
+    for name in ('pk__in', 'id__in'):
+        if isinstance(lookups.get(name), (list, tuple, set, frozenset)):
+            try:
+                hints.setdefault('request_ids', [int(value) for value in lookups[name]])
+            except (TypeError, ValueError):
+                pass
+    return hints
+
+
+class FriendRequestShardRouter:
+    """
+    Routes the friend request queries to the database of the user or the requests they filter on.
+    Other models, and the friend requests while not sharded, are left to the next router.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.label != 'main_app.FriendRequest' or not is_sharded():
+            return None
+        user_id = hints.get('user_id')
+        if user_id is not None:
+            return user_alias(user_id)
+        request_ids = hints.get('request_ids')
+        if request_ids:
+            aliases = {request_alias(request_id) for request_id in request_ids}
+            if len(aliases) > 1:
+                raise ShardingError(f'The friend requests {request_ids} are stored in {len(aliases)} databases.')
+            return aliases.pop()
+        instance = hints.get('instance')
+        if isinstance(instance, model):
+            if instance._state.db is not None:
+                return instance._state.db
+            if instance.id is not None:
+                return request_alias(instance.id)
+            return user_alias(instance.sender_id)
+        if instance is not None and instance._meta.label == settings.AUTH_USER_MODEL:
+            # The related managers of a user
+            return user_alias(instance.pk)
+        raise ShardingError(
+            'The friend requests are sharded, filter them by sender, receiver or id, or read them per_shard().')
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in settings.FRIEND_REQUEST_SHARDS:
+            return None
+        if app_label in ('auth', 'contenttypes'):
+            # Left empty, the first migrations of the friend requests create foreign keys to the users
+            return True
+        return app_label == 'main_app' and model_name == 'friendrequest'
+
+
+def plan_rebalance():
+    """
+    Returns the moves spreading the buckets evenly over `FRIEND_REQUEST_SHARDS`, as few as possible.
+
+    Returns:
+        dict: The new database of each bucket to move, by bucket.
+    """
+
+    shards = settings.FRIEND_REQUEST_SHARDS
+    buckets = settings.FRIEND_REQUEST_SHARD_BUCKETS
+    quota = {alias: buckets // len(shards) + (index < buckets % len(shards)) for index, alias in enumerate(shards)}
+    owned = {alias: [] for alias in shards}
+    movable = []
+    for bucket in range(buckets):
+        alias = shard_map.read_alias(bucket)
+        (owned[alias] if alias in owned else movable).append(bucket)
+    for alias in shards:
+        movable += owned[alias][quota[alias]:]
+        del owned[alias][quota[alias]:]
+    moves = {}
+    for alias in shards:
+        while len(owned[alias]) < quota[alias]:
+            bucket = movable.pop()
+            moves[bucket] = alias
+            owned[alias].append(bucket)
+    return moves
+
+
+def move_buckets(moves, settle=None, batch_size=1000, log=lambda message: None):
+    """
+    Moves buckets to other databases while they keep being read and written.
+
+    Each bucket goes through four phases, every one given `settle` seconds for all
+    the processes to reload the shard map:
+    1. it is written to both databases and read from the old one, while its friend
+       requests are copied to the new one,
+    2. it is read from the new database, still written to both, so the processes
+       still reading the old one see every write,
+    3. it is only written to the new database,
+    4. the copies the old database no longer needs are deleted.
+
+    Args:
+        moves: The new database of each bucket to move, by bucket.
+        settle: Seconds waited after each change of the map, twice `FRIEND_REQUEST_SHARD_MAP_REFRESH` by default.
+        batch_size: The number of friend requests copied or deleted at a time.
+        log: Called with a line describing each step.
+
+    Returns:
+        tuple: The number of friend requests copied and deleted.
+    """
+
+    sources = {bucket: shard_map.read_alias(bucket) for bucket in moves}
+    moves = {bucket: alias for bucket, alias in moves.items() if sources[bucket] != alias}
+    if not moves:
+        return 0, 0
+    if settle is None:
+        settle = settings.FRIEND_REQUEST_SHARD_MAP_REFRESH * 2
+
+    def assign(phase, description):
+        ShardAssignment = apps.get_model('main_app', 'ShardAssignment')
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            for bucket, (alias, also_write) in phase.items():
+                ShardAssignment.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+                    bucket=bucket, defaults={'alias': alias, 'also_write': also_write})
+        shard_map.load()
+        log(f'{description}, waiting {settle:g}s for every process to see it')
+        time.sleep(settle)
+
+    assign({bucket: (sources[bucket], alias) for bucket, alias in moves.items()},
+           f'Writing {len(moves)} buckets to their new databases')
+    copied = copy_buckets(moves, sources, batch_size)
+    log(f'Copied {copied} friend requests')
+    assign({bucket: (alias, sources[bucket]) for bucket, alias in moves.items()},
+           'Reading the buckets from their new databases')
+    assign({bucket: (alias, '') for bucket, alias in moves.items()},
+           'Writing the buckets to their new databases only')
+    deleted = drop_moved(set(sources.values()), set(moves), batch_size)
+    log(f'Deleted {deleted} friend requests left behind')
+    return copied, deleted
+
+
+def scan(alias, batch_size):
+    """
+    Yields the friend requests of a database in batches, in id order.
+    """
+
+    FriendRequest = apps.get_model('main_app', 'FriendRequest')
+    rows = FriendRequest.objects.using(alias).only(
+        'id', 'sender_id', 'receiver_id', 'status', 'created_at', 'updated_at').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(rows.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield batch
+
+
+def copy_buckets(moves, sources, batch_size):
+    """
+    Copies the friend requests of moving buckets to their new databases, then deletes from
+    them the copies deleted from the old databases meanwhile, which nothing else would.
+    """
+
+    FriendRequest = apps.get_model('main_app', 'FriendRequest')
+    copied = 0
+    for source in set(sources.values()):
+        for batch in scan(source, batch_size):
+            copies = defaultdict(dict)
+            for friend_request in batch:
+                for bucket in request_buckets(friend_request.id, friend_request.sender_id, friend_request.receiver_id):
+                    if sources.get(bucket) == source and bucket in moves:
+                        copies[moves[bucket]][friend_request.id] = friend_request
+            for target, friend_requests in copies.items():
+                FriendRequest.objects.using(target).store_copies(list(friend_requests.values()))
+                copied += len(friend_requests)
+
+    for target in set(moves.values()):
+        for batch in scan(target, batch_size):
+            expected = defaultdict(set)
+            for friend_request in batch:
+                for bucket in request_buckets(friend_request.id, friend_request.sender_id, friend_request.receiver_id):
+                    if moves.get(bucket) == target:
+                        expected[sources[bucket]].add(friend_request.id)
+            for source, request_ids in expected.items():
+                kept = set(FriendRequest.objects.using(source).filter(id__in=request_ids).values_list('id', flat=True))
+                FriendRequest.objects.using(target).drop_copies(request_ids - kept)
+    return copied
+
+
+def drop_moved(aliases, buckets, batch_size):
+    """
+    Deletes from the given databases the copies of friend requests in moved buckets
+    that none of their buckets is written to any more.
+    """
+
+    FriendRequest = apps.get_model('main_app', 'FriendRequest')
+    deleted = 0
+    for alias in aliases:
+        for batch in scan(alias, batch_size):
+            unneeded = [
+                friend_request.id for friend_request in batch
+                if request_buckets(friend_request.id, friend_request.sender_id, friend_request.receiver_id) & buckets
+                and alias not in copy_aliases(friend_request.id, friend_request.sender_id, friend_request.receiver_id)
+            ]
+            FriendRequest.objects.using(alias).drop_copies(unneeded)
+            deleted += len(unneeded)
+    return deleted
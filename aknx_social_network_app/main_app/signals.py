@@ -0,0 +1,76 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import cache as social_cache
+from . import sharding
+from .models import FriendRequest, FriendRequestTombstone, Friendship
+
+
+@receiver(post_delete, sender=FriendRequest)
+def record_tombstone(sender, instance, **kwargs):
+    """
+    Leaves a tombstone for every deleted friend request, including those deleted along with a user.
+    """
+
+    FriendRequestTombstone.objects.create(
+        request_id=instance.id, sender_id=instance.sender_id, receiver_id=instance.receiver_id)
+
+
+@receiver(post_delete, sender=FriendRequest)
+def delete_friendships(sender, instance, **kwargs):
+    """
+    Deletes the friendships of a deleted friend request, which may be stored in another database.
+    """
+
+    Friendship.objects.filter(friend_request_id=instance.id).delete()
+
+
+@receiver(post_delete, sender=FriendRequest)
+def delete_copies(sender, instance, using, **kwargs):
+    """
+    Deletes the other copies of a friend request deleted from one of the databases storing it.
+    """
+
+    if not sharding.is_sharded():
+        return
+    for alias in sharding.copy_aliases(instance.id, instance.sender_id, instance.receiver_id):
+        if alias != using:
+            FriendRequest.objects.using(alias).drop_copies([instance.id])
+
+
+@receiver(post_delete, sender=FriendRequest)
+def invalidate_request_users(sender, instance, **kwargs):
+    """
+    Drops the cached friend lists, counts and versions of both users of a deleted friend request.
+    """
+
+    social_cache.invalidate(instance.sender_id, instance.receiver_id)
+
+
+@receiver(pre_delete, sender=get_user_model())
+def collect_friends(sender, instance, **kwargs):
+    """
+    Remembers the friends of a user about to be deleted, before the cascade drops their friendships.
+    """
+
+    instance._friend_ids = list(Friendship.objects.filter(user_id=instance.id).values_list('friend_id', flat=True))
+
+
+@receiver(post_delete, sender=get_user_model())
+def invalidate_user_and_friends(sender, instance, **kwargs):
+    """
+    Drops the cached entries of a deleted user and of the friends who lost them.
+    """
+
+    social_cache.invalidate(instance.id, *getattr(instance, '_friend_ids', []))
+
+
+@receiver(post_delete, sender=get_user_model())
+def delete_sharded_requests(sender, instance, **kwargs):
+    """
+    Deletes the friend requests of a deleted user stored in a shard, out of reach of the cascade.
+    """
+
+    if sharding.is_sharded():
+        FriendRequest.objects.involving(instance.id).delete()
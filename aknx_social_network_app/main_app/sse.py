@@ -0,0 +1,156 @@
+"""
+Server-Sent Events stream of the authenticated user's notifications.
+
+`NotificationStream` is an ASGI application wrapping the Django one in asgi.py.
+It serves `STREAM_PATH` itself, as a long-lived response that would otherwise
+hold a thread of the synchronous Django stack, and passes every other request
+through. Clients replace polling `get_pending_friend_requests` with:
+
+    GET /api/notifications/stream/?access_token=<token>
+    Accept: text/event-stream
+
+The token may also be sent as an `Authorization: Bearer` header; browsers'
+EventSource cannot set headers, hence the query parameter. On reconnection,
+EventSource sends the `Last-Event-ID` header and the stream resumes after that
+event. When the missed events are no longer buffered, a `reset` event tells the
+client to reload its state.
+"""
+
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+
+from users.tokens import is_revoked, read_access_token
+
+from .notifications import SubscriptionOverflow, get_broker
+
+STREAM_PATH = '/api/notifications/stream/'
+
+
+def format_event(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+class NotificationStream:
+    """
+    ASGI application streaming notifications as Server-Sent Events.
+
+    Args:
+        application: The ASGI application serving every other request.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != STREAM_PATH:
+            return await self.application(scope, receive, send)
+        if scope['method'] != 'GET':
+            return await self.respond(send, 405, {'detail': 'Method not allowed.'})
+
+        headers = {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope['headers']}
+        query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        # The revocation check may hit the shared counter store, keep it off the event loop
+        user_id = await sync_to_async(self.authenticate, thread_sensitive=False)(headers, query)
+        if user_id is None:
+            return await self.respond(send, 401, {'detail': 'Missing or invalid access token.'},
+                                      [(b'www-authenticate', b'Bearer realm="api"')])
+
+        last_event_id = headers.get('last-event-id') or query.get('last_event_id', [None])[0]
+        await self.stream(user_id, last_event_id, receive, send)
+
+    def authenticate(self, headers, query):
+        """
+        Returns the id of the user the access token belongs to, None if it is missing or invalid.
+        """
+
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer':
+            token = query.get('access_token', [''])[0]
+        if not token:
+            return None
+        try:
+            payload = read_access_token(token)
+        except signing.BadSignature:
+            return None
+        return None if is_revoked(payload) else payload['uid']
+
+    async def respond(self, send, status, data, headers=()):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), *headers],
+        })
+        await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
+
+    async def stream(self, user_id, last_event_id, receive, send):
+        broker = get_broker()
+        subscription = broker.subscribe(user_id)
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        next_event = None
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no'),
+                ],
+            })
+            await self.send_chunk(send, f'retry: {settings.NOTIFICATIONS_RETRY_MS}\n\n'.encode())
+
+            last_key = None
+            if last_event_id is not None:
+                missed = await sync_to_async(broker.missed_events, thread_sensitive=False)(user_id, last_event_id)
+                if missed is None:
+                    await self.send_chunk(send, format_event('reset', {}))
+                else:
+                    last_key = broker.parse_id(last_event_id)
+                    for event in missed:
+                        await self.send_chunk(send, format_event(event.type, event.data, event.id))
+                        last_key = broker.parse_id(event.id)
+
+            while True:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait(
+                    {next_event, disconnected}, timeout=settings.NOTIFICATIONS_HEARTBEAT,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    return
+                if next_event not in done:
+                    # Keeps proxies from closing an idle connection
+                    await self.send_chunk(send, b': keepalive\n\n')
+                    continue
+                event, next_event = next_event.result(), None
+                key = broker.parse_id(event.id)
+                if last_key is not None and key <= last_key:
+                    # Already sent from the buffer
+                    continue
+                last_key = key
+                await self.send_chunk(send, format_event(event.type, event.data, event.id))
+        except SubscriptionOverflow:
+            # Too far behind, the client reconnects and resumes from the buffer
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            subscription.close()
+            for task in (next_event, disconnected):
+                if task is not None:
+                    task.cancel()
+
+    async def send_chunk(self, send, body):
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    async def wait_for_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
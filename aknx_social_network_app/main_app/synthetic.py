@@ -0,0 +1,74 @@
+"""
+Synthetic friend graphs for benchmarks.
+
+Receivers are drawn from a power law over the users (a few very popular users,
+a long tail of barely connected ones), which is the degree distribution real
+social graphs show and the one that stresses 2-hop queries the most.
+"""
+
+import itertools
+import random
+
+from .models import FriendRequest, Friendship
+
+# A realistic mix: most requests get accepted, some wait, a few are turned down
+DEFAULT_STATUSES = {'accepted': 0.7, 'pending': 0.2, 'rejected': 0.1}
+
+
+def power_law_weights(count, alpha):
+    """
+    Returns cumulative weights giving the user at rank `r` a weight of `1 / (r + 1) ** alpha`.
+    """
+
+    return list(itertools.accumulate(1 / (rank + 1) ** alpha for rank in range(count)))
+
+
+def create_friend_graph(user_ids, edges, statuses=None, alpha=0.8, batch_size=5000, seed=0):
+    """
+    Bulk inserts `edges` friend requests between distinct pairs of the given users.
+
+    Args:
+        user_ids: The ids of the users to connect, at least two.
+        edges: The number of friend requests to create.
+        statuses: A mapping of request status to its share of the edges, all accepted by default.
+        alpha: The exponent of the power law popular receivers are drawn from.
+        batch_size: The number of rows inserted per query.
+        seed: The seed making the generated graph reproducible.
+
+    Returns:
+        int: The number of friend requests created. Accepted requests are also linked as friendships.
+    """
+
+    statuses = statuses or {'accepted': 1}
+    max_edges = len(user_ids) * (len(user_ids) - 1) // 2
+    if edges > max_edges:
+        raise ValueError(f'{len(user_ids)} users can hold at most {max_edges} edges.')
+
+    rng = random.Random(seed)
+    receivers_by_popularity = list(user_ids)
+    rng.shuffle(receivers_by_popularity)
+    cum_weights = power_law_weights(len(user_ids), alpha)
+    status_names = list(statuses)
+    status_weights = [statuses[name] for name in status_names]
+
+    seen = set()
+    created = 0
+    while created < edges:
+        wanted = min(batch_size, edges - created)
+        senders = rng.choices(user_ids, k=wanted)
+        receivers = rng.choices(receivers_by_popularity, cum_weights=cum_weights, k=wanted)
+        batch = []
+        for sender, receiver in zip(senders, receivers):
+            pair = (min(sender, receiver), max(sender, receiver))
+            if sender == receiver or pair in seen:
+                continue
+            seen.add(pair)
+            batch.append(FriendRequest(
+                sender_id=sender, receiver_id=receiver,
+                status=rng.choices(status_names, weights=status_weights)[0]))
+        FriendRequest.objects.bulk_create(batch, batch_size=batch_size)
+        created += len(batch)
+
+    for _ in Friendship.objects.link_accepted(batch_size=batch_size):
+        pass
+    return created
@@ -1,3 +1,1643 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.db import connection, connections
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from aknx_social_network_app import metrics, serialization
+from aknx_social_network_app.db import routers
+from aknx_social_network_app.db.pool import PoolTimeout, close_pools
+from aknx_social_network_app.serialization import FastJSONRenderer, PlainList
+from users.tokens import issue_access_token
+
+from . import cache as social_cache
+from . import notifications, profiling, sharding
+from .changes import friend_request_changes
+from .models import FriendRequest, FriendRequestTombstone, Friendship, ProfilingRule
+from .notifications import LocalBroker, SubscriptionOverflow, get_broker
+from .ratelimit import SQLiteCounterBackend, get_counter_backend
+from .sse import STREAM_PATH, NotificationStream
+from .throttles import (
+    BulkFriendRequestRateThrottle,
+    SlidingWindowRateThrottle,
+    get_throttle_stats,
+)
+
+User = get_user_model()
+
+
+def create_user(email, first_name='', last_name=''):
+    return User.objects.create_user(
+        username=email, email=email, password=None,
+        first_name=first_name, last_name=last_name)
+
+
+@override_settings(RATE_LIMIT_STORE={'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'})
+class SocialAPITestCase(TestCase):
+    """
+    Base test case with an authenticated API client for `self.user`.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('me@example.com', 'Me', 'Myself')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        get_counter_backend().clear()
+        social_cache.get_cache().clear()
+        social_cache.reset_stats()
+
+    def send_requests(self, count, status='pending', receiver=None, offset=0):
+        receiver = receiver or self.user
+        senders = [
+            create_user(f'sender{offset + i}@example.com', f'Sender{offset + i}', 'Test')
+            for i in range(count)
+        ]
+        requests = [
+            FriendRequest.objects.create(sender=sender, receiver=receiver, status=status)
+            for sender in senders
+        ]
+        if status == 'accepted':
+            Friendship.objects.link(requests)
+        # Written behind the views' back, drop what they may have cached
+        social_cache.invalidate(receiver.id, *[sender.id for sender in senders])
+        return requests
+
+
+class CursorPaginationTests(SocialAPITestCase):
+
+    def fetch_all(self, url, params=None, between_pages=None):
+        ids = []
+        response = self.client.get(url, dict(params or {}, pagination='cursor'))
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids.extend(row['id'] for row in response.data['results'])
+            if response.data['next'] is None:
+                return ids
+            if between_pages:
+                between_pages()
+            response = self.client.get(response.data['next'])
+
+    def test_pages_through_pending_requests_newest_first(self):
+        requests = self.send_requests(25)
+        ids = self.fetch_all('/api/social/get_pending_friend_requests/')
+        self.assertEqual(ids, [request.id for request in reversed(requests)])
+
+    def test_ordering_is_stable_while_rows_are_inserted(self):
+        requests = self.send_requests(25)
+        inserted = []
+
+        def insert():
+            inserted.extend(self.send_requests(1, offset=100 + len(inserted)))
+
+        ids = self.fetch_all('/api/social/get_pending_friend_requests/', between_pages=insert)
+        self.assertEqual(ids, [request.id for request in reversed(requests)])
+
+    def test_cursor_pages_do_not_count(self):
+        self.send_requests(15, status='accepted')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/social/get_friend_list/', {'pagination': 'cursor'})
+            self.assertEqual(len(response.data['results']), 10)
+            response = self.client.get(response.data['next'])
+            self.assertEqual(len(response.data['results']), 5)
+            self.assertIsNone(response.data['next'])
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+    def test_users_are_keyed_on_id(self):
+        self.send_requests(12)
+        ids = self.fetch_all('/api/users/search_users/', {'search': 'sender'})
+        self.assertEqual(ids, list(
+            User.objects.filter(email__startswith='sender').order_by('id').values_list('id', flat=True)))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/social/get_friend_list/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_numbers_remain_the_default(self):
+        self.send_requests(3)
+        response = self.client.get('/api/social/get_pending_friend_requests/')
+        self.assertEqual(response.data['count'], 3)
+
+    def test_friend_list_pages_are_newest_first(self):
+        requests = self.send_requests(15, status='accepted')
+        response = self.client.get('/api/social/get_friend_list/')
+        next_response = self.client.get(response.data['next'])
+        ids = [row['user_id'] for row in response.data['results'] + next_response.data['results']]
+        self.assertEqual(ids, [request.sender_id for request in reversed(requests)])
+
+    def test_pending_request_pages_are_newest_first(self):
+        requests = self.send_requests(15)
+        response = self.client.get('/api/social/get_pending_friend_requests/')
+        next_response = self.client.get(response.data['next'])
+        ids = [row['id'] for row in response.data['results'] + next_response.data['results']]
+        self.assertEqual(ids, [request.id for request in reversed(requests)])
+
+
+class FriendListQueryCountTests(SocialAPITestCase):
+
+    def assert_constant_queries(self, url, status):
+        for count in (1, 10):
+            FriendRequest.objects.filter(receiver=self.user).delete()
+            self.assertFalse(Friendship.objects.filter(user=self.user).exists())
+            self.send_requests(count, status=status, offset=count * 100)
+            # One COUNT and one joined SELECT, whatever the page size
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(len(response.data['results']), count)
+            self.assertEqual(response.data['count'], count)
+            # The count is cached until the user's friend requests change
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.data['count'], count)
+            with self.assertNumQueries(1):
+                self.client.get(url, {'pagination': 'cursor'})
+
+    def test_friend_list_queries(self):
+        self.assert_constant_queries('/api/social/get_friend_list/', 'accepted')
+
+    def test_pending_requests_queries(self):
+        self.assert_constant_queries('/api/social/get_pending_friend_requests/', 'pending')
+
+    def test_rows_carry_sender_details(self):
+        request, = self.send_requests(1)
+        response = self.client.get('/api/social/get_pending_friend_requests/')
+        self.assertEqual(response.data['results'], [{
+            'id': request.id,
+            'user_id': request.sender.id,
+            'email': request.sender.email,
+            'first_name': request.sender.first_name,
+            'last_name': request.sender.last_name,
+        }])
+
+
+class FriendshipTests(SocialAPITestCase):
+
+    def friend_ids(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.get('/api/social/get_friend_list/')
+        return [row['user_id'] for row in response.data['results']]
+
+    def test_accepting_links_both_users(self):
+        request, = self.send_requests(1)
+        response = self.client.post(
+            f'/api/social/{request.id}/update_request_status/', {'status': 'accepted'})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.friend_ids(self.user), [request.sender_id])
+        self.assertEqual(self.friend_ids(request.sender), [self.user.id])
+        self.assertEqual(Friendship.objects.count(), 2)
+
+    def test_rejecting_does_not_link(self):
+        request, = self.send_requests(1)
+        self.client.post(f'/api/social/{request.id}/update_request_status/', {'status': 'rejected'})
+        self.assertFalse(Friendship.objects.exists())
+
+    def test_backfill_command(self):
+        accepted = self.send_requests(3, status='pending')
+        FriendRequest.objects.filter(id__in=[r.id for r in accepted]).update(status='accepted')
+        self.send_requests(2, offset=10)
+
+        call_command('backfill_friendships', batch_size=2, stdout=StringIO())
+        call_command('backfill_friendships', stdout=StringIO())
+
+        self.assertEqual(Friendship.objects.count(), 6)
+        self.assertCountEqual(self.friend_ids(self.user), [r.sender_id for r in accepted])
+        self.assertEqual(self.friend_ids(accepted[0].sender), [self.user.id])
+
+
+class FriendGraphTests(SocialAPITestCase):
+
+    def befriend(self, *pairs):
+        requests = [
+            FriendRequest.objects.create(sender=sender, receiver=receiver, status='accepted')
+            for sender, receiver in pairs
+        ]
+        Friendship.objects.link(requests)
+        social_cache.invalidate(*[user.id for pair in pairs for user in pair])
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.a, cls.b, cls.c, cls.d, cls.e = [
+            create_user(f'{name}@example.com', name.title()) for name in 'abcde'
+        ]
+
+    def test_mutual_friends(self):
+        self.befriend((self.user, self.a), (self.b, self.user), (self.c, self.user),
+                      (self.a, self.d), (self.d, self.b), (self.d, self.e))
+        response = self.client.get(f'/api/social/{self.d.id}/mutual_friends/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['id'] for row in response.data['results']], [self.a.id, self.b.id])
+
+        response = self.client.get('/api/social/999999/mutual_friends/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_suggestions_rank_by_mutual_friends(self):
+        self.befriend((self.user, self.a), (self.user, self.b),
+                      (self.a, self.c), (self.b, self.c), (self.a, self.d), (self.c, self.e))
+        response = self.client.get('/api/social/suggestions/')
+        self.assertEqual(response.data['results'], [
+            {'id': self.c.id, 'email': self.c.email, 'first_name': 'C', 'last_name': '',
+             'mutual_friends': 2},
+            {'id': self.d.id, 'email': self.d.email, 'first_name': 'D', 'last_name': '',
+             'mutual_friends': 1},
+        ])
+
+    def test_suggestions_skip_requested_users(self):
+        self.befriend((self.user, self.a), (self.a, self.c), (self.a, self.d))
+        FriendRequest.objects.create(sender=self.user, receiver=self.c)
+        response = self.client.get('/api/social/suggestions/', {'limit': 5})
+        self.assertEqual([row['id'] for row in response.data['results']], [self.d.id])
+
+    def test_suggestions_query_count(self):
+        self.befriend((self.user, self.a), (self.a, self.c), (self.a, self.d), (self.a, self.e))
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/social/suggestions/', {'limit': 2})
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_invalid_limit(self):
+        response = self.client.get('/api/social/suggestions/', {'limit': 'many'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_generate_social_graph(self):
+        last_id = User.objects.order_by('-id').values_list('id', flat=True)[0]
+        call_command('generate_social_graph', '--statuses=accepted=0.5,pending=0.5', users=40, edges=200,
+                     stdout=StringIO())
+        requests = FriendRequest.objects.filter(sender_id__gt=last_id, receiver_id__gt=last_id)
+        self.assertEqual(User.objects.filter(id__gt=last_id).count(), 40)
+        self.assertEqual(requests.count(), 200)
+        self.assertEqual(set(requests.values_list('status', flat=True)), {'accepted', 'pending'})
+        self.assertEqual(Friendship.objects.filter(user_id__gt=last_id).count(),
+                         2 * requests.filter(status='accepted').count())
+
+        with self.assertRaises(CommandError):
+            call_command('generate_social_graph', users=2, edges=10, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('generate_social_graph', '--statuses=approved=1', stdout=StringIO())
+
+
+class FriendRequestThrottleTests(SocialAPITestCase):
+
+    def send(self, receiver):
+        return self.client.post('/api/social/send_request/', {'receiver': receiver.id})
+
+    def at(self, now):
+        return mock.patch.object(SlidingWindowRateThrottle, 'timer', return_value=now)
+
+    def test_limits_requests_per_minute(self):
+        receivers = [create_user(f'receiver{i}@example.com') for i in range(5)]
+        with self.at(6000.0):
+            for receiver in receivers[:3]:
+                self.assertEqual(self.send(receiver).status_code, 201)
+            response = self.send(receivers[3])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(get_throttle_stats(['friend_request']),
+                         {'friend_request': {'allowed': 3, 'denied': 1}})
+
+        # Half way through the next window half of the previous window still counts
+        with self.at(6090.0):
+            self.assertEqual(self.send(receivers[3]).status_code, 201)
+            self.assertEqual(self.send(receivers[4]).status_code, 429)
+        with self.at(6115.0):
+            self.assertEqual(self.send(receivers[4]).status_code, 201)
+
+
+class SQLiteCounterBackendTests(TestCase):
+
+    def test_concurrent_increments_are_atomic(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteCounterBackend(f'{directory}/counters.sqlite3')
+
+            def hammer():
+                for _ in range(50):
+                    store.incr('key', ttl=60)
+
+            threads = [threading.Thread(target=hammer) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(store.get('key'), 400)
+
+    def test_counters_expire(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteCounterBackend(f'{directory}/counters.sqlite3')
+            with mock.patch('time.time', return_value=100.0):
+                store.incr('key', 5, ttl=10)
+                self.assertEqual(store.incr('key', 1, ttl=10), 6)
+            with mock.patch('time.time', return_value=111.0):
+                self.assertEqual(store.get_many(['key', 'other']), {'key': 0, 'other': 0})
+                self.assertEqual(store.incr('key', 1, ttl=10), 1)
+
+
+class BulkFriendRequestTests(SocialAPITestCase):
+
+    def bulk_send(self, receivers):
+        return self.client.post(
+            '/api/social/bulk_send_requests/', {'receivers': receivers}, format='json')
+
+    def bulk_update(self, items):
+        return self.client.post(
+            '/api/social/bulk_update_request_status/', {'requests': items}, format='json')
+
+    def unthrottled(self):
+        return mock.patch.object(BulkFriendRequestRateThrottle, 'allow_request', return_value=True)
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return len(queries)
+
+    def test_send_reports_per_item_results(self):
+        a, b, c = [create_user(f'{name}@example.com') for name in 'abc']
+        FriendRequest.objects.create(sender=self.user, receiver=a)
+        FriendRequest.objects.create(sender=self.user, receiver=b, status='rejected')
+
+        with self.unthrottled():
+            response = self.bulk_send([a.id, b.id, c.id, c.id, self.user.id, 999999])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['receiver'], row['status']) for row in response.data['results']], [
+            (a.id, 'error'), (b.id, 'sent'), (c.id, 'sent'), (self.user.id, 'error'), (999999, 'error'),
+        ])
+        self.assertEqual(
+            dict(FriendRequest.objects.filter(sender=self.user).values_list('receiver_id', 'status')),
+            {a.id: 'pending', b.id: 'pending', c.id: 'pending'})
+
+    def test_send_uses_constant_queries(self):
+        receivers = [create_user(f'bulk{i}@example.com').id for i in range(20)]
+        with self.unthrottled():
+            small = self.count_queries(lambda: self.bulk_send(receivers[:2]))
+            large = self.count_queries(lambda: self.bulk_send(receivers[2:]))
+        self.assertEqual(small, large)
+
+    def test_send_counts_every_receiver_against_rate_limit(self):
+        receivers = [create_user(f'bulk{i}@example.com').id for i in range(4)]
+        self.assertEqual(self.bulk_send(receivers).status_code, 429)
+        self.assertEqual(self.bulk_send(receivers[:2]).status_code, 200)
+        self.assertEqual(self.bulk_send(receivers[2:]).status_code, 429)
+        single = self.client.post('/api/social/send_request/', {'receiver': receivers[2]})
+        self.assertEqual(single.status_code, 201)
+        self.assertEqual(FriendRequest.objects.filter(sender=self.user).count(), 3)
+
+    def test_update_reports_per_item_results(self):
+        pending = self.send_requests(3)
+        accepted, = self.send_requests(1, status='accepted', offset=10)
+        others = FriendRequest.objects.create(sender=pending[0].sender, receiver=accepted.sender)
+
+        response = self.bulk_update([
+            {'id': pending[0].id, 'status': 'accepted'},
+            {'id': pending[1].id, 'status': 'rejected'},
+            {'id': pending[1].id, 'status': 'accepted'},
+            {'id': accepted.id, 'status': 'rejected'},
+            {'id': others.id, 'status': 'accepted'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['id'], row['status']) for row in response.data['results']], [
+            (pending[0].id, 'accepted'), (pending[1].id, 'rejected'),
+            (accepted.id, 'error'), (others.id, 'error'),
+        ])
+        self.assertEqual(
+            dict(FriendRequest.objects.filter(receiver=self.user).values_list('id', 'status')),
+            {pending[0].id: 'accepted', pending[1].id: 'rejected', pending[2].id: 'pending',
+             accepted.id: 'accepted'})
+        self.assertTrue(Friendship.objects.filter(user=pending[0].sender, friend=self.user).exists())
+
+    def test_update_uses_constant_queries(self):
+        requests = self.send_requests(20)
+        small = self.count_queries(
+            lambda: self.bulk_update([{'id': r.id, 'status': 'accepted'} for r in requests[:2]]))
+        large = self.count_queries(
+            lambda: self.bulk_update([{'id': r.id, 'status': 'accepted'} for r in requests[2:]]))
+        self.assertEqual(small, large)
+
+    def test_update_rejects_invalid_status(self):
+        request, = self.send_requests(1)
+        response = self.bulk_update([{'id': request.id, 'status': 'maybe'}])
+        self.assertEqual(response.status_code, 400)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Query plans are checked with SQLite EXPLAIN QUERY PLAN')
+class QueryPlanTests(SocialAPITestCase):
+    """
+    Captures the statements of every hot friend request endpoint and fails if the
+    plan of any of them scans a whole table, or sorts a list that an index should
+    return already ordered.
+    """
+
+    def is_table_scan(self, step):
+        # SCAN walks a whole table or index, SEARCH seeks a range of an index
+        return (
+            step.startswith('SCAN ')
+            and step != 'SCAN CONSTANT ROW'
+            and 'VIRTUAL TABLE' not in step
+        )
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = create_user('other@example.com')
+
+    def setUp(self):
+        super().setUp()
+        self.pending = self.send_requests(12)
+        self.accepted = self.send_requests(12, status='accepted', offset=50)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[3] for row in cursor.fetchall()]
+
+    def assert_indexed(self, request, sorting_allowed=False):
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+            if getattr(response, 'data', None) and response.data.get('next'):
+                self.client.get(response.data['next'])
+        self.assertLess(response.status_code, 300)
+
+        statements = [
+            query['sql'] for query in queries
+            if query['sql'].startswith(('SELECT', 'UPDATE', 'DELETE'))
+        ]
+        self.assertTrue(statements)
+        for sql in statements:
+            plan = self.explain(sql)
+            report = '{}\n  {}'.format(sql, '\n  '.join(plan))
+            for step in plan:
+                self.assertFalse(self.is_table_scan(step), f'Table scan in:\n{report}')
+                if not sorting_allowed:
+                    self.assertNotIn('TEMP B-TREE FOR ORDER BY', step, f'Sort in:\n{report}')
+
+    def test_friend_list(self):
+        self.assert_indexed(lambda: self.client.get('/api/social/get_friend_list/'))
+        self.assert_indexed(lambda: self.client.get(
+            '/api/social/get_friend_list/', {'pagination': 'cursor'}))
+
+    def test_pending_requests(self):
+        self.assert_indexed(lambda: self.client.get('/api/social/get_pending_friend_requests/'))
+        self.assert_indexed(lambda: self.client.get(
+            '/api/social/get_pending_friend_requests/', {'pagination': 'cursor'}))
+
+    def test_request_list(self):
+        FriendRequest.objects.create(sender=self.user, receiver=self.other)
+        # The sent and received requests are read from two indexes, then sorted together
+        self.assert_indexed(lambda: self.client.get('/api/social/'), sorting_allowed=True)
+        sql = str(FriendRequest.objects.involving(self.user.id).order_by('-created_at', '-id')[:10].query)
+        plan = '\n'.join(self.explain(sql))
+        self.assertIn('friendrequest_sender_recent', plan)
+        self.assertIn('friendrequest_receiver_recent', plan)
+
+    def test_mutual_friends(self):
+        self.assert_indexed(lambda: self.client.get(
+            f'/api/social/{self.accepted[0].sender_id}/mutual_friends/'))
+
+    def test_suggestions(self):
+        # Ranking by mutual friend count has to sort the aggregated candidates
+        self.assert_indexed(lambda: self.client.get('/api/social/suggestions/'), sorting_allowed=True)
+
+    def test_send_request(self):
+        self.assert_indexed(lambda: self.client.post(
+            '/api/social/send_request/', {'receiver': self.other.id}))
+
+    def test_update_request_status(self):
+        self.assert_indexed(lambda: self.client.post(
+            f'/api/social/{self.pending[0].id}/update_request_status/', {'status': 'accepted'}))
+
+    def test_bulk_actions(self):
+        self.assert_indexed(lambda: self.client.post(
+            '/api/social/bulk_send_requests/', {'receivers': [self.other.id]}, format='json'))
+        self.assert_indexed(lambda: self.client.post(
+            '/api/social/bulk_update_request_status/',
+            {'requests': [{'id': r.id, 'status': 'accepted'} for r in self.pending[1:]]},
+            format='json'))
+
+    def test_changes(self):
+        self.pending[0].delete()
+        self.assert_indexed(lambda: self.client.get('/api/social/changes/'))
+        since = self.client.get('/api/social/changes/', {'limit': 5}).data['since']
+        self.assert_indexed(lambda: self.client.get('/api/social/changes/', {'since': since}))
+
+
+class SocialCacheTests(SocialAPITestCase):
+
+    def pending_count(self, user=None):
+        self.client.force_authenticate(user or self.user)
+        return self.client.get('/api/social/get_pending_friend_requests/').data['count']
+
+    def friend_count(self, user=None):
+        self.client.force_authenticate(user or self.user)
+        return self.client.get('/api/social/get_friend_list/').data['count']
+
+    def test_write_paths_invalidate(self):
+        sender = create_user('sender@example.com')
+        self.assertEqual(self.pending_count(), 0)
+        self.assertEqual(self.friend_count(sender), 0)
+
+        self.client.force_authenticate(sender)
+        self.client.post('/api/social/send_request/', {'receiver': self.user.id})
+        self.assertEqual(self.pending_count(), 1)
+
+        friend_request = FriendRequest.objects.get(sender=sender)
+        self.client.post(f'/api/social/{friend_request.id}/update_request_status/', {'status': 'accepted'})
+        self.assertEqual(self.pending_count(), 0)
+        self.assertEqual(self.friend_count(), 1)
+        self.assertEqual(self.friend_count(sender), 1)
+
+    def test_bulk_write_paths_invalidate(self):
+        receivers = [create_user(f'bulk{i}@example.com') for i in range(2)]
+        self.assertEqual(self.pending_count(receivers[0]), 0)
+
+        self.client.force_authenticate(self.user)
+        with mock.patch.object(BulkFriendRequestRateThrottle, 'allow_request', return_value=True):
+            self.client.post('/api/social/bulk_send_requests/',
+                             {'receivers': [r.id for r in receivers]}, format='json')
+        self.assertEqual(self.pending_count(receivers[0]), 1)
+
+        friend_request = FriendRequest.objects.get(receiver=receivers[0])
+        self.client.post('/api/social/bulk_update_request_status/',
+                         {'requests': [{'id': friend_request.id, 'status': 'accepted'}]}, format='json')
+        self.assertEqual(self.pending_count(receivers[0]), 0)
+        self.assertEqual(self.friend_count(), 1)
+
+    def test_stats_endpoint(self):
+        self.pending_count()
+        self.pending_count()
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/social/cache_stats/').status_code, 403)
+
+        admin = User.objects.create_superuser('admin', 'admin@example.com', None)
+        self.client.force_authenticate(admin)
+        response = self.client.get('/api/social/cache_stats/')
+        self.assertEqual(response.data['pending_count'], {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    @override_settings(SOCIAL_CACHE_MAX_FRIEND_IDS=1)
+    def test_large_friend_lists_are_not_cached(self):
+        self.send_requests(2, status='accepted')
+        self.assertEqual(len(social_cache.get_friend_ids(self.user.id)), 2)
+        self.assertEqual(len(social_cache.get_friend_ids(self.user.id)), 2)
+        self.assertEqual(social_cache.get_stats()['friend_ids']['hits'], 0)
+
+        # The friend list still gets its count from the cache
+        self.client.get('/api/social/get_friend_list/')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/social/get_friend_list/')
+        self.assertEqual(response.data['count'], 2)
+
+
+class ConditionalGetTests(SocialAPITestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # ETags are only given from a cache shared by the processes
+        shared = self.settings(CACHES={**settings.CACHES, 'social': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory.name}})
+        shared.enable()
+        self.addCleanup(shared.disable)
+        super().setUp()
+
+    def get(self, url, etag=None, params=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, params, **headers)
+
+    def test_unchanged_lists_are_not_modified(self):
+        self.send_requests(3)
+        for url in ('/api/social/get_pending_friend_requests/', '/api/social/get_friend_list/'):
+            response = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            # Answered from the cached version alone
+            with self.assertNumQueries(0):
+                response = self.get(url, etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response.content, b'')
+
+            self.assertEqual(self.get(url, f'"other", {etag}').status_code, 304)
+            self.assertEqual(self.get(url, etag, {'pagination': 'cursor'}).status_code, 200)
+
+    def test_etags_change_with_friend_requests(self):
+        url = '/api/social/get_pending_friend_requests/'
+        etag = self.get(url)['ETag']
+        sender = create_user('sender@example.com')
+        self.client.force_authenticate(sender)
+        self.client.post('/api/social/send_request/', {'receiver': self.user.id})
+
+        self.client.force_authenticate(self.user)
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        self.assertNotEqual(response['ETag'], etag)
+
+        friend_list_etag = self.get('/api/social/get_friend_list/')['ETag']
+        friend_request = FriendRequest.objects.get(sender=sender)
+        self.client.post(f'/api/social/{friend_request.id}/update_request_status/', {'status': 'accepted'})
+        self.assertEqual(self.get('/api/social/get_friend_list/', friend_list_etag).status_code, 200)
+
+    def test_etags_change_with_deletes(self):
+        url = '/api/social/get_pending_friend_requests/'
+        first, second = self.send_requests(2)
+        response = self.get(url)
+        self.assertEqual(response.data['count'], 2)
+        etag = response['ETag']
+
+        self.assertEqual(self.client.delete(f'/api/social/{first.id}/').status_code, 204)
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+
+        etag = response['ETag']
+        second.sender.delete()
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_etags_change_when_a_friend_is_deleted(self):
+        url = '/api/social/get_friend_list/'
+        friend_request, = self.send_requests(1, status='accepted')
+        response = self.get(url)
+        self.assertEqual(response.data['count'], 1)
+        etag = response['ETag']
+
+        friend_request.sender.delete()
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_etags_are_per_user(self):
+        url = '/api/social/get_friend_list/'
+        etag = self.get(url)['ETag']
+        self.client.force_authenticate(create_user('other@example.com'))
+        self.assertEqual(self.get(url, etag).status_code, 200)
+
+    def test_local_memory_cache_gives_no_etags(self):
+        url = '/api/social/get_pending_friend_requests/'
+        etag = self.get(url)['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        with self.settings(CACHES={**settings.CACHES, 'social': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+@override_settings(RATE_LIMIT_STORE={'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'})
+class AtomicWriteTests(SocialAPITestCase):
+
+    def test_rejected_request_can_be_sent_again(self):
+        receiver = create_user('receiver@example.com')
+        friend_request = FriendRequest.objects.create(sender=self.user, receiver=receiver, status='rejected')
+        response = self.client.post('/api/social/send_request/', {'receiver': receiver.id})
+        self.assertEqual(response.status_code, 201)
+        friend_request.refresh_from_db()
+        self.assertEqual(friend_request.status, 'pending')
+
+        response = self.client.post('/api/social/send_request/', {'receiver': receiver.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(FriendRequest.objects.count(), 1)
+
+    def test_transition_only_moves_pending_requests(self):
+        pending, = self.send_requests(1)
+        accepted, = self.send_requests(1, status='accepted', offset=10)
+        response = self.client.post(f'/api/social/{accepted.id}/update_request_status/', {'status': 'rejected'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/social/999999/update_request_status/', {'status': 'rejected'})
+        self.assertEqual(response.status_code, 404)
+
+        transitioned = FriendRequest.objects.transition([pending.id, accepted.id], 'accepted', self.user.id)
+        self.assertEqual([(r.id, r.sender_id, r.receiver_id) for r in transitioned],
+                         [(pending.id, pending.sender_id, self.user.id)])
+        self.assertEqual(FriendRequest.objects.transition([pending.id], 'rejected'), [])
+
+    def test_only_the_receiver_processes_a_request(self):
+        pending, = self.send_requests(1)
+        outsider = create_user('outsider@example.com')
+        for user in (pending.sender, outsider):
+            self.client.force_authenticate(user)
+            response = self.client.post(f'/api/social/{pending.id}/update_request_status/', {'status': 'accepted'})
+            self.assertEqual(response.status_code, 404)
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, 'pending')
+        self.assertFalse(Friendship.objects.exists())
+
+        self.client.force_authenticate(self.user)
+        self.client.post(f'/api/social/{pending.id}/update_request_status/', {'status': 'accepted'})
+        self.client.force_authenticate(outsider)
+        response = self.client.post(f'/api/social/{pending.id}/update_request_status/', {'status': 'rejected'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_fallback_without_upsert_support(self):
+        receivers = [create_user(f'receiver{i}@example.com') for i in range(3)]
+        FriendRequest.objects.create(sender=self.user, receiver=receivers[0], status='rejected')
+        FriendRequest.objects.create(sender=self.user, receiver=receivers[1], status='accepted')
+        with mock.patch('main_app.models.can_upsert_returning', return_value=False):
+            sent = FriendRequest.objects.send(self.user.id, [receiver.id for receiver in receivers])
+            self.assertCountEqual([r.receiver_id for r in sent], [receivers[0].id, receivers[2].id])
+            transitioned = FriendRequest.objects.transition([r.id for r in sent], 'accepted', receivers[0].id)
+            self.assertEqual([r.receiver_id for r in transitioned], [receivers[0].id])
+        self.assertEqual(
+            dict(FriendRequest.objects.filter(sender=self.user).values_list('receiver_id', 'status')),
+            {receivers[0].id: 'accepted', receivers[1].id: 'accepted', receivers[2].id: 'pending'})
+
+
+@override_settings(RATE_LIMIT_STORE={'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'})
+class ConcurrentWriteTests(TransactionTestCase):
+    """
+    Many threads racing on the same friend requests, each with its own database connection.
+    """
+
+    threads = 12
+
+    def setUp(self):
+        get_counter_backend().clear()
+        social_cache.get_cache().clear()
+        self.sender = create_user('sender@example.com')
+        self.receiver = create_user('receiver@example.com')
+        unthrottled = mock.patch.object(SlidingWindowRateThrottle, 'allow_request', return_value=True)
+        unthrottled.start()
+        self.addCleanup(unthrottled.stop)
+
+    def race(self, user, path, data):
+        """
+        Posts the same request from every thread at once and returns the responses.
+        Every request must succeed or be refused, a database error would be a 500 for a client.
+        """
+
+        barrier = threading.Barrier(self.threads)
+        responses = []
+        errors = []
+
+        def post():
+            client = APIClient()
+            client.force_authenticate(user)
+            barrier.wait()
+            try:
+                responses.append(client.post(path, data, format='json'))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(responses), self.threads)
+        for response in responses:
+            self.assertIn(response.status_code, (200, 201, 400))
+        return responses
+
+    def statuses(self, responses):
+        return sorted(response.status_code for response in responses)
+
+    def test_concurrent_sends(self):
+        responses = self.race(self.sender, '/api/social/send_request/', {'receiver': self.receiver.id})
+        self.assertEqual(self.statuses(responses), [201] + [400] * (self.threads - 1))
+        self.assertEqual(FriendRequest.objects.count(), 1)
+
+        FriendRequest.objects.update(status='rejected')
+        responses = self.race(self.sender, '/api/social/send_request/', {'receiver': self.receiver.id})
+        self.assertEqual(self.statuses(responses), [201] + [400] * (self.threads - 1))
+        self.assertEqual(FriendRequest.objects.get().status, 'pending')
+
+    def test_concurrent_transitions(self):
+        friend_request = FriendRequest.objects.create(sender=self.sender, receiver=self.receiver)
+        responses = self.race(
+            self.receiver, f'/api/social/{friend_request.id}/update_request_status/', {'status': 'accepted'})
+        self.assertEqual(self.statuses(responses), [200] + [400] * (self.threads - 1))
+        self.assertEqual(Friendship.objects.count(), 2)
+
+    def test_concurrent_bulk_sends(self):
+        receivers = [create_user(f'bulk{i}@example.com').id for i in range(20)]
+        responses = self.race(self.sender, '/api/social/bulk_send_requests/', {'receivers': receivers})
+        sent = [row['receiver'] for response in responses for row in response.data['results']
+                if row['status'] == 'sent']
+        self.assertCountEqual(sent, receivers)
+        self.assertEqual(FriendRequest.objects.count(), len(receivers))
+
+    def test_concurrent_bulk_transitions(self):
+        requests = [
+            FriendRequest.objects.create(sender=create_user(f'bulk{i}@example.com'), receiver=self.receiver)
+            for i in range(20)
+        ]
+        items = [{'id': friend_request.id, 'status': 'accepted'} for friend_request in requests]
+        responses = self.race(self.receiver, '/api/social/bulk_update_request_status/', {'requests': items})
+        accepted = [row['id'] for response in responses for row in response.data['results']
+                    if row['status'] == 'accepted']
+        self.assertCountEqual(accepted, [friend_request.id for friend_request in requests])
+        self.assertEqual(Friendship.objects.count(), 2 * len(requests))
+
+
+class AsyncReadEndpointTests(TransactionTestCase):
+    """
+    The async endpoints read from another thread, so the data must be committed.
+    """
+
+    def setUp(self):
+        get_counter_backend().clear()
+        social_cache.get_cache().clear()
+        self.user = create_user('me@example.com', 'Me', 'Myself')
+        for i in range(3):
+            friend = create_user(f'friend{i}@example.com', f'Friend{i}', 'Test')
+            accepted = FriendRequest.objects.create(sender=friend, receiver=self.user, status='accepted')
+            Friendship.objects.link([accepted])
+            sender = create_user(f'sender{i}@example.com', f'Sender{i}', 'Test')
+            FriendRequest.objects.create(sender=sender, receiver=self.user)
+        self.authorization = f'Bearer {issue_access_token(self.user)}'
+
+    async def test_async_endpoints_match_sync_endpoints(self):
+        client = AsyncClient()
+        # Query strings go in the path, AsyncClient.get() does not encode `data` on Django 3.2
+        urls = [
+            'social/get_friend_list/',
+            'social/get_pending_friend_requests/?pagination=cursor',
+            'users/search_users/?search=sender',
+        ]
+        for url in urls:
+            sync_response = await client.get(
+                f'/api/{url}', authorization=self.authorization, accept='application/json')
+            async_response = await client.get(
+                f'/api/async/{url}', authorization=self.authorization, accept='application/json')
+            self.assertEqual(async_response.status_code, 200)
+            self.assertEqual(async_response['Content-Type'], 'application/json')
+            self.assertEqual(async_response.json().keys(), sync_response.json().keys())
+            self.assertEqual(async_response.json()['results'], sync_response.json()['results'])
+            self.assertEqual(len(async_response.json()['results']), 3)
+
+    async def test_async_endpoints_are_instrumented(self):
+        metrics.registry.reset()
+        await AsyncClient().get('/api/async/social/get_friend_list/', authorization=self.authorization)
+        labels = {'route': 'async-friendrequest-get-friend-list', 'method': 'GET'}
+        self.assertGreater(metric_value('http_request_queries_sum', **labels), 0)
+        self.assertEqual(metric_value('http_request_render_duration_seconds_count', **labels), 1)
+
+    async def test_async_endpoints_require_authentication(self):
+        response = await AsyncClient().get('/api/async/social/get_friend_list/')
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(SOCIAL_EXPORT_CHUNK_SIZE=2)
+    async def test_export_streams_on_event_loop(self):
+        # Streaming responses are iterated on the event loop under ASGI
+        response = await AsyncClient().get('/api/social/export/', authorization=self.authorization)
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 6)
+
+
+class NotificationBrokerTests(SimpleTestCase):
+
+    async def test_subscribers_receive_events_and_resume_from_buffer(self):
+        broker = LocalBroker(buffer_size=3)
+        subscription = broker.subscribe(1)
+        first = broker.publish(1, notifications.EVENT_RECEIVED, {'request_id': 1})
+        broker.publish(2, notifications.EVENT_RECEIVED, {'request_id': 2})
+        self.assertEqual(await subscription.get(), first)
+        subscription.close()
+
+        later = [broker.publish(1, notifications.EVENT_ACCEPTED, {'request_id': i}) for i in range(2)]
+        self.assertEqual(broker.missed_events(1, first.id), later)
+        self.assertEqual(broker.missed_events(1, later[-1].id), [])
+
+        # The first two events are pushed out of the buffer of three
+        newest = [broker.publish(1, notifications.EVENT_REJECTED, {'request_id': i}) for i in range(2)]
+        self.assertIsNone(broker.missed_events(1, first.id))
+        self.assertEqual(broker.missed_events(1, later[0].id), [later[1], *newest])
+        self.assertIsNone(broker.missed_events(1, 'not-an-id'))
+
+    async def test_slow_subscriber_is_dropped(self):
+        broker = LocalBroker(queue_size=2)
+        subscription = broker.subscribe(1)
+        # Published from another thread, like the on_commit callbacks of sync views
+        publisher = threading.Thread(target=lambda: [
+            broker.publish(1, notifications.EVENT_RECEIVED, {'request_id': i}) for i in range(3)])
+        publisher.start()
+        publisher.join()
+        await asyncio.sleep(0)
+
+        self.assertEqual((await subscription.get()).data, {'request_id': 0})
+        self.assertEqual((await subscription.get()).data, {'request_id': 1})
+        with self.assertRaises(SubscriptionOverflow):
+            await subscription.get()
+
+
+@override_settings(
+    RATE_LIMIT_STORE={'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'},
+    NOTIFICATIONS_BROKER={'BACKEND': 'main_app.notifications.LocalBroker'},
+)
+class NotificationStreamTests(SimpleTestCase):
+
+    async def inner_application(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def open_stream(self, path=STREAM_PATH, query='', headers=()):
+        sent = asyncio.Queue()
+        received = asyncio.Queue()
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path,
+            'query_string': query.encode(), 'headers': list(headers),
+        }
+        application = NotificationStream(self.inner_application)
+        task = asyncio.ensure_future(application(scope, received.get, sent.put))
+        return task, sent, received
+
+    async def next_message(self, sent):
+        return await asyncio.wait_for(sent.get(), timeout=1)
+
+    async def close_stream(self, task, received):
+        await received.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(task, timeout=1)
+
+    def token_query(self, user_id=7):
+        user = User(pk=user_id, email='me@example.com')
+        return f'access_token={issue_access_token(user)}'
+
+    async def test_streams_events_and_resumes_after_last_event_id(self):
+        task, sent, received = self.open_stream(query=self.token_query())
+        start = await self.next_message(sent)
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertEqual((await self.next_message(sent))['body'], b'retry: 3000\n\n')
+
+        first = get_broker().publish(7, notifications.EVENT_RECEIVED, {'request_id': 1})
+        get_broker().publish(8, notifications.EVENT_RECEIVED, {'request_id': 2})
+        body = (await self.next_message(sent))['body'].decode()
+        self.assertEqual(body, f'id: {first.id}\nevent: friend_request.received\ndata: {{"request_id":1}}\n\n')
+        await self.close_stream(task, received)
+
+        # Published while disconnected
+        missed = get_broker().publish(7, notifications.EVENT_ACCEPTED, {'request_id': 3})
+        task, sent, received = self.open_stream(
+            query=self.token_query(), headers=[(b'last-event-id', first.id.encode())])
+        await self.next_message(sent)
+        await self.next_message(sent)
+        body = (await self.next_message(sent))['body'].decode()
+        self.assertTrue(body.startswith(f'id: {missed.id}\nevent: friend_request.accepted\n'))
+        await self.close_stream(task, received)
+
+    async def test_requires_access_token(self):
+        task, sent, _ = self.open_stream(query='access_token=forged')
+        self.assertEqual((await self.next_message(sent))['status'], 401)
+        await asyncio.wait_for(task, timeout=1)
+
+    async def test_other_paths_are_passed_through(self):
+        task, sent, _ = self.open_stream(path='/api/social/get_friend_list/')
+        self.assertEqual((await self.next_message(sent))['status'], 204)
+        await asyncio.wait_for(task, timeout=1)
+
+
+class FriendRequestNotificationTests(SocialAPITestCase):
+
+    def test_write_paths_notify_users_on_commit(self):
+        other = create_user('other@example.com')
+        with mock.patch.object(LocalBroker, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/social/send_request/', {'receiver': other.id})
+            friend_request = FriendRequest.objects.get(sender=self.user, receiver=other)
+            publish.assert_called_once_with(other.id, notifications.EVENT_RECEIVED, {
+                'request_id': friend_request.id, 'user': {'id': self.user.id, 'email': self.user.email}})
+
+            publish.reset_mock()
+            self.client.force_authenticate(other)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(f'/api/social/{friend_request.id}/update_request_status/', {'status': 'accepted'})
+            publish.assert_called_once_with(self.user.id, notifications.EVENT_ACCEPTED, {
+                'request_id': friend_request.id, 'user': {'id': other.id, 'email': other.email}})
+
+    def test_bulk_paths_notify_each_user(self):
+        receivers = [create_user(f'bulk{i}@example.com') for i in range(3)]
+        with mock.patch.object(LocalBroker, 'publish') as publish, \
+                mock.patch.object(BulkFriendRequestRateThrottle, 'allow_request', return_value=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/social/bulk_send_requests/', {
+                    'receivers': [receiver.id for receiver in receivers]}, format='json')
+        ids = dict(FriendRequest.objects.filter(sender=self.user).values_list('receiver_id', 'id'))
+        self.assertCountEqual(
+            [(call.args[0], call.args[2]['request_id']) for call in publish.call_args_list],
+            ids.items())
+
+
+class FriendRequestChangesTests(SocialAPITestCase):
+
+    def changes(self, since=None, **params):
+        if since is not None:
+            params['since'] = since
+        response = self.client.get('/api/social/changes/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_full_sync_then_changes_since_cursor(self):
+        pending = self.send_requests(2)
+        accepted = self.send_requests(1, status='accepted', offset=10)
+        data = self.changes()
+        self.assertEqual([change['id'] for change in data['results']], [r.id for r in pending + accepted])
+        self.assertFalse(data['has_more'])
+        change = data['results'][0]
+        self.assertEqual(change['user']['email'], 'sender0@example.com')
+        self.assertFalse(change['deleted'])
+
+        # Everything is recent, so it is all within the settle window and sent again
+        self.assertEqual(len(self.changes(data['since'])['results']), 3)
+
+        # Past the settle window only the rejected and deleted requests are sent
+        FriendRequest.objects.update(updated_at=timezone.now() - timedelta(minutes=1))
+        since = self.changes()['since']
+        self.client.post(f'/api/social/{pending[0].id}/update_request_status/', {'status': 'rejected'})
+        deleted_id = pending[1].id
+        pending[1].delete()
+        results = self.changes(since)['results']
+        self.assertEqual([(change['id'], change['status'], change['deleted']) for change in results], [
+            (pending[0].id, 'rejected', False), (deleted_id, None, True)])
+        self.assertIsNone(results[1]['user'])
+
+    def test_pages_follow_cursor(self):
+        requests = self.send_requests(5)
+        seen = []
+        data = self.changes(limit=2)
+        while True:
+            seen += [change['id'] for change in data['results']]
+            if not data['has_more']:
+                break
+            data = self.changes(data['since'], limit=2)
+        self.assertEqual(seen, [r.id for r in requests])
+
+    def test_caught_up_cursor_stops_short_of_present(self):
+        self.send_requests(2)
+        now = timezone.now()
+        for settle, expected in ((timedelta(0), 0), (timedelta(seconds=5), 2)):
+            _, since, _ = friend_request_changes(self.user.id, settle=settle)
+            with mock.patch('main_app.changes.timezone.now', return_value=now + timedelta(seconds=1)):
+                self.assertEqual(len(friend_request_changes(self.user.id, since)[0]), expected)
+
+    def test_invalid_and_expired_cursors(self):
+        self.assertEqual(self.client.get('/api/social/changes/', {'since': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/social/changes/', {'limit': 0}).status_code, 400)
+        since = self.changes()['since']
+        later = timezone.now() + timedelta(days=31)
+        with mock.patch('main_app.changes.timezone.now', return_value=later):
+            self.assertEqual(self.client.get('/api/social/changes/', {'since': since}).status_code, 410)
+
+    def test_purge_tombstones_command(self):
+        self.send_requests(2)[0].delete()
+        FriendRequestTombstone.objects.update(deleted_at=timezone.now() - timedelta(days=31))
+        self.send_requests(1, offset=10)[0].delete()
+        out = StringIO()
+        call_command('purge_tombstones', stdout=out)
+        self.assertIn('Deleted 1 tombstones', out.getvalue())
+        self.assertEqual(FriendRequestTombstone.objects.count(), 1)
+
+
+def metric_value(name, **labels):
+    """
+    Returns the value of a sample of the metrics registry, None if there is no such sample.
+    """
+
+    wanted = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    for line in metrics.registry.render():
+        sample, _, value = line.rpartition(' ')
+        if sample == f'{name}{{{wanted}}}':
+            return float(value)
+    return None
+
+
+class InstrumentationTests(SocialAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+
+    def test_request_metrics(self):
+        self.send_requests(3, status='accepted')
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/social/get_friend_list/', HTTP_ACCEPT='application/json')
+        labels = {'route': 'friendrequest-get-friend-list', 'method': 'GET'}
+        self.assertEqual(metric_value('http_request_queries_sum', **labels), len(captured))
+        self.assertEqual(metric_value('http_request_duration_seconds_count', **labels), 1)
+        self.assertEqual(metric_value('http_request_render_duration_seconds_count', **labels), 1)
+        self.assertEqual(metric_value('http_response_size_bytes_sum', **labels), len(response.content))
+        self.assertEqual(metric_value('http_response_size_bytes_bucket', **labels, le='100'), 0)
+        self.assertEqual(metric_value('http_response_size_bytes_bucket', **labels, le='+Inf'), 1)
+        self.assertEqual(metric_value('http_responses_total', **labels, status='200'), 1)
+
+        self.client.get('/no/such/page/')
+        self.assertEqual(metric_value('http_responses_total', route='unmatched', method='GET', status='404'), 1)
+
+    def test_metrics_endpoint_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.client.post('/api/social/send_request/', {'receiver': create_user('a@example.com').id})
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('http_request_duration_seconds_count{route="friendrequest-send-request",method="POST"} 1', body)
+        self.assertIn('throttle_requests_total{scope="friend_request",result="allowed"} 1', body)
+        self.assertIn('social_cache_requests_total{kind="friend_ids",result="hits"}', body)
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.assertLogs('aknx_social_network_app.metrics', 'WARNING') as logs:
+            self.client.get('/api/social/get_pending_friend_requests/')
+        self.assertIn('Slow request GET /api/social/get_pending_friend_requests/', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class ConnectionPoolTests(TransactionTestCase):
+    """
+    Pooled connections to the test database, through wrappers of their own.
+    """
+
+    def setUp(self):
+        self.addCleanup(close_pools)
+
+    def make_wrapper(self, **settings_dict):
+        wrapper = type(connections['default'])({**connection.settings_dict, 'POOL': None, **settings_dict}, alias='pooled')
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_connections_are_reused_and_bounded(self):
+        first = self.make_wrapper(POOL={'SIZE': 1, 'TIMEOUT': 0.05})
+        first.ensure_connection()
+        raw = first.connection
+        with self.assertRaises(PoolTimeout):
+            self.make_wrapper(POOL={'SIZE': 1, 'TIMEOUT': 0.05}).ensure_connection()
+
+        first.close()
+        second = self.make_wrapper(POOL={'SIZE': 1, 'TIMEOUT': 0.05})
+        with second.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone(), ('wal',))
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone(), (5000,))
+        self.assertIs(second.connection, raw)
+        stats = second.pool.stats()
+        self.assertEqual((stats['opened'], stats['acquires'], stats['timeouts']), (1, 2, 1))
+        self.assertEqual((stats['in_use'], stats['idle']), (1, 0))
+
+    def test_waiting_acquire_gets_released_connection(self):
+        first = self.make_wrapper(POOL={'SIZE': 1, 'TIMEOUT': 5})
+        first.ensure_connection()
+        raw = first.connection
+        first.inc_thread_sharing()
+        threading.Timer(0.05, first.close).start()
+        second = self.make_wrapper(POOL={'SIZE': 1, 'TIMEOUT': 5})
+        second.ensure_connection()
+        self.assertIs(second.connection, raw)
+        self.assertEqual(second.pool.stats()['waits'], 1)
+
+    def test_failed_health_check_replaces_connection(self):
+        first = self.make_wrapper(POOL={'SIZE': 2}, CONN_HEALTH_CHECKS=True)
+        first.ensure_connection()
+        broken = first.connection
+        first.close()
+
+        second = self.make_wrapper(POOL={'SIZE': 2}, CONN_HEALTH_CHECKS=True)
+        second.ensure_connection()
+        self.assertIs(second.connection, broken)
+        with mock.patch.object(second, 'is_usable', return_value=False):
+            with second.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        self.assertIsNot(second.connection, broken)
+        stats = second.pool.stats()
+        self.assertEqual((stats['opened'], stats['closed'], stats['idle']), (2, 1, 0))
+
+    def test_unpooled_connections_are_closed(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        raw = wrapper.connection
+        wrapper.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            raw.execute('SELECT 1')
+        self.assertEqual(wrapper.pool.stats()['size'], 0)
+
+    def test_pools_are_in_metrics(self):
+        self.make_wrapper(POOL={'SIZE': 3}).ensure_connection()
+        with self.settings(METRICS_TOKEN='secret'):
+            body = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        self.assertIn('db_pool_size{alias="pooled"} 3', body)
+        self.assertIn('db_connections{alias="pooled",state="in_use"} 1', body)
+        self.assertIn('db_connection_acquire_seconds_count{alias="pooled"} 1', body)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Reads routed to a replica, a second SQLite file copied from the test database
+    by `sync_replicas` and behind it until copied again.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        connections.databases['replica'] = {
+            **connection.settings_dict, 'NAME': os.path.join(directory.name, 'replica.sqlite3'), 'POOL': None}
+
+        def remove_replica():
+            connections['replica'].close()
+            del connections['replica']
+            del connections.databases['replica']
+            close_pools()
+
+        self.addCleanup(remove_replica)
+        # The pins are kept in a cache shared by the processes
+        replicas = override_settings(
+            DATABASE_REPLICAS=['replica'], DATABASE_REPLICA_PIN_CACHE='pins', CACHES={**settings.CACHES, 'pins': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': os.path.join(directory.name, 'pins')}})
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+        self.addCleanup(routers.monitor.reset)
+        social_cache.get_cache().clear()
+
+        self.user = create_user('me@example.com', 'Me', 'Myself')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        call_command('sync_replicas', stdout=StringIO())
+
+    def pending_count(self):
+        return self.client.get('/api/social/get_pending_friend_requests/').json()['count']
+
+    def test_writes_pin_users_to_the_primary(self):
+        sender = create_user('sender@example.com')
+        other = create_user('other@example.com')
+        # Written behind the views' back, nobody is pinned
+        FriendRequest.objects.create(sender=sender, receiver=self.user)
+        self.assertEqual(self.pending_count(), 0)
+
+        client = APIClient()
+        client.force_authenticate(other)
+        with mock.patch.object(SlidingWindowRateThrottle, 'allow_request', return_value=True):
+            response = client.post('/api/social/send_request/', {'receiver': self.user.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(routers.is_pinned(other.id))
+        self.assertEqual(self.pending_count(), 2)
+        self.assertEqual(routers.monitor.status()['routed'], {('replica', 'replica'): 1, ('default', 'pinned'): 1})
+
+        routers.get_pin_cache().delete_many([routers.PIN_KEY.format(self.user.id)])
+        call_command('sync_replicas', stdout=StringIO())
+        self.assertEqual(self.pending_count(), 2)
+        self.assertEqual(routers.monitor.status()['routed'][('replica', 'replica')], 2)
+
+    def test_lagging_replicas_get_no_reads(self):
+        create_user('newcomer@example.com')
+        with mock.patch.object(routers, 'replica_lag', return_value=60):
+            response = self.client.get('/api/users/search_users/', {'search': 'newcomer'})
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(routers.monitor.status(), {'lag': {'replica': 60}, 'routed': {('default', 'lagging'): 1}})
+
+        routers.monitor.reset()
+        response = self.client.get('/api/users/search_users/', {'search': 'newcomer'})
+        self.assertEqual(response.json()['count'], 0)
+        with self.settings(METRICS_TOKEN='secret'):
+            body = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        self.assertIn('db_replica_lag_seconds{alias="replica"} 0', body)
+        self.assertIn('db_replica_routed_requests_total{alias="replica",reason="replica"} 1', body)
+
+    def test_writes_go_to_the_primary(self):
+        user = User.objects.using('replica').get(pk=self.user.pk)
+        user.first_name = 'Renamed'
+        user.save()
+        self.assertEqual(User.objects.using('default').get(pk=self.user.pk).first_name, 'Renamed')
+        self.assertEqual(User.objects.using('replica').get(pk=self.user.pk).first_name, 'Me')
+
+    def test_pins_require_a_shared_cache(self):
+        with self.settings(DATABASE_REPLICA_PIN_CACHE='social'), self.assertRaises(ImproperlyConfigured):
+            routers.pin_to_primary(self.user.id)
+
+    def test_sync_requires_sqlite_replicas(self):
+        with self.settings(DATABASE_REPLICAS=[]), self.assertRaises(CommandError):
+            call_command('sync_replicas', stdout=StringIO())
+
+
+class ShardingTests(TransactionTestCase):
+    """
+    Friend requests sharded over two SQLite files next to the test database.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.shards = ['shard_a', 'shard_b']
+        for alias in self.shards:
+            connections.databases[alias] = {
+                **connection.settings_dict, 'NAME': os.path.join(directory.name, f'{alias}.sqlite3'), 'POOL': None}
+            with connections[alias].schema_editor() as editor:
+                editor.create_model(FriendRequest)
+
+        def remove_shards():
+            for alias in self.shards:
+                connections[alias].close()
+                del connections[alias]
+                del connections.databases[alias]
+            close_pools()
+
+        self.addCleanup(remove_shards)
+        shards = override_settings(FRIEND_REQUEST_SHARDS=self.shards)
+        shards.enable()
+        self.addCleanup(shards.disable)
+        sharding.shard_map.load()
+        self.addCleanup(sharding.shard_map.__init__)
+        throttle = mock.patch.object(SlidingWindowRateThrottle, 'allow_request', return_value=True)
+        throttle.start()
+        self.addCleanup(throttle.stop)
+        social_cache.get_cache().clear()
+
+    def create_users(self, count):
+        """
+        Returns users in alternate halves of the buckets, which a rebalance over two shards
+        stores in different shards.
+        """
+
+        users = []
+        half = settings.FRIEND_REQUEST_SHARD_BUCKETS // 2
+        for number in range(1000):
+            user = create_user(f'user{number}@example.com', f'User{number}')
+            if not users or (sharding.user_bucket(user.id) < half) != (sharding.user_bucket(users[-1].id) < half):
+                users.append(user)
+            if len(users) == count:
+                return users
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def copies(self, request_id):
+        return {alias: FriendRequest.objects.using(alias).filter(id=request_id).values_list('status', flat=True).first()
+                for alias in ['default', *self.shards]}
+
+    def test_requests_are_stored_with_both_users(self):
+        call_command('shards', 'rebalance', '--settle=0', stdout=StringIO())
+        sender, receiver = self.create_users(2)
+        self.assertNotEqual(sharding.user_alias(sender.id), sharding.user_alias(receiver.id))
+
+        response = self.client_for(sender).post('/api/social/send_request/', {'receiver': receiver.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        request_id = FriendRequest.objects.get(sender=sender, receiver=receiver).id
+        self.assertEqual(sharding.request_alias(request_id), sharding.user_alias(sender.id))
+        self.assertEqual(self.copies(request_id), {'default': None, 'shard_a': 'pending', 'shard_b': 'pending'})
+
+        response = self.client_for(receiver).get('/api/social/get_pending_friend_requests/')
+        self.assertEqual([(row['id'], row['email']) for row in response.json()['results']],
+                         [(request_id, sender.email)])
+        response = self.client_for(receiver).post(
+            f'/api/social/{request_id}/update_request_status/', {'status': 'accepted'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.copies(request_id), {'default': None, 'shard_a': 'accepted', 'shard_b': 'accepted'})
+        response = self.client_for(sender).get('/api/social/get_friend_list/')
+        self.assertEqual([row['email'] for row in response.json()['results']], [receiver.email])
+
+        for user in (sender, receiver):
+            response = self.client_for(user).get('/api/social/')
+            self.assertEqual(response.json()['results'], [{'receiver': receiver.id}])
+        self.assertEqual(self.client_for(create_user('other@example.com')).get('/api/social/').json()['count'], 0)
+
+        response = self.client_for(sender).delete(f'/api/social/{request_id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.copies(request_id), {'default': None, 'shard_a': None, 'shard_b': None})
+        self.assertEqual(FriendRequestTombstone.objects.filter(request_id=request_id).count(), 1)
+        self.assertFalse(Friendship.objects.exists())
+
+    def test_rebalance_moves_requests_while_they_are_written(self):
+        with override_settings(FRIEND_REQUEST_SHARDS=[]):
+            users = self.create_users(6)
+            legacy = [FriendRequest.objects.create(sender=sender, receiver=receiver)
+                      for sender, receiver in zip(users, users[1:])]
+        moving = []
+
+        def write_while_moving(seconds):
+            # During the first phase, the buckets are written to both databases
+            if not moving:
+                moving.append(FriendRequest.objects.send(users[5].id, [users[0].id])[0])
+                FriendRequest.objects.get(pk=legacy[0].id).delete()
+
+        out = StringIO()
+        with mock.patch.object(sharding.time, 'sleep', side_effect=write_while_moving):
+            call_command('shards', 'rebalance', '--settle=0', stdout=out)
+        self.assertIn('Moved 64 buckets', out.getvalue())
+
+        self.assertFalse(FriendRequest.objects.using('default').exists())
+        for friend_request in legacy[1:] + moving:
+            homes = {sharding.user_alias(friend_request.sender_id), sharding.user_alias(friend_request.receiver_id),
+                     sharding.request_alias(friend_request.id)}
+            self.assertEqual({alias for alias, status in self.copies(friend_request.id).items() if status}, homes)
+            self.assertEqual(FriendRequest.objects.get(pk=friend_request.id).sender_id, friend_request.sender_id)
+        self.assertEqual(self.copies(legacy[0].id), {'default': None, 'shard_a': None, 'shard_b': None})
+        pending = self.client_for(users[0]).get('/api/social/get_pending_friend_requests/').json()['results']
+        self.assertEqual([row['email'] for row in pending], [users[5].email])
+
+        out = StringIO()
+        call_command('shards', 'status', stdout=out)
+        self.assertRegex(out.getvalue(), r'default +0 buckets +0 friend requests')
+        self.assertRegex(out.getvalue(), r'shard_a +32 buckets')
+
+    def test_queries_over_every_user_are_refused(self):
+        call_command('shards', 'rebalance', '--settle=0', stdout=StringIO())
+        sender, *receivers = self.create_users(4)
+        FriendRequest.objects.send(sender.id, [receiver.id for receiver in receivers])
+        with self.assertRaises(sharding.ShardingError):
+            FriendRequest.objects.count()
+        self.assertEqual(sum(shard.count() for shard in FriendRequest.objects.per_shard()), 3)
+        self.assertEqual(FriendRequest.objects.involving(sender.id).count(), 3)
+        self.assertEqual(list(sender.sent_requests.order_by('id').values_list('receiver_id', flat=True)),
+                         [receiver.id for receiver in receivers])
+
+    def test_deleting_a_user_deletes_their_requests(self):
+        call_command('shards', 'rebalance', '--settle=0', stdout=StringIO())
+        sender, receiver = self.create_users(2)
+        friend_request, = FriendRequest.objects.send(sender.id, [receiver.id])
+        receiver.delete()
+        self.assertEqual(self.copies(friend_request.id), {'default': None, 'shard_a': None, 'shard_b': None})
+        self.assertEqual(FriendRequestTombstone.objects.filter(request_id=friend_request.id).count(), 1)
+
+
+class ProfilingTests(SocialAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = override_settings(PROFILING_ENABLED=True, PROFILING_DIR=self.directory.name,
+                                     PROFILING_INTERVAL_MS=1)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(profiling.rules.__init__)
+
+    def slow_view(self, request):
+        time.sleep(0.05)
+        return HttpResponse()
+
+    def test_rules_select_requests(self):
+        other = create_user('other@example.com')
+        ProfilingRule.objects.create(name='search', path_pattern=r'^/api/users/search_users/', sample_percent=100)
+        ProfilingRule.objects.create(name='me', user=self.user, sample_percent=100)
+        ProfilingRule.objects.create(name='disabled', sample_percent=100, enabled=False)
+        ProfilingRule.objects.create(name='expired', sample_percent=100,
+                                     expires_at=timezone.now() - timedelta(minutes=1))
+        profiling.rules.load()
+
+        factory = RequestFactory()
+        self.assertEqual(profiling.rules.match(factory.get('/api/users/search_users/')).name, 'search')
+        mine = factory.get('/api/social/', HTTP_AUTHORIZATION=f'Bearer {issue_access_token(self.user)}')
+        self.assertEqual(profiling.rules.match(mine).name, 'me')
+        theirs = factory.get('/api/social/', HTTP_AUTHORIZATION=f'Bearer {issue_access_token(other)}')
+        self.assertIsNone(profiling.rules.match(theirs))
+        self.assertIsNone(profiling.rules.match(factory.get('/api/social/')))
+
+    def test_profiled_request_is_saved_as_collapsed_stacks(self):
+        ProfilingRule.objects.create(name='all', sample_percent=100)
+        profiling.rules.load()
+        middleware = profiling.ProfilingMiddleware(self.slow_view)
+        middleware(RequestFactory().get('/api/social/'))
+
+        [profile] = profiling.list_profiles()
+        self.assertEqual((profile['method'], profile['route']), ('GET', 'unmatched'))
+        stacks = profile['path'].read_text().splitlines()
+        self.assertTrue(all(line.rpartition(' ')[2].isdigit() for line in stacks))
+        self.assertTrue(any('slow_view (main_app/tests.py:' in line for line in stacks))
+
+        stdout = StringIO()
+        call_command('profiles', 'list', stdout=stdout)
+        self.assertIn(profile['name'], stdout.getvalue())
+        stdout = StringIO()
+        call_command('profiles', 'download', profile['name'], stdout=stdout)
+        self.assertEqual(stdout.getvalue(), profile['path'].read_text())
+        with self.assertRaises(CommandError):
+            call_command('profiles', 'download', '../db.sqlite3', stdout=StringIO())
+
+    @override_settings(PROFILING_MAX_FILES=2)
+    def test_storage_is_capped(self):
+        ProfilingRule.objects.create(name='all', sample_percent=100)
+        profiling.rules.load()
+        middleware = profiling.ProfilingMiddleware(self.slow_view)
+        for _ in range(3):
+            middleware(RequestFactory().get('/api/social/'))
+        self.assertEqual(len(profiling.list_profiles()), 2)
+
+    def test_unselected_requests_are_not_profiled(self):
+        profiling.rules.load()
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/users/search_users/', {'search': 'me'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in captured if 'profilingrule' in query['sql']])
+        self.assertEqual(profiling.list_profiles(), [])
+
+
+class FastSerializationTests(SocialAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Names that exercise escaping: quotes, control characters, non-ASCII and U+2028
+        self.send_requests(3)
+        self.send_requests(3, status='accepted', offset=10)
+        User.objects.filter(email='sender0@example.com').update(first_name='Zoë "Z"\t\u2028')
+
+    def assert_identical(self, url, params=None):
+        social_cache.get_cache().clear()
+        expected = self.client.get(url, params)
+        self.assertEqual(expected.status_code, 200)
+        self.assertNotIsInstance(expected.data.get('results'), PlainList)
+        with override_settings(FAST_SERIALIZATION=True):
+            social_cache.get_cache().clear()
+            response = self.client.get(url, params)
+        self.assertIsInstance(response.data['results'], PlainList)
+        self.assertEqual(response.content, expected.content)
+        # Encoded by orjson, with the bytes of the standard path
+        with mock.patch.object(serialization.orjson, 'dumps', wraps=serialization.orjson.dumps) as dumps:
+            self.assertEqual(FastJSONRenderer().render(response.data), expected.content)
+        dumps.assert_called_once()
+
+    @unittest.skipUnless(serialization.orjson, 'orjson is not installed, see requirements.txt')
+    def test_list_responses_are_byte_identical(self):
+        self.assert_identical('/api/social/get_friend_list/')
+        self.assert_identical('/api/social/get_pending_friend_requests/')
+        self.assert_identical('/api/social/get_pending_friend_requests/', {'pagination': 'cursor'})
+        self.assert_identical('/api/users/search_users/', {'page_size': 20})
+
+    def test_other_payloads_fall_back(self):
+        rows = PlainList([{'id': 1, 'email': 'a@example.com'}], serializer=None)
+        expected = b'[{"id":1,"email":"a@example.com"}]'
+        self.assertEqual(FastJSONRenderer().render(rows), expected)
+        with mock.patch.object(serialization, 'orjson', None):
+            self.assertEqual(FastJSONRenderer().render(rows), expected)
+        self.assertEqual(
+            FastJSONRenderer().render(rows, 'application/json; indent=2'),
+            JSONRenderer().render(rows, 'application/json; indent=2'))
+        self.assertEqual(FastJSONRenderer().render({'score': 1e16}), b'{"score":1e+16}')
+        self.assertEqual(FastJSONRenderer().render(PlainList([2 ** 64], serializer=None)), b'[18446744073709551616]')
+
+
+class FriendRequestExportTests(SocialAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.received = self.send_requests(3)
+        self.sent = FriendRequest.objects.create(sender=self.user, receiver=self.received[0].sender, status='rejected')
+        self.others = self.send_requests(2, receiver=create_user('other@example.com'), offset=10)
+
+    def export(self, **params):
+        response = self.client.get('/api/social/export/', params, HTTP_ACCEPT='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    @override_settings(SOCIAL_EXPORT_CHUNK_SIZE=2)
+    def test_ndjson_export_of_own_requests(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn(f'friend_requests_{self.user.id}.ndjson', response['Content-Disposition'])
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [r.id for r in self.received] + [self.sent.id])
+        self.assertEqual(rows[-1]['sender_email'], self.user.email)
+        self.assertEqual(rows[-1]['status'], 'rejected')
+
+    def test_csv_export(self):
+        response, content = self.export(output='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(content.splitlines()))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['receiver_email'], self.user.email)
+        self.assertEqual(rows[0]['created_at'], self.received[0].created_at.isoformat())
+
+    def test_other_users_require_admin(self):
+        self.assertEqual(self.client.get('/api/social/export/', {'all': 'true'}).status_code, 403)
+        self.assertEqual(self.client.get('/api/social/export/', {'output': 'xml'}).status_code, 400)
+
+        self.client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', None))
+        self.assertEqual(len(self.export(all='true')[1].splitlines()), 6)
+        self.assertEqual(len(self.export(user=self.others[0].receiver_id)[1].splitlines()), 2)
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+            call_command('export_friend_requests', output='csv', file=path, chunk_size=2, stderr=StringIO())
+            with open(path, newline='') as export_file:
+                self.assertEqual(len(list(csv.DictReader(export_file))), 6)
+
+        out = StringIO()
+        call_command('export_friend_requests', user=self.user.id, stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
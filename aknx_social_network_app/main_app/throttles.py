@@ -1,12 +1,125 @@
 from rest_framework.throttling import UserRateThrottle
 
+from .ratelimit import get_counter_backend
 
-class FriendRequestRateThrottle(UserRateThrottle):
+# Scopes of every sliding window throttle, used to report their counters
+THROTTLE_SCOPES = set()
+
+
+class SlidingWindowRateThrottle(UserRateThrottle):
+    """
+    Throttle class enforcing its rate with a sliding window counter in a shared store.
+    Unlike the timestamp history kept by UserRateThrottle, each user only costs two
+    integer counters, the current and the previous window, and every request is one
+    atomic increment in the store configured by `RATE_LIMIT_STORE`, so the limit holds
+    across all worker processes. The request count over the last `duration` seconds is
+    estimated by weighting the previous window by how much of it still overlaps.
+    Allowed and denied requests are counted per scope, see `get_throttle_stats`.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        THROTTLE_SCOPES.add(cls.scope)
+
+    def get_cost(self, request, view):
+        """
+        Returns the number of requests this request is counted as.
+        """
+
+        return 1
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        store = get_counter_backend()
+        cost = self.get_cost(request, view)
+        self.now = self.timer()
+        window, self.elapsed = divmod(self.now, self.duration)
+        current_key = f'{self.key}:{int(window)}'
+        ttl = 2 * self.duration
+
+        self.current = store.incr(current_key, cost, ttl=ttl)
+        self.previous = store.get(f'{self.key}:{int(window) - 1}')
+        if self.estimate(self.current) > self.num_requests:
+            # Give the increment back so denied requests do not use up the allowance
+            self.current = store.incr(current_key, -cost, ttl=ttl)
+            self.cost = cost
+            store.incr(f'throttle_stats:{self.scope}:denied', cost)
+            return False
+
+        store.incr(f'throttle_stats:{self.scope}:allowed', cost)
+        return True
+
+    def estimate(self, current):
+        overlap = 1 - self.elapsed / self.duration
+        return self.previous * overlap + current
+
+    def wait(self):
+        """
+        Returns the number of seconds until a request of the same cost would be allowed.
+        """
+
+        allowance = self.num_requests - self.current - self.cost
+        if allowance >= 0 and self.previous:
+            # Wait for the previous window to slide out enough
+            overlap_needed = allowance / self.previous
+            return max(0.0, (1 - overlap_needed) * self.duration - self.elapsed)
+        return self.duration - self.elapsed
+
+
+class FriendRequestRateThrottle(SlidingWindowRateThrottle):
     """
     Throttle class that limits the rate of friend requests.
-    This class inherits from UserRateThrottle and sets a specific 
-    rate limit for sending friend requests to three requests per minute. 
+    This class inherits from SlidingWindowRateThrottle and sets a specific
+    rate limit for sending friend requests to three requests per minute.
     It is used to prevent abuse of the friend request feature in the application.
     """
 
-    rate = '3/min'
\ No newline at end of file
+    scope = 'friend_request'
+    rate = '3/min'
+
+
+class BulkFriendRequestRateThrottle(FriendRequestRateThrottle):
+    """
+    Throttle class for bulk friend requests, sharing the allowance of FriendRequestRateThrottle.
+    Each distinct receiver of the batch is counted as one friend request, and a batch 
+    exceeding the remaining allowance is refused as a whole.
+    """
+
+    def get_cost(self, request, view):
+        if hasattr(request.data, 'getlist'):
+            receivers = request.data.getlist('receivers')
+        elif hasattr(request.data, 'get'):
+            receivers = request.data.get('receivers')
+        else:
+            receivers = None
+        if isinstance(receivers, list) and receivers:
+            return len(set(map(str, receivers)))
+        return 1
+
+
+def get_throttle_stats(scopes=None):
+    """
+    Returns the allowed and denied request counters of each throttle scope.
+
+    Args:
+        scopes: The scopes to report, every known scope by default.
+
+    Returns:
+        dict: A mapping of scope to a dict with its `allowed` and `denied` counts.
+    """
+
+    scopes = sorted(scopes or THROTTLE_SCOPES)
+    keys = [f'throttle_stats:{scope}:{kind}' for scope in scopes for kind in ('allowed', 'denied')]
+    values = get_counter_backend().get_many(keys)
+    return {
+        scope: {
+            kind: values[f'throttle_stats:{scope}:{kind}'] for kind in ('allowed', 'denied')
+        }
+        for scope in scopes
+    }
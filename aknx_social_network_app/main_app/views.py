@@ -1,24 +1,111 @@
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.http import parse_etags
+from aknx_social_network_app.db.routers import ReplicaReadsMixin
 from .serializers import (
     SocialRequestSerializer,
-    FriendsSerializer
+    BulkSocialRequestSerializer,
+    BulkRequestStatusSerializer,
+    FriendsSerializer,
+    FriendSuggestionSerializer,
+    FriendRequestChangeSerializer,
 )
-from rest_framework.permissions import IsAuthenticated
+from users.serializers import UserSerializer
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django.contrib.auth import get_user_model
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.serializers import ValidationError
 from rest_framework import status
+from django.db import transaction
 from django.db.models import Q
-from .models import FriendRequest
-from .throttles import FriendRequestRateThrottle
+from .models import FriendRequest, Friendship
+from .throttles import BulkFriendRequestRateThrottle, FriendRequestRateThrottle
+from . import cache as social_cache
+from . import graph
+from . import notifications
+from .changes import ExpiredCursor, friend_request_changes
+from .export import (
+    CONTENT_TYPES as EXPORT_CONTENT_TYPES,
+    ExportContentNegotiation,
+    export_chunks,
+    export_queryset,
+    stream_chunks,
+)
+
+User = get_user_model()
 
     
-class SocialViewSet(viewsets.ModelViewSet):
+class SocialViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated, ]
     queryset = FriendRequest.objects.all()
     serializer_class = SocialRequestSerializer
+    # Served from the read replicas, when there are any
+    replica_actions = ('get_friend_list', 'get_pending_friend_requests')
+    # Keyset used when a list action is paginated with `?pagination=cursor`
+    cursor_ordering = ('-created_at', '-id')
+    lookup_value_regex = r'\d+'
+    # Upper bound and default for the `limit` parameter of `suggestions`
+    max_suggestions = 100
+    default_suggestions = 20
+    # Upper bound and default for the `limit` parameter of `changes`
+    max_changes = 500
+    default_changes = 100
+
+    def get_queryset(self):
+        """
+        Lists the friend requests the user sent or received, which are stored together when
+        sharded. The other actions look friend requests up by id, routed on their own.
+        """
+
+        if self.action == 'list':
+            return FriendRequest.objects.involving(self.request.user.id).order_by(*self.cursor_ordering)
+        return super().get_queryset()
+    
+    def get_list_etag(self, request):
+        """
+        Returns the weak ETag of a list action's response for the authenticated user.
+        It combines the user's social version with a digest of the URL and the negotiated 
+        media type. The version follows the friend requests but not the names and emails
+        of the users listed, so the body is only known to be equivalent.
+        """
+
+        version = social_cache.get_version(request.user.id)
+        representation = f'{self.action}:{request.build_absolute_uri()}:{request.accepted_media_type}'
+        digest = hashlib.sha1(representation.encode()).hexdigest()[:16]
+        return f'W/"{request.user.id}-{version}-{digest}"'
+
+    def get_not_modified_response(self, request):
+        """
+        Computes `self.etag` and returns a 304 response if it matches the request's `If-None-Match`.
+        This runs before any query, an unchanged poll only costs the version lookup in the cache.
+        
+        Lists get no ETag unless the social cache is shared by the processes. A write
+        only drops the version of a local-memory cache in the process serving it, and
+        the others would keep answering 304 with a stale list.
+        """
+
+        if not social_cache.is_shared_cache(settings.SOCIAL_CACHE_ALIAS):
+            self.etag = None
+            return None
+        self.etag = self.get_list_etag(request)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and self.etag in parse_etags(if_none_match):
+            return self.set_etag(Response(status=status.HTTP_304_NOT_MODIFIED))
+        return None
+
+    def set_etag(self, response):
+        if self.etag is not None:
+            response['ETag'] = self.etag
+        # Per-user responses, revalidated by the client on every use
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     
     
     @action(
@@ -59,8 +146,9 @@ class SocialViewSet(viewsets.ModelViewSet):
     def update_request_status(self, request, pk=None):
         """
         Updates the status of a friend request based on the provided input.
-        This method allows authenticated users to change the status of a friend request to either 'accepted' or 'rejected'. 
+        This method allows the receiver of a friend request to change its status to either 'accepted' or 'rejected'. 
         It verifies the current status of the request and ensures that only valid status values are processed.
+        Accepting a request also records the friendship from both users' side in the same transaction.
         
         Args:
             request: The HTTP request object containing the status for the friend request.
@@ -73,27 +161,85 @@ class SocialViewSet(viewsets.ModelViewSet):
             ValidationError: If the provided status is not 'accepted' or 'rejected'.
         """
 
-        try:
-            friend_request = self.get_object()
+        status_value = request.data.get('status')
 
-            # Verify wether request already sent
-            if friend_request.status != 'pending':
+        if status_value not in ['accepted', 'rejected']:
+            raise ValidationError({"message": "Invalid status. Only 'accepted' or 'rejected' are allowed."})
+
+        with transaction.atomic():
+            # A conditional UPDATE of the pending request, only one of concurrent calls gets it
+            # Only the receiver of a request may process it
+            transitioned = FriendRequest.objects.transition([int(pk)], status_value, request.user.id)
+            if transitioned:
+                friend_request, = transitioned
+                if status_value == 'accepted':
+                    Friendship.objects.link([friend_request])
+                social_cache.invalidate(friend_request.sender_id, friend_request.receiver_id)
+                notifications.notify_request_processed(friend_request, request.user)
+
+        if not transitioned:
+            if FriendRequest.objects.filter(pk=pk, receiver=request.user).exists():
                 return Response({"message": "This request has already been processed."}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({"message": "Friend request not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        action_message = "accepted" if status_value == 'accepted' else "rejected"
+        return Response({"message": f"Friend request {action_message}."}, status=status.HTTP_200_OK)
+        
+    @action(
+        methods=['post'], 
+        detail=False, 
+        permission_classes=[IsAuthenticated, ], 
+        serializer_class=BulkSocialRequestSerializer,
+        throttle_classes=[BulkFriendRequestRateThrottle, ]
+        )
+    def bulk_send_requests(self, request):
+        """
+        Sends friend requests to a list of users in one call.
+        Every distinct receiver counts against the friend request rate limit. Receivers that 
+        cannot be sent a request are reported in the results without failing the others.
 
-            status_value = request.data.get('status')
+        Args:
+            request: The HTTP request object containing the `receivers` list of user ids.
 
-            if status_value not in ['accepted', 'rejected']:
-                raise ValidationError({"message": "Invalid status. Only 'accepted' or 'rejected' are allowed."})
+        Returns:
+            Response: The result of each receiver.
 
-            friend_request.status = status_value
-            friend_request.save()
+        Raises:
+            ValidationError: If the provided list is missing, empty or too long.
+        """
+
+        serializer = self.get_serializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+    @action(
+        methods=['post'], 
+        detail=False, 
+        permission_classes=[IsAuthenticated],
+        serializer_class=BulkRequestStatusSerializer
+        )
+    def bulk_update_request_status(self, request):
+        """
+        Accepts or rejects a list of friend requests received by the authenticated user in one call.
+        Requests that are not found or were already processed are reported in the results 
+        without failing the others.
+
+        Args:
+            request: The HTTP request object containing the `requests` list of `id` and `status` items.
+
+        Returns:
+            Response: The result of each friend request.
+
+        Raises:
+            ValidationError: If the provided list is invalid or contains an invalid status.
+        """
+
+        serializer = self.get_serializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        return Response({"results": results}, status=status.HTTP_200_OK)
 
-            action_message = "accepted" if status_value == 'accepted' else "rejected"
-            return Response({"message": f"Friend request {action_message}."}, status=status.HTTP_200_OK)
-        
-        except FriendRequest.DoesNotExist:
-            return Response({"message": "Friend request not found."}, status=status.HTTP_404_NOT_FOUND)
-        
     @action(
         methods=['get'], 
         detail=False, 
@@ -102,7 +248,11 @@ class SocialViewSet(viewsets.ModelViewSet):
     def get_friend_list(self, request):
         """
         Retrieves the list of friends for the authenticated user.
-        This method fetches and returns a list of accepted friend requests for the user making the request. 
+        This method fetches and returns the friends of the user making the request, whichever side 
+        sent the accepted friend request, from the symmetric Friendship table. 
+        Pass `pagination=cursor` to page with an opaque cursor instead of page numbers.
+        With a shared social cache, responses carry an ETag, and a request whose `If-None-Match` 
+        still matches gets a 304 Not Modified without the list being queried.
         
         Args:
             request: The HTTP request object used to access the authenticated user's information.
@@ -112,15 +262,21 @@ class SocialViewSet(viewsets.ModelViewSet):
         """
 
         # Extract user from request data
-        receiver = request.user
+        user = request.user
+
+        not_modified = self.get_not_modified_response(request)
+        if not_modified is not None:
+            return not_modified
         
-        queryset = FriendRequest.objects.filter(receiver=receiver, status='accepted')
+        # Newest friends first, read in order from the (user, -created_at, -id) index
+        queryset = Friendship.objects.filter(user=user).with_friend_profile().order_by(
+            '-created_at', '-id').with_known_count(lambda: social_cache.get_friend_count(user.id))
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = FriendsSerializer(page,many=True)
-            return self.get_paginated_response(serializer.data)
+            return self.set_etag(self.get_paginated_response(serializer.data))
         serializer = FriendsSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.set_etag(Response(serializer.data))
 
     @action(
         methods=['get'], 
@@ -131,6 +287,9 @@ class SocialViewSet(viewsets.ModelViewSet):
         """
         Retrieves the list of pending friend requests for the authenticated user.
         This method fetches and returns all friend requests that are currently pending for the user making the request. 
+        Pass `pagination=cursor` to page with an opaque cursor instead of page numbers.
+        With a shared social cache, responses carry an ETag, and a request whose `If-None-Match` 
+        still matches gets a 304 Not Modified without the list being queried.
         
         Args:
             request: The HTTP request object used to access the authenticated user's information.
@@ -141,11 +300,191 @@ class SocialViewSet(viewsets.ModelViewSet):
 
         # Extract current user from request data
         logged_in_user = request.user
+
+        not_modified = self.get_not_modified_response(request)
+        if not_modified is not None:
+            return not_modified
         
-        queryset = FriendRequest.objects.filter(receiver=logged_in_user, status='pending')
+        # Newest requests first, read in order from the pending inbox index
+        queryset = FriendRequest.objects.filter(
+            receiver=logged_in_user, status='pending').with_sender_profile().order_by(
+            '-created_at', '-id').with_known_count(
+            lambda: social_cache.get_pending_count(logged_in_user.id))
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = FriendsSerializer(page,many=True)
-            return self.get_paginated_response(serializer.data)
+            return self.set_etag(self.get_paginated_response(serializer.data))
         serializer = FriendsSerializer(queryset, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return self.set_etag(Response(serializer.data))
+
+    @action(
+        methods=['get'], 
+        detail=True, 
+        permission_classes=[IsAuthenticated],
+        cursor_ordering=('id',)
+        )
+    def mutual_friends(self, request, pk=None):
+        """
+        Retrieves the friends the authenticated user has in common with another user.
+        The intersection of both friend lists is computed by the database in a single query.
+        
+        Args:
+            request: The HTTP request object used to access the authenticated user's information.
+            pk: The id of the other user.
+        
+        Returns:
+            Response: A paginated response containing the mutual friends.
+        """
+
+        if not User.objects.filter(pk=pk).exists():
+            return Response({"message": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        queryset = graph.mutual_friends(request.user.id, pk)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = UserSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = UserSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+    @action(
+        methods=['get'], 
+        detail=False, 
+        permission_classes=[IsAuthenticated]
+        )
+    def suggestions(self, request):
+        """
+        Suggests "people you may know" to the authenticated user.
+        Friends of the user's friends are ranked by how many friends they have in common with the user.
+        
+        Args:
+            request: The HTTP request object, optionally carrying a `limit` on the number of suggestions.
+        
+        Returns:
+            Response: The best ranked suggestions, each with its number of mutual friends.
+        
+        Raises:
+            ValidationError: If the provided limit is not a positive integer.
+        """
+
+        try:
+            limit = int(request.query_params.get('limit', self.default_suggestions))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValidationError({"message": "Limit must be a positive integer."})
+
+        queryset = graph.friend_suggestions(request.user.id)[:min(limit, self.max_suggestions)]
+        serializer = FriendSuggestionSerializer(queryset, many=True)
+        return Response({"results": serializer.data})
+
+
+    @action(
+        methods=['get'], 
+        detail=False, 
+        permission_classes=[IsAuthenticated]
+        )
+    def changes(self, request):
+        """
+        Retrieves the friend requests sent or received by the authenticated user that changed since a cursor.
+        Clients keep a local copy of their friend requests, fetch everything once without `since`, 
+        then only ask for the changes since the cursor returned by their previous sync. Rejected 
+        requests come with their status and deleted ones as tombstones with `deleted` set.
+        
+        Args:
+            request: The HTTP request object, optionally carrying the `since` cursor and a `limit`.
+        
+        Returns:
+            Response: The changes oldest first, the `since` cursor of the next sync, and 
+            `has_more` when further changes can be fetched right away.
+        
+        Raises:
+            ValidationError: If the cursor is invalid or the limit is not a positive integer.
+        """
+
+        try:
+            limit = int(request.query_params.get('limit', self.default_changes))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValidationError({"message": "Limit must be a positive integer."})
+
+        try:
+            results, since, has_more = friend_request_changes(
+                request.user.id,
+                since=request.query_params.get('since'),
+                limit=min(limit, self.max_changes),
+                retention=timedelta(days=settings.SOCIAL_TOMBSTONE_RETENTION_DAYS),
+            )
+        except ValueError:
+            raise ValidationError({"message": "Invalid cursor."})
+        except ExpiredCursor:
+            return Response({"message": "This cursor has expired, sync again without `since`."},
+                            status=status.HTTP_410_GONE)
+
+        serializer = FriendRequestChangeSerializer(results, many=True)
+        return Response({"results": serializer.data, "since": since, "has_more": has_more})
+
+    @action(
+        methods=['get'], 
+        detail=False, 
+        permission_classes=[IsAuthenticated],
+        content_negotiation_class=ExportContentNegotiation
+        )
+    def export(self, request):
+        """
+        Streams every friend request sent or received by the authenticated user, as NDJSON or CSV.
+        Rows are read and encoded a chunk at a time, so exports of any size run in constant memory. 
+        Pass `output=csv` for CSV, NDJSON is the default. Admin users may export the requests of 
+        another user with `user=<id>`, or the whole table with `all=true`.
+        
+        Args:
+            request: The HTTP request object, optionally carrying the `output`, `user` and `all` parameters.
+        
+        Returns:
+            StreamingHttpResponse: The export as an attachment, one friend request per line in id order.
+        
+        Raises:
+            ValidationError: If the output format or the user id is invalid.
+            PermissionDenied: If a user who is not an admin asks for another user's requests or for all of them.
+        """
+
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_CONTENT_TYPES:
+            raise ValidationError({"message": "Output must be one of: {}.".format(', '.join(EXPORT_CONTENT_TYPES))})
+
+        user_id = request.user.id
+        if 'user' in request.query_params or 'all' in request.query_params:
+            if not request.user.is_staff:
+                raise PermissionDenied("Only admin users can export the requests of other users.")
+            if request.query_params.get('all') == 'true':
+                user_id = None
+            else:
+                try:
+                    user_id = int(request.query_params.get('user'))
+                except (TypeError, ValueError):
+                    raise ValidationError({"message": "User must be a user id."})
+
+        chunks = export_chunks(export_queryset(user_id), output, settings.SOCIAL_EXPORT_CHUNK_SIZE)
+        response = StreamingHttpResponse(stream_chunks(chunks), content_type=EXPORT_CONTENT_TYPES[output])
+        response['Content-Disposition'] = 'attachment; filename="friend_requests_{}.{}"'.format(
+            'all' if user_id is None else user_id, output)
+        return response
+
+    @action(
+        methods=['get'], 
+        detail=False, 
+        permission_classes=[IsAdminUser]
+        )
+    def cache_stats(self, request):
+        """
+        Reports the hit ratio of the per-user friend list cache in the process serving the request.
+        
+        Args:
+            request: The HTTP request object of an admin user.
+        
+        Returns:
+            Response: The hits, misses and hit ratio of the friend ids and pending count entries.
+        """
+
+        return Response(social_cache.get_stats())
@@ -0,0 +1,56 @@
+from django.contrib.auth import get_user_model
+from django.core import signing
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from .tokens import is_revoked, read_access_token
+
+User = get_user_model()
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    Authentication class for the access tokens returned by `email_login`.
+    Clients authenticate by passing the token in the `Authorization` header:
+        Authorization: Bearer <token>
+    The token is verified without hashing any password or querying the database.
+    The request user is built from the token claims, it carries the user's id,
+    email and staff flags but none of the other user fields.
+    """
+
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+
+        try:
+            payload = read_access_token(auth[1].decode())
+        except signing.SignatureExpired:
+            raise AuthenticationFailed('Token has expired.')
+        except (signing.BadSignature, UnicodeError):
+            raise AuthenticationFailed('Invalid token.')
+
+        if is_revoked(payload):
+            raise AuthenticationFailed('Token has been revoked.')
+        return (self.get_user(payload), payload)
+
+    def get_user(self, payload):
+        user = User(
+            pk=payload['uid'],
+            username=payload['email'],
+            email=payload['email'],
+            is_staff=payload['staff'],
+            is_superuser=payload['superuser'],
+            is_active=True,
+        )
+        # Behave like an instance loaded from the database
+        user._state.adding = False
+        user._state.db = 'default'
+        return user
+
+    def authenticate_header(self, request):
+        return f'{self.keyword} realm="api"'
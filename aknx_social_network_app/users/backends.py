@@ -0,0 +1,29 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from .hashing import check_user_password, make_password
+
+User = get_user_model()
+
+
+class PooledHashingBackend(ModelBackend):
+    """
+    Authentication backend checking passwords on the hashing pool (users/hashing.py)
+    instead of the request thread. It otherwise behaves like ModelBackend, including
+    upgrading hashes made with outdated hasher parameters.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = User._default_manager.get_by_natural_key(username)
+        except User.DoesNotExist:
+            # Hash anyway so unknown users take as long to refuse as wrong passwords
+            make_password(password)
+            return None
+        if check_user_password(user, password) and self.user_can_authenticate(user):
+            return user
+        return None
@@ -0,0 +1,208 @@
+"""
+Password hashing offloaded to a bounded pool of worker processes.
+
+Hashing a password is deliberately expensive, and done on the request thread it
+blocks a WSGI worker (or the event loop under ASGI) for the whole computation.
+Registration and login hand it to a process pool instead, configured by the
+`PASSWORD_HASHING_WORKERS` and `PASSWORD_HASHING_QUEUE_DEPTH` settings. Once
+every worker is busy and the queue is full, new hashes are refused right away
+with a 503 rather than piling up behind each other. With zero workers hashing
+runs inline, as Django does by default.
+
+Checking a password also reports a new hash when the stored one was made with
+outdated hasher parameters, so hashes are upgraded progressively on login.
+"""
+
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class HashingPoolSaturated(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The server is busy, please retry shortly.'
+    default_code = 'hashing_pool_saturated'
+
+    def __init__(self, wait):
+        super().__init__()
+        # Sent as the Retry-After header by the DRF exception handler
+        self.wait = wait
+
+
+def _make_password(password):
+    return hashers.make_password(password)
+
+
+def _make_passwords(passwords):
+    return [hashers.make_password(password) for password in passwords]
+
+
+def _check_password(password, encoded):
+    rehashed = []
+    valid = hashers.check_password(
+        password, encoded, setter=lambda raw: rehashed.append(hashers.make_password(raw)))
+    return valid, rehashed[0] if rehashed else None
+
+
+class HashingPool:
+    """
+    Runs hashing functions on at most `workers` processes with at most `queue_depth`
+    more waiting for a free worker.
+
+    Args:
+        workers: The number of worker processes, hashing runs inline when 0.
+        queue_depth: The number of hashes that may wait for a worker.
+        retry_after: Seconds suggested to clients refused while the pool is full.
+    """
+
+    def __init__(self, workers, queue_depth, retry_after=1):
+        self.workers = workers
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(workers + queue_depth) if workers else None
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, forking a threaded server process is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, func, *args):
+        """
+        Schedules `func(*args)` on the pool.
+
+        Returns:
+            Future: The future of the call's result.
+
+        Raises:
+            HashingPoolSaturated: If every worker is busy and the queue is full.
+        """
+
+        if not self.workers:
+            future = Future()
+            future.set_result(func(*args))
+            return future
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolSaturated(self.retry_after)
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(func, *args)
+            except BrokenProcessPool:
+                # A worker died and took the pool down with it, start a new one
+                self._discard(executor)
+                future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def make_password(self, password):
+        return self.submit(_make_password, password).result()
+
+    def make_passwords(self, passwords, slices=None):
+        """
+        Hashes many passwords in parallel, for batch jobs rather than requests.
+        The passwords are split into `slices` tasks, twice the number of workers by default,
+        each taking a slot of the pool.
+
+        Returns:
+            list: The hashes, in the order of the passwords.
+
+        Raises:
+            HashingPoolSaturated: If the pool has fewer free slots than tasks.
+        """
+
+        if not passwords:
+            return []
+        size = -(-len(passwords) // (slices or max(self.workers, 1) * 2))
+        futures = [
+            self.submit(_make_passwords, passwords[start:start + size])
+            for start in range(0, len(passwords), size)
+        ]
+        return [encoded for future in futures for encoded in future.result()]
+
+    def check_password(self, password, encoded):
+        """
+        Checks a password against its stored hash.
+
+        Returns:
+            tuple: Whether the password is correct, and its new hash if the stored one
+                must be upgraded to the preferred hasher parameters, None otherwise.
+        """
+
+        return self.submit(_check_password, password, encoded).result()
+
+    async def amake_password(self, password):
+        return await asyncio.wrap_future(self.submit(_make_password, password))
+
+    async def acheck_password(self, password, encoded):
+        return await asyncio.wrap_future(self.submit(_check_password, password, encoded))
+
+
+_pool = None
+
+
+def get_hashing_pool():
+    """
+    Returns the hashing pool configured by the `PASSWORD_HASHING_*` settings.
+    """
+
+    global _pool
+    if _pool is None:
+        _pool = HashingPool(
+            settings.PASSWORD_HASHING_WORKERS,
+            settings.PASSWORD_HASHING_QUEUE_DEPTH,
+            settings.PASSWORD_HASHING_RETRY_AFTER,
+        )
+    return _pool
+
+
+@receiver(setting_changed)
+def reset_hashing_pool(setting, **kwargs):
+    global _pool
+    if setting.startswith('PASSWORD_HASHING_') and _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def make_password(password):
+    return get_hashing_pool().make_password(password)
+
+
+def check_user_password(user, password):
+    """
+    Checks a user's password on the hashing pool, saving the upgraded hash if needed.
+    """
+
+    valid, rehashed = get_hashing_pool().check_password(password, user.password)
+    if rehashed:
+        user.password = rehashed
+        user.save(update_fields=['password'])
+    return valid
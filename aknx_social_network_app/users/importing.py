@@ -0,0 +1,205 @@
+"""
+Bulk import of users from CSV or NDJSON files, used by the `import_users` command.
+
+Each record has an `email`, optionally a `first_name` and a `last_name`, and either
+a plain `password` or a `password_hash`. A plain password is hashed on the
+hashing pool. A hash made by one of the `PASSWORD_HASHERS` is stored as it is,
+and it is upgraded to the preferred hasher on the user's next login. A record
+with neither gets an unusable password.
+
+The file is read a batch at a time. Each batch costs one `username IN (...)`
+lookup to skip the users that already exist, since registered users have their
+email as username. The new users are then inserted with `bulk_create` in one
+transaction. Importing a file again creates nobody twice. After every batch, a
+checkpoint records the byte offset reached in the file, so an interrupted
+import resumes where it stopped instead of hashing everything again.
+"""
+
+import csv
+import json
+import os
+
+from django.contrib.auth import get_user_model, hashers
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+
+User = get_user_model()
+
+FORMATS = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+NAME_MAX_LENGTH = 150
+
+
+def detect_format(path):
+    """
+    Returns the format of a file from its extension.
+
+    Raises:
+        ValueError: If the extension is not one of a CSV or NDJSON file.
+    """
+
+    try:
+        return FORMATS[os.path.splitext(path)[1].lower()]
+    except KeyError:
+        raise ValueError(f'Cannot tell the format of {path}, expected one of: {", ".join(FORMATS)}')
+
+
+def read_records(path, input_format, offset=0):
+    """
+    Yields the records of a file, each with the byte offset just past it.
+    Malformed NDJSON lines are yielded as None.
+
+    Args:
+        path: The file to read.
+        input_format: 'csv' or 'ndjson'. CSV files start with a header row naming the fields.
+        offset: Where to start reading, 0 or an offset yielded by a previous read.
+    """
+
+    with open(path, 'rb') as records_file:
+        header = None
+        if input_format == 'csv':
+            header = next(csv.reader([records_file.readline().decode('utf-8-sig')]), [])
+        if offset:
+            records_file.seek(offset)
+        position = records_file.tell()
+
+        def lines():
+            nonlocal position
+            for line in records_file:
+                position += len(line)
+                yield line.decode('utf-8')
+
+        if input_format == 'csv':
+            for row in csv.reader(lines()):
+                if row:
+                    yield dict(zip(header, row)), position
+            return
+
+        for line in lines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            yield record if isinstance(record, dict) else None, position
+
+
+def clean_record(record):
+    """
+    Validates and normalizes a record.
+
+    Returns:
+        dict: The `email`, `first_name`, `last_name`, `password` and `password_hash` of the user.
+
+    Raises:
+        ValidationError: If the record cannot be imported.
+    """
+
+    if record is None:
+        raise ValidationError('Malformed record.')
+    email = str(record.get('email') or '').strip()
+    validate_email(email)
+    user = {
+        'email': email,
+        'first_name': str(record.get('first_name') or '').strip(),
+        'last_name': str(record.get('last_name') or '').strip(),
+        'password': record.get('password') or None,
+        'password_hash': record.get('password_hash') or None,
+    }
+    if max(len(email), len(user['first_name']), len(user['last_name'])) > NAME_MAX_LENGTH:
+        raise ValidationError(f'Fields are limited to {NAME_MAX_LENGTH} characters.')
+    if user['password_hash'] is not None:
+        try:
+            hashers.identify_hasher(user['password_hash'])
+        except ValueError:
+            raise ValidationError('Unknown password hash algorithm.')
+    return user
+
+
+def import_batch(users, pool):
+    """
+    Creates the users of a batch that do not exist yet.
+
+    Args:
+        users: Cleaned records, as returned by `clean_record`.
+        pool: The HashingPool hashing the plain passwords.
+
+    Returns:
+        tuple: The number of users created, and of users skipped as they already existed
+            or appeared earlier in the batch.
+    """
+
+    new = {}
+    for user in users:
+        new.setdefault(user['email'], user)
+    existing = set(User.objects.filter(username__in=list(new)).values_list('username', flat=True))
+    new = [user for email, user in new.items() if email not in existing]
+
+    to_hash = [user for user in new if user['password_hash'] is None and user['password'] is not None]
+    for user, encoded in zip(to_hash, pool.make_passwords([user['password'] for user in to_hash])):
+        user['password_hash'] = encoded
+
+    with transaction.atomic():
+        # Conflicts are users registered since the lookup, they are left as they are
+        User.objects.bulk_create([
+            User(
+                username=user['email'],
+                email=user['email'],
+                first_name=user['first_name'],
+                last_name=user['last_name'],
+                password=user['password_hash'] or hashers.make_password(None),
+            ) for user in new
+        ], ignore_conflicts=True)
+    return len(new), len(users) - len(new)
+
+
+class Checkpoint:
+    """
+    Progress of an import, saved after every batch so an interrupted import can resume.
+
+    Args:
+        path: The checkpoint file.
+        source: The file being imported, a checkpoint of another file is ignored.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.state = {'offset': 0, 'records': 0, 'created': 0, 'existing': 0, 'invalid': 0}
+
+    def load(self):
+        """
+        Loads the progress saved by a previous run, if any.
+
+        Returns:
+            bool: Whether the import resumes from a previous run.
+        """
+
+        try:
+            with open(self.path) as checkpoint_file:
+                saved = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return False
+        if saved.get('source') != self.source or saved['offset'] > os.path.getsize(self.source):
+            return False
+        self.state = {key: saved[key] for key in self.state}
+        return True
+
+    def save(self, **progress):
+        self.state.update(progress)
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({'source': self.source, **self.state}, checkpoint_file)
+        # Replaced atomically, a crash leaves either the previous or the new checkpoint
+        os.replace(temporary_path, self.path)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,52 @@
+import base64
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from aknx_social_network_app.benchmarking import format_summary, summarize, temporary_database
+from users.tokens import issue_access_token
+
+User = get_user_model()
+
+ENDPOINT = '/api/social/get_pending_friend_requests/'
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the requests per second of an authenticated endpoint with HTTP Basic '
+        'authentication and with access tokens, on a throwaway database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Number of requests timed per authentication scheme.')
+
+    def handle(self, *args, **options):
+        # Keep revocation checks off the shared rate limit file
+        store = {'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'}
+        with temporary_database(), override_settings(RATE_LIMIT_STORE=store):
+            password = 'benchmark-password'
+            # Hashed with the configured hasher, as Basic authentication pays for it on every request
+            user = User.objects.create_user(
+                username='bench@example.com', email='bench@example.com', password=password)
+
+            credentials = base64.b64encode(f'{user.email}:{password}'.encode()).decode()
+            schemes = [
+                ('basic', f'Basic {credentials}'),
+                ('token', f'Bearer {issue_access_token(user)}'),
+            ]
+            client = Client()
+            for label, header in schemes:
+                samples = []
+                for _ in range(options['requests']):
+                    start = time.perf_counter()
+                    response = client.get(ENDPOINT, HTTP_AUTHORIZATION=header)
+                    samples.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        self.stderr.write(f'{label}: unexpected status {response.status_code}')
+                        return
+                summary = summarize(samples)
+                self.stdout.write('{} {:10.1f} req/s'.format(
+                    format_summary(label, summary), len(samples) / sum(samples)))
@@ -0,0 +1,72 @@
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from aknx_social_network_app.benchmarking import (
+    FIRST_NAMES,
+    LAST_NAMES,
+    create_synthetic_users,
+    format_summary,
+    summarize,
+    temporary_database,
+    time_calls,
+)
+from users.search import ContainsSearchBackend, get_search_backend
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the user search backend against substring matching on a '
+        'throwaway database filled with synthetic users.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000,
+                            help='Number of synthetic users to create.')
+        parser.add_argument('--queries', type=int, default=200,
+                            help='Number of search terms timed per backend.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with temporary_database():
+            start = time.perf_counter()
+            create_synthetic_users(options['users'], seed=options['seed'])
+            self.stdout.write('Created {} users in {:.1f}s'.format(
+                options['users'], time.perf_counter() - start))
+
+            terms = self.make_terms(options['queries'], options['seed'])
+            page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+            backends = [('index', get_search_backend()), ('icontains', ContainsSearchBackend())]
+            for label, backend in backends:
+                def run(term, backend=backend):
+                    # Same work as a search_users page: a COUNT plus the first page
+                    queryset = backend.search(User.objects.all(), term)
+                    queryset.count()
+                    list(queryset[:page_size])
+
+                samples = time_calls(run, terms)
+                label = '{} ({})'.format(label, type(backend).__name__)
+                self.stdout.write(format_summary(label, summarize(samples)))
+
+    def make_terms(self, count, seed):
+        """
+        Builds a mix of full names, name prefixes and email fragments to search for.
+        """
+
+        rng = random.Random(seed)
+        terms = []
+        for _ in range(count):
+            name = rng.choice(FIRST_NAMES + LAST_NAMES)
+            kind = rng.random()
+            if kind < 0.4:
+                terms.append(name)
+            elif kind < 0.8:
+                terms.append(name[:rng.randint(3, len(name))])
+            else:
+                terms.append('{}{}'.format(rng.choice(LAST_NAMES), rng.randint(1, 99999)))
+        return terms
@@ -0,0 +1,87 @@
+import itertools
+import os
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from users.hashing import HashingPool
+from users.importing import Checkpoint, clean_record, detect_format, import_batch, read_records
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports users from a CSV or NDJSON file with an `email`, `first_name`, `last_name` and '
+        'either a plain `password` or a `password_hash` per record. Existing users are skipped, '
+        'plain passwords are hashed on a pool of worker processes, and an interrupted import '
+        'resumes from its checkpoint when run again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The CSV or NDJSON file to import.')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default=None,
+                            help='Format of the file, guessed from its extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of records looked up, hashed and inserted together.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes hashing plain passwords, 0 to hash inline.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording the progress of the import, <path>.checkpoint by default.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint and import the file from the start.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            input_format = options['format'] or detect_format(path)
+        except ValueError as e:
+            raise CommandError(e)
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist.')
+
+        checkpoint = Checkpoint(options['checkpoint'] or f'{path}.checkpoint', path)
+        if not options['restart'] and checkpoint.load():
+            self.stdout.write('Resuming after record {records}'.format(**checkpoint.state))
+
+        pool = HashingPool(options['workers'], queue_depth=options['workers'] * 2)
+        try:
+            self.run(path, input_format, options['batch_size'], pool, checkpoint)
+        finally:
+            pool.shutdown()
+        checkpoint.delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {records} records: {created} created, {existing} already existed, '
+            '{invalid} invalid.'.format(**checkpoint.state)))
+
+    def run(self, path, input_format, batch_size, pool, checkpoint):
+        state = checkpoint.state
+        records = read_records(path, input_format, state['offset'])
+        number = state['records']
+        start = time.perf_counter()
+        imported = 0
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+
+            users = []
+            for record, _ in batch:
+                number += 1
+                try:
+                    users.append(clean_record(record))
+                except ValidationError as e:
+                    state['invalid'] += 1
+                    self.stderr.write(f'Record {number}: {" ".join(e.messages)}')
+            created, existing = import_batch(users, pool)
+            checkpoint.save(
+                offset=batch[-1][1],
+                records=number,
+                created=state['created'] + created,
+                existing=state['existing'] + existing,
+            )
+
+            imported += len(batch)
+            self.stdout.write('{records} records: {created} created, {existing} already existed, '
+                              '{invalid} invalid, {rate:.0f} records/s'.format(
+                                  rate=imported / (time.perf_counter() - start), **state))
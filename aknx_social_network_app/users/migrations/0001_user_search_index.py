@@ -0,0 +1,90 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+SQLITE_FORWARD = [
+    # External content table: the index stores trigrams only, rows live in auth_user
+    """
+    CREATE VIRTUAL TABLE users_search_index USING fts5(
+        email, first_name, last_name,
+        content='auth_user', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER users_search_index_ai AFTER INSERT ON auth_user BEGIN
+        INSERT INTO users_search_index(rowid, email, first_name, last_name)
+        VALUES (new.id, new.email, new.first_name, new.last_name);
+    END
+    """,
+    """
+    CREATE TRIGGER users_search_index_ad AFTER DELETE ON auth_user BEGIN
+        INSERT INTO users_search_index(users_search_index, rowid, email, first_name, last_name)
+        VALUES ('delete', old.id, old.email, old.first_name, old.last_name);
+    END
+    """,
+    """
+    CREATE TRIGGER users_search_index_au AFTER UPDATE OF email, first_name, last_name ON auth_user BEGIN
+        INSERT INTO users_search_index(users_search_index, rowid, email, first_name, last_name)
+        VALUES ('delete', old.id, old.email, old.first_name, old.last_name);
+        INSERT INTO users_search_index(rowid, email, first_name, last_name)
+        VALUES (new.id, new.email, new.first_name, new.last_name);
+    END
+    """,
+    "INSERT INTO users_search_index(users_search_index) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS users_search_index_au',
+    'DROP TRIGGER IF EXISTS users_search_index_ad',
+    'DROP TRIGGER IF EXISTS users_search_index_ai',
+    'DROP TABLE IF EXISTS users_search_index',
+]
+
+# Django's icontains lookup compiles to UPPER(column::text) LIKE UPPER(%s)
+POSTGRES_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+] + [
+    f'CREATE INDEX IF NOT EXISTS users_{column}_trgm ON auth_user '
+    f'USING gin (UPPER({column}::text) gin_trgm_ops)'
+    for column in ('email', 'first_name', 'last_name')
+]
+
+POSTGRES_BACKWARD = [
+    f'DROP INDEX IF EXISTS users_{column}_trgm'
+    for column in ('email', 'first_name', 'last_name')
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_FORWARD[0])
+        except OperationalError:
+            # SQLite built without FTS5 or the trigram tokenizer (< 3.34),
+            # search falls back to substring matching.
+            return
+        for statement in SQLITE_FORWARD[1:]:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        for statement in POSTGRES_FORWARD:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}.get(vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
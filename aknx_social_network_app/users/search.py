@@ -0,0 +1,100 @@
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Q
+
+# SQLite FTS5 table (trigram tokenizer) mirroring the searchable user columns.
+SQLITE_SEARCH_TABLE = 'users_search_index'
+
+# The trigram tokenizer cannot match terms shorter than a single trigram.
+MIN_INDEXED_TERM_LENGTH = 3
+
+SEARCH_FIELDS = ('email', 'first_name', 'last_name')
+
+
+class ContainsSearchBackend:
+    """
+    Fallback search backend running a case-insensitive substring match.
+    This is the original behaviour of `search_users` and is used for databases
+    without a search index, or for terms too short to be looked up in one.
+    """
+
+    def search(self, queryset, term):
+        condition = Q()
+        for field in SEARCH_FIELDS:
+            condition |= Q(**{f'{field}__icontains': term})
+        return queryset.filter(condition)
+
+
+class SQLiteFTSSearchBackend(ContainsSearchBackend):
+    """
+    Search backend using the SQLite FTS5 trigram index created by the users migrations.
+    The index is an external content table over `auth_user`, kept current by
+    triggers on insert, update and delete, and results are ordered by bm25 rank.
+    """
+
+    def search(self, queryset, term):
+        if len(term) < MIN_INDEXED_TERM_LENGTH:
+            return super().search(queryset, term)
+
+        # Quote the term as a phrase so it is matched as a plain substring
+        match = '"{}"'.format(term.replace('"', '""'))
+        user_table = queryset.model._meta.db_table
+        return queryset.extra(
+            select={'search_rank': f'{SQLITE_SEARCH_TABLE}.rank'},
+            tables=[SQLITE_SEARCH_TABLE],
+            where=[
+                f'{SQLITE_SEARCH_TABLE}.rowid = {user_table}.id',
+                f'{SQLITE_SEARCH_TABLE} MATCH %s',
+            ],
+            params=[match],
+            order_by=['search_rank', 'id'],
+        )
+
+
+class PostgresTrigramSearchBackend(ContainsSearchBackend):
+    """
+    Search backend for PostgreSQL relying on the pg_trgm GIN indexes created
+    by the users migrations. The `icontains` filter is served by those indexes
+    and results are ranked by their best trigram similarity to the term.
+    """
+
+    def search(self, queryset, term):
+        # Imported lazily as it requires psycopg2
+        from django.contrib.postgres.search import TrigramSimilarity
+        from django.db.models.functions import Greatest
+
+        similarity = Greatest(*[TrigramSimilarity(field, term) for field in SEARCH_FIELDS])
+        return super().search(queryset, term).annotate(
+            search_rank=similarity).order_by('-search_rank', 'id')
+
+
+# Index availability per database name, so the introspection query runs once
+_sqlite_index_available = {}
+
+
+def sqlite_search_index_exists(connection):
+    name = connection.settings_dict['NAME']
+    if name not in _sqlite_index_available:
+        with connection.cursor() as cursor:
+            _sqlite_index_available[name] = (
+                SQLITE_SEARCH_TABLE in connection.introspection.table_names(cursor))
+    return _sqlite_index_available[name]
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS):
+    """
+    Returns the search backend matching a database.
+
+    Args:
+        using: The alias of the database running the search, `queryset.db` for a routed queryset.
+
+    Returns:
+        ContainsSearchBackend: The backend used to filter and rank users for a search term.
+    """
+
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return PostgresTrigramSearchBackend()
+    if connection.vendor == 'sqlite' and sqlite_search_index_exists(connection):
+        return SQLiteFTSSearchBackend()
+    return ContainsSearchBackend()
+
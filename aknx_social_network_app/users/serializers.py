@@ -2,9 +2,12 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from rest_framework.validators import UniqueValidator
 from django.core.validators import validate_email
-from django.contrib.auth.hashers import make_password
 from django.core.exceptions import ValidationError
 
+from aknx_social_network_app.serialization import FastListSerializer
+
+from .hashing import make_password
+
 User = get_user_model()
 
 class EmailLoginSerializer(serializers.Serializer):
@@ -35,6 +38,7 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'email', 'first_name', 'last_name',)
+        list_serializer_class = FastListSerializer
     
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -42,7 +46,7 @@ class RegisterSerializer(serializers.ModelSerializer):
     Serializer for user registration, handling validation and creation of user accounts.
     This serializer validates user input for registration, ensuring that the email is unique 
     and properly formatted, and that required fields are provided. It also hashes the password 
-    before creating a new user instance.
+    on the hashing pool before creating a new user instance.
     
     Args:
         email: The email address of the user, which must be unique.
@@ -55,6 +59,7 @@ class RegisterSerializer(serializers.ModelSerializer):
     
     Raises:
         ValidationError: If the email is not unique, if required fields are missing, or if the email format is invalid.
+        HashingPoolSaturated: If the hashing pool cannot take the password right now.
     """
 
     email = serializers.EmailField(required=True, validators=[UniqueValidator(
@@ -85,7 +90,7 @@ class RegisterSerializer(serializers.ModelSerializer):
         return super().validate(data)
     
     def create(self, validated_data):
-        # Hashing the password 
+        # Hashing the password on the hashing pool
         validated_data['password'] = make_password(
             validated_data.get('password'))
 
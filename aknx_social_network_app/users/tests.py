@@ -1,3 +1,290 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model, hashers
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from aknx_social_network_app.db.pool import close_pools
+from main_app import cache as social_cache
+from main_app.ratelimit import get_counter_backend
+
+from . import importing
+from .hashing import HashingPool, get_hashing_pool
+from .search import ContainsSearchBackend, SQLiteFTSSearchBackend, get_search_backend
+
+User = get_user_model()
+
+
+def create_user(email, first_name='', last_name='', password=None):
+    return User.objects.create_user(
+        username=email, email=email, password=password,
+        first_name=first_name, last_name=last_name)
+
+
+class SearchUsersTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('searcher@example.com', 'Search', 'Er')
+        cls.alice = create_user('alice.smith@example.com', 'Alice', 'Smith')
+        cls.bob = create_user('bob@example.com', 'Bob', 'Smithson')
+        cls.carol = create_user('carol@example.com', 'Carol', 'Jones')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, term):
+        response = self.client.get('/api/users/search_users/', {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return [row['id'] for row in response.data['results']]
+
+    def test_matches_substring_of_any_field(self):
+        self.assertCountEqual(self.search('smith'), [self.alice.id, self.bob.id])
+        self.assertEqual(self.search('ones'), [self.carol.id])
+        self.assertEqual(self.search('BOB@EXAMPLE'), [self.bob.id])
+
+    def test_short_terms_fall_back_to_substring_match(self):
+        self.assertCountEqual(self.search('jo'), [self.carol.id])
+
+    def test_index_follows_user_updates(self):
+        self.carol.last_name = 'Smithers'
+        self.carol.save()
+        self.assertCountEqual(self.search('smith'), [self.alice.id, self.bob.id, self.carol.id])
+
+        self.bob.delete()
+        self.assertCountEqual(self.search('smith'), [self.alice.id, self.carol.id])
+
+    def test_index_matches_substring_backend(self):
+        for term in ('smith', 'example', 'ali', 'nothing-here'):
+            indexed = get_search_backend().search(User.objects.all(), term)
+            scanned = ContainsSearchBackend().search(User.objects.all(), term)
+            self.assertCountEqual(
+                indexed.values_list('id', flat=True), scanned.values_list('id', flat=True))
+
+    def test_backend_follows_the_database_searched(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # A database without the search index
+        connections.databases['plain'] = {
+            **connection.settings_dict, 'NAME': os.path.join(directory.name, 'plain.sqlite3'), 'POOL': None}
+
+        def remove_database():
+            connections['plain'].close()
+            del connections['plain']
+            del connections.databases['plain']
+            close_pools()
+
+        self.addCleanup(remove_database)
+        self.assertIsInstance(get_search_backend(), SQLiteFTSSearchBackend)
+        self.assertIs(type(get_search_backend('plain')), ContainsSearchBackend)
+
+
+@override_settings(
+    RATE_LIMIT_STORE={'BACKEND': 'main_app.ratelimit.LocMemCounterBackend'},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    PASSWORD_HASHING_WORKERS=0,
+)
+class AccessTokenTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('token@example.com', 'Token', 'User', password='secret-password')
+
+    def setUp(self):
+        self.client = APIClient()
+        get_counter_backend().clear()
+
+    def login(self):
+        response = self.client.post('/api/users/email_login/', {
+            'email': self.user.email, 'password': 'secret-password'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['access_token']
+
+    def get_pending(self, token):
+        return self.client.get('/api/social/get_pending_friend_requests/',
+                               HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_login_returns_token(self):
+        response = self.client.post('/api/users/email_login/', {
+            'email': self.user.email, 'password': 'secret-password'}, format='json')
+        self.assertEqual(response.data['token_type'], 'Bearer')
+        self.assertGreater(response.data['expires_in'], 0)
+        self.assertTrue(response.data['access_token'])
+
+    def test_token_authenticates_without_user_query(self):
+        token = self.login()
+        social_cache.get_cache().clear()
+        # Only the pending count of the empty inbox, no query loading the user
+        with self.assertNumQueries(1):
+            response = self.get_pending(token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_tokens_are_refused(self):
+        token = self.login()
+        response = self.get_pending(token[:-1] + ('A' if token[-1] != 'A' else 'B'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+
+        with override_settings(ACCESS_TOKEN_LIFETIME=-1):
+            response = self.get_pending(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(str(response.data['detail']), 'Token has expired.')
+
+    def test_logout_revokes_token(self):
+        token = self.login()
+        other_token = self.login()
+        response = self.client.post('/api/users/logout/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get_pending(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(str(response.data['detail']), 'Token has been revoked.')
+        self.assertEqual(self.get_pending(other_token).status_code, 200)
+
+
+@override_settings(
+    PASSWORD_HASHERS=[
+        'django.contrib.auth.hashers.MD5PasswordHasher',
+        'django.contrib.auth.hashers.SHA1PasswordHasher',
+    ],
+    PASSWORD_HASHING_WORKERS=0,
+)
+class PasswordHashingTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def register(self, email):
+        return self.client.post('/api/users/register/', {
+            'email': email, 'first_name': 'New', 'last_name': 'User',
+            'password': 'secret-password'}, format='json')
+
+    def test_pool_hashes_in_worker_processes(self):
+        pool = HashingPool(workers=1, queue_depth=1)
+        self.addCleanup(pool.shutdown)
+        # Workers load the settings module, without the overrides of this test case
+        encoded = pool.make_password('secret-password')
+        self.assertEqual(pool.check_password('secret-password', encoded), (True, None))
+        hashes = pool.make_passwords(['first-password', 'second-password', 'third-password'])
+        self.assertEqual(pool.check_password('third-password', hashes[2]), (True, None))
+
+        valid, _ = asyncio.run(pool.acheck_password('wrong-password', encoded))
+        self.assertFalse(valid)
+
+    def test_saturated_pool_refuses_fast(self):
+        with override_settings(PASSWORD_HASHING_WORKERS=1, PASSWORD_HASHING_QUEUE_DEPTH=0):
+            # Keep the only worker busy
+            get_hashing_pool().submit(time.sleep, 5)
+            start = time.perf_counter()
+            response = self.register('busy@example.com')
+            self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(User.objects.filter(email='busy@example.com').exists())
+
+    def test_register_hashes_password(self):
+        self.assertEqual(self.register('new@example.com').status_code, 200)
+        user = User.objects.get(email='new@example.com')
+        self.assertTrue(user.password.startswith('md5$'))
+        self.assertTrue(user.check_password('secret-password'))
+
+    def test_login_upgrades_outdated_hash(self):
+        user = create_user('old@example.com')
+        user.password = hashers.make_password('secret-password', hasher='sha1')
+        user.save()
+
+        response = self.client.post('/api/users/email_login/', {
+            'email': user.email, 'password': 'secret-password'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('md5$'))
+
+        response = self.client.post('/api/users/email_login/', {
+            'email': user.email, 'password': 'wrong-password'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ImportUsersTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        create_user('existing@example.com')
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as records_file:
+            records_file.write(content)
+        return path
+
+    def import_users(self, path, **options):
+        out, err = StringIO(), StringIO()
+        call_command('import_users', path, workers=0, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import(self):
+        legacy_hash = hashers.make_password('legacy-password', hasher='md5')
+        path = self.write('users.csv', (
+            'email,first_name,last_name,password,password_hash\n'
+            'new@example.com,New,"User, Jr",secret-password,\n'
+            'hashed@example.com,Hashed,User,,' + legacy_hash + '\n'
+            'nopassword@example.com,No,Password,,\n'
+            'existing@example.com,Existing,User,secret-password,\n'
+            'new@example.com,Duplicate,User,other-password,\n'
+            'not-an-email,Bad,Email,secret-password,\n'
+            'bad-hash@example.com,Bad,Hash,,plain\n'
+        ))
+        with self.assertNumQueries(4):
+            out, err = self.import_users(path, batch_size=10)
+        self.assertIn('7 records: 3 created, 2 already existed, 2 invalid.', out)
+        self.assertIn('Record 6: Enter a valid email address.', err)
+        self.assertIn('Record 7: Unknown password hash algorithm.', err)
+
+        new = User.objects.get(username='new@example.com')
+        self.assertEqual((new.first_name, new.last_name), ('New', 'User, Jr'))
+        self.assertTrue(new.check_password('secret-password'))
+        self.assertTrue(User.objects.get(email='hashed@example.com').check_password('legacy-password'))
+        self.assertFalse(User.objects.get(email='nopassword@example.com').has_usable_password())
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+        # Importing again creates nobody twice
+        out, _ = self.import_users(path)
+        self.assertIn('0 created, 5 already existed', out)
+
+    def test_interrupted_import_resumes(self):
+        path = self.write('users.ndjson', ''.join(
+            json.dumps({'email': f'user{i}@example.com', 'password': 'secret-password'}) + '\n'
+            for i in range(5)) + '{not json\n')
+
+        import_batch = importing.import_batch
+        calls = []
+
+        def failing_batch(users, pool):
+            calls.append(len(users))
+            if len(calls) == 2:
+                raise RuntimeError('Interrupted')
+            return import_batch(users, pool)
+
+        with mock.patch('users.management.commands.import_users.import_batch', failing_batch):
+            with self.assertRaises(RuntimeError):
+                self.import_users(path, batch_size=2)
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 2)
+        with open(path + '.checkpoint') as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['records'], 2)
+
+        out, err = self.import_users(path, batch_size=2)
+        self.assertIn('Resuming after record 2', out)
+        self.assertIn('6 records: 5 created, 0 already existed, 1 invalid.', out)
+        self.assertIn('Record 6: Malformed record.', err)
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 5)
@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.shortcuts import render
+from aknx_social_network_app.db.routers import ReplicaReadsMixin
 from .serializers import (
     EmailLoginSerializer,
     UserSerializer,
@@ -12,14 +14,20 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.serializers import ValidationError
 from django.contrib.auth import authenticate
-from django.db.models import Q
+from .authentication import SignedTokenAuthentication
+from .search import get_search_backend
+from .tokens import issue_access_token, revoke_access_token
 
 User = get_user_model()
 
-class UsersViewSet(viewsets.ModelViewSet):
+class UsersViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated, ]
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    # Served from the read replicas, when there are any
+    replica_actions = ('search_users',)
+    # Keyset used when a list action is paginated with `?pagination=cursor`
+    cursor_ordering = ('id',)
     
     
     @action(
@@ -62,17 +70,20 @@ class UsersViewSet(viewsets.ModelViewSet):
         """
         Handles user login via email and password authentication.
         This method validates the provided email and password, authenticates the user, and 
-        returns a success message upon successful login. 
+        returns a success message along with an access token upon successful login. 
+        The token authenticates the following requests as `Authorization: Bearer <token>` 
+        until it expires, without checking the password again.
         If the credentials are invalid, it raises a validation error.
         
         Args:
             request: The HTTP request object containing the login data.
         
         Returns:
-            Response: A success message indicating the user has logged in successfully.
+            Response: A success message with the access token and its lifetime in seconds.
         
         Raises:
             ValidationError: If the email or password is invalid.
+            HashingPoolSaturated: If the password hashing pool is full, with a 503 status.
         """
 
         data = request.data
@@ -85,7 +96,33 @@ class UsersViewSet(viewsets.ModelViewSet):
             if user is None:
                 raise ValidationError(
                     {"message": ["Email or password is invalid"]})
-            return Response({"message": "Logged in successfully!"})
+            return Response({
+                "message": "Logged in successfully!",
+                "access_token": issue_access_token(user),
+                "token_type": SignedTokenAuthentication.keyword,
+                "expires_in": settings.ACCESS_TOKEN_LIFETIME,
+            })
+
+    @action(
+        methods=['post'], 
+        detail=False, 
+        permission_classes=[IsAuthenticated, ], 
+        authentication_classes=[SignedTokenAuthentication, ]
+        )
+    def logout(self, request):
+        """
+        Revokes the access token used to authenticate the request.
+        The token is refused from then on, even though it has not expired yet.
+        
+        Args:
+            request: The HTTP request object authenticated with an access token.
+        
+        Returns:
+            Response: A message indicating the user has logged out.
+        """
+
+        revoke_access_token(request.auth)
+        return Response({"message": "Logged out successfully!"})
     
     @action(
         methods=['get'], 
@@ -97,6 +134,8 @@ class UsersViewSet(viewsets.ModelViewSet):
         Retrieves a list of users based on optional search parameters.
         This method allows authenticated users to search for other users by a specified search term. 
         If no search term is provided, it returns all users, and the results can be paginated.
+        Matching users are looked up through the database search index and ordered by relevance,
+        or by id when paginating with a cursor.
         
         Args:
             request: The HTTP request object containing the search parameters.
@@ -107,13 +146,15 @@ class UsersViewSet(viewsets.ModelViewSet):
         Examples:
         To search for users with a specific title:
             GET /users/search?search=example
+        To page through the results with a cursor instead of page numbers:
+            GET /users/search?search=example&pagination=cursor
         """
 
         search_params = request.GET.get('search')
-        queryset = User.objects.filter(
-            Q(email__icontains=search_params) | 
-            Q(first_name__icontains=search_params) |
-            Q(last_name__icontains=search_params)) if search_params else User.objects.all()
+        queryset = User.objects.all()
+        if search_params:
+            # The database the read is routed to, a replica may run it
+            queryset = get_search_backend(queryset.db).search(queryset, search_params)
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = UserSerializer(page,many=True)